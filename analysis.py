@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+
+# Works out the numbers usually read off a runtime_plot.py graph, for one
+# recording or a whole archive of them:
+#
+#   output_at_30s        the reference every percentage is relative to, taken
+#                        the same way as rutite.py: the first measurement at
+#                        least 30s after the light came on
+#   runtime              ANSI FL1 runtime, the time until the output first
+#                        falls to 10% (--runtime-percent) of the output at 30s
+#   first_step_down      when the output first drops by a step, and from/to
+#   regulation_*         the longest level stretch after the first step-down:
+#                        its start, end and mean output, and its flatness, the
+#                        spread between its 5th and 95th percentiles in
+#                        percent of its mean (0 is perfectly flat)
+#   average_output       time-weighted average output up to the end of runtime
+#   lumen_hours          output integrated over the whole recording (lux_hours
+#                        if there's no lux to lumen factor)
+#   peak_temperature     and the time it was reached
+#   steps, plateaus      every step change, and the level stretches between them
+#
+# Output is in lumens if the recording has a lux to lumen factor (a binary log
+# stores it, and a csv file has it in its Lumens column) or one is given with
+# --lux-to-lumen-factor, and in lux otherwise.
+#
+# Averages and totals are integrated over time rather than summed over rows,
+# so recordings made with rutite.py --adaptive come out right, and rows
+# without a reading (gaps where a test was resumed) are bridged with a
+# straight line. Steps are found on the recording resampled to a fixed time
+# step: a step is wherever the mean of the --step-window seconds after a point
+# differs from the mean of the --step-window seconds before it by more than
+# --step-percent of the output at 30s. Both means come from one cumulative sum,
+# so a recording costs a few passes over its arrays whatever its length.
+#
+# Recordings are analysed in parallel, one process per core, and the results
+# are written as json (everything) or csv (one row of the single-number
+# metrics per recording).
+
+import argparse
+import csv
+import json
+import math
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+import pandas as pd
+
+import recording
+
+CSV_FIELDS = ['file', 'units', 'lux_to_lumen_factor', 'rows', 'duration', 'output_at_30s',
+        'runtime', 'runtime_reached', 'first_step_down', 'first_step_down_from', 'first_step_down_to',
+        'regulation_start', 'regulation_end', 'regulation_output', 'regulation_flatness',
+        'average_output', 'lumen_hours', 'lux_hours', 'peak_temperature', 'peak_temperature_time',
+        'step_count', 'plateau_count', 'error']
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='work out runtime, step-downs, regulation and output totals from RuTiTe recordings')
+    parser.add_argument('-in', '--input', dest='inputs', action='append', required=True,
+            help = 'recording, directory or glob of recordings; can be repeated')
+    parser.add_argument('-f', '--format', dest='format', choices=['json', 'csv'],
+            default = 'json',
+            help = 'json for every metric, step and plateau, or csv for one row of metrics per recording')
+    parser.add_argument('-o', '--outputfile', dest='output',
+            help = 'filename for the results (default: print them)')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int,
+            help = 'number of worker processes (default: one per core)')
+    parser.add_argument('-lf', '--lux-to-lumen-factor', dest='lux_to_lumen_factor', type=float,
+            help = 'lux to lumen factor for recordings that don\'t have their own')
+    add_metric_arguments(parser)
+    recording.add_cache_arguments(parser)
+    return parser
+
+
+def add_metric_arguments(parser):
+    # The settings the metrics are worked out with, shared with catalogue.py.
+    parser.add_argument('-rp', '--runtime-percent', dest='runtime_percent', type=float,
+            default = 10.0,
+            help = 'runtime ends when the output falls to this percentage of the output at 30s')
+    parser.add_argument('-sp', '--step-percent', dest='step_percent', type=float,
+            default = 10.0,
+            help = 'smallest change, in percent of the output at 30s, that counts as a step')
+    parser.add_argument('-sw', '--step-window', dest='step_window', type=float,
+            default = 5.0,
+            help = 'seconds averaged on each side of a point when looking for steps')
+    parser.add_argument('-pm', '--plateau-min', dest='plateau_min', type=float,
+            default = 30.0,
+            help = 'shortest level stretch, in seconds, that counts as a plateau')
+    parser.add_argument('-res', '--resolution', dest='resolution', type=float,
+            default = 1.0,
+            help = 'time step in seconds the recording is resampled to when looking for steps')
+
+
+def load_options(args=None):
+    return build_parser().parse_args(args)
+
+
+def load(filename, options):
+    # Returns seconds since the light came on, output, temperature and the
+    # output's units. The start is the test start in a binary log's header or
+    # a csv file's relative time column, or else the first row.
+    data = recording.read_recording(filename, recording.open_cache(options))
+    times = data.Time.to_numpy(dtype=float)
+    relative = pd.to_numeric(data['[relative time]'], errors='coerce').to_numpy(dtype=float)
+    if len(relative) and not np.isnan(relative).all():
+        seconds = relative
+    elif 'start_time' in data.attrs:
+        seconds = times - data.attrs['start_time']
+    else:
+        seconds = times - np.nanmin(times) if len(times) else times
+    lux = pd.to_numeric(data.Lux, errors='coerce').to_numpy(dtype=float)
+    temps = pd.to_numeric(data['Temperature (C)'], errors='coerce').to_numpy(dtype=float)
+
+    factor = data.attrs.get('lux_to_lumen_factor')
+    if not factor:
+        lumens = pd.to_numeric(data.Lumens, errors='coerce').to_numpy(dtype=float)
+        recorded = (lumens > 0) & (lux > 0)
+        if recorded.any():
+            factor = float(np.median(lux[recorded] / lumens[recorded]))
+    factor = factor or options.lux_to_lumen_factor
+    if factor:
+        return seconds, lux / factor, temps, 'lumens', factor
+    return seconds, lux, temps, 'lux', None
+
+
+def output_at_30s(seconds, output):
+    # Like rutite.py, the first measurement at or after 30s.
+    after = np.flatnonzero(seconds >= 30.0)
+    return output[after[0]] if len(after) else math.nan
+
+
+def integrate(seconds, output, end=None):
+    # Area under the output over time, up to `end` seconds.
+    if end is not None:
+        keep = seconds <= end
+        seconds, output = seconds[keep], output[keep]
+    if len(seconds) < 2:
+        return 0.0
+    return float(np.sum((output[1:] + output[:-1]) * np.diff(seconds)) / 2)
+
+
+def resample(seconds, output, resolution):
+    grid = np.arange(seconds[0], seconds[-1] + resolution / 2, resolution)
+    return grid, np.interp(grid, seconds, output)
+
+
+def find_steps(values, window, threshold):
+    # The mean of the `window` points after each point minus the mean of the
+    # `window` points before it. Each run of points where that's beyond the
+    # threshold (in one direction) is one step, at its largest change.
+    sums = np.r_[0.0, np.cumsum(values)]
+    i = np.arange(window, len(values) - window + 1)
+    if not len(i):
+        return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)
+    before = (sums[i] - sums[i - window]) / window
+    after = (sums[i + window] - sums[i]) / window
+    change = after - before
+    candidates = np.flatnonzero(np.abs(change) >= threshold)
+    if not len(candidates):
+        return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)
+    direction = np.sign(change[candidates])
+    new_run = np.r_[True, (np.diff(candidates) > 1) | (direction[1:] != direction[:-1])]
+    run = np.cumsum(new_run) - 1
+    order = np.lexsort((-np.abs(change[candidates]), run))
+    largest = order[np.r_[True, run[order][1:] != run[order][:-1]]]
+    steps = candidates[largest]
+    return i[steps], before[steps], after[steps]
+
+
+def longest_run(mask):
+    # Start and end (exclusive) of the longest run of True in mask.
+    edges = np.flatnonzero(np.diff(np.r_[0, mask.astype(np.int8), 0]))
+    starts, ends = edges[::2], edges[1::2]
+    if not len(starts):
+        return 0, 0
+    longest = np.argmax(ends - starts)
+    return starts[longest], ends[longest]
+
+
+def find_plateaus(grid, values, step_indexes, window, band, min_length):
+    # The stretches between steps, less a window either side of each step so
+    # the transitions aren't counted. A gradual fall (like the end of a
+    # battery) isn't a step, so each stretch is cut down to its longest run
+    # within `band` of its median. Only those at least min_length long count.
+    resolution = grid[1] - grid[0] if len(grid) > 1 else 0.0
+    plateaus = []
+    for start, end in zip(np.r_[0, step_indexes + window], np.r_[step_indexes - window, len(values)]):
+        if (end - start) * resolution < min_length:
+            continue
+        segment = values[start:end]
+        run_start, run_end = longest_run(np.abs(segment - np.median(segment)) <= band)
+        if (run_end - run_start) * resolution < min_length:
+            continue
+        level = segment[run_start:run_end]
+        plateaus.append({
+            'start': grid[start + run_start],
+            'end': grid[start + run_end - 1],
+            'mean': np.mean(level),
+            'min': np.min(level),
+            'max': np.max(level),
+            'flatness': flatness(level),
+        })
+    return plateaus
+
+
+def flatness(values):
+    low, high = np.percentile(values, [5, 95])
+    mean = np.mean(values)
+    return (high - low) / mean * 100.0 if mean else math.nan
+
+
+def analyse(seconds, output, temps, options):
+    # Every metric for one recording, as a dict.
+    if not np.isnan(temps).all():
+        peak = np.nanargmax(temps)
+        peak_temperature = {'peak_temperature': temps[peak], 'peak_temperature_time': seconds[peak]}
+    else:
+        peak_temperature = {}
+    valid = ~np.isnan(output) & ~np.isnan(seconds)
+    seconds, output = seconds[valid], output[valid]
+    if len(seconds) < 2:
+        raise ValueError('not enough measurements')
+    if np.any(np.diff(seconds) < 0):
+        order = np.argsort(seconds, kind='stable')
+        seconds, output = seconds[order], output[order]
+
+    reference = output_at_30s(seconds, output)
+    if np.isnan(reference) or reference <= 0:
+        raise ValueError('no output 30s into the test')
+    result = {'rows': len(seconds), 'duration': seconds[-1], 'output_at_30s': reference}
+
+    below = np.flatnonzero((seconds >= 30.0) & (output <= reference * options.runtime_percent / 100.0))
+    result['runtime_reached'] = bool(len(below))
+    result['runtime'] = seconds[below[0]] if len(below) else seconds[-1]
+
+    grid, values = resample(seconds, output, options.resolution)
+    window = max(1, int(round(options.step_window / options.resolution)))
+    threshold = reference * options.step_percent / 100.0
+    step_indexes, step_from, step_to = find_steps(values, window, threshold)
+    steps = [{'time': grid[i], 'from': before, 'to': after} for i, before, after in zip(step_indexes, step_from, step_to)]
+    down = [step for step in steps if step['to'] < step['from']]
+    if down:
+        result['first_step_down'] = down[0]['time']
+        result['first_step_down_from'] = down[0]['from']
+        result['first_step_down_to'] = down[0]['to']
+
+    plateaus = find_plateaus(grid, values, step_indexes, window, threshold, options.plateau_min)
+    regulation_start = result.get('first_step_down', 30.0)
+    regulated = [plateau for plateau in plateaus if plateau['end'] > regulation_start]
+    if regulated:
+        longest = max(regulated, key=lambda plateau: plateau['end'] - plateau['start'])
+        result['regulation_start'] = longest['start']
+        result['regulation_end'] = longest['end']
+        result['regulation_output'] = longest['mean']
+        result['regulation_flatness'] = longest['flatness']
+
+    if result['runtime'] > 0:
+        result['average_output'] = integrate(seconds, output, result['runtime']) / result['runtime']
+    result['output_hours'] = integrate(seconds, output) / 3600.0
+    result.update(peak_temperature)
+    result['step_count'] = len(steps)
+    result['plateau_count'] = len(plateaus)
+    result['steps'] = steps
+    result['plateaus'] = plateaus
+    return result
+
+
+def clean(value):
+    # Plain, rounded python values for json and csv, with None for NaN.
+    if isinstance(value, dict):
+        return {key: clean(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [clean(item) for item in value]
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return None if math.isnan(value) else round(float(value), 3)
+    return value
+
+
+def analyse_file(filename, options):
+    result = {'file': filename}
+    try:
+        seconds, output, temps, units, factor = load(filename, options)
+        result.update(units=units, lux_to_lumen_factor=factor)
+        metrics = analyse(seconds, output, temps, options)
+        metrics['lumen_hours' if units == 'lumens' else 'lux_hours'] = metrics.pop('output_hours')
+        result.update(metrics)
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    return clean(result)
+
+
+def analyse_all(filenames, options):
+    if len(filenames) == 1 or options.jobs == 1:
+        return [analyse_file(filename, options) for filename in filenames]
+    with ProcessPoolExecutor(max_workers=options.jobs) as executor:
+        return list(executor.map(analyse_file, filenames, repeat(options), chunksize=8))
+
+
+def write_results(results, options, f):
+    if options.format == 'json':
+        json.dump(results, f, indent=1)
+        f.write('\n')
+        return
+    writer = csv.DictWriter(f, CSV_FIELDS, extrasaction='ignore')
+    writer.writeheader()
+    writer.writerows(results)
+
+
+def main():
+    options = load_options()
+    filenames = recording.find_recordings(options.inputs)
+    if not filenames:
+        sys.exit('no recordings found')
+    start = time.perf_counter()
+    results = analyse_all(filenames, options)
+    if options.output:
+        with open(options.output, 'w', newline='') as f:
+            write_results(results, options, f)
+    else:
+        write_results(results, options, sys.stdout)
+    failed = sum(1 for result in results if 'error' in result)
+    print('Analysed {} recordings in {:.2f}s{}'.format(len(results) - failed, time.perf_counter() - start,
+            ', {} failed'.format(failed) if failed else ''), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
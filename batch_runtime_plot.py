@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+# Renders a runtime_plot.py graph for every recording in a directory or glob.
+#
+# Graphs are rendered in a pool of worker processes on the Agg backend. Each
+# worker imports matplotlib and runtime_plot once, and builds the styled figure
+# once per layout, reusing them for every file it's given. Any option
+# runtime_plot.py accepts can be given as the default for every file, and a
+# metadata file can override them per file:
+#
+#   {"defaults": {"lux_to_lumen_factor": 4.336},
+#    "files": {"turbo.csv": {"graph_title": "Turbo", "temp_sensor": "mcp9808"}}}
+#
+# A graph is skipped if neither its recording nor its options have changed
+# since it was last rendered.
+
+import argparse
+import contextlib
+import copy
+import hashlib
+import io
+import json
+import os.path
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import matplotlib
+matplotlib.use('Agg')
+import recording
+import runtime_plot
+
+STAMPS_FILE = '.rutite-batch.json'
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+            description='render runtime_plot.py graphs for a batch of recordings; other options are passed to runtime_plot.py as defaults for every file')
+    parser.add_argument('-in', '--input', dest='inputs', action='append', required=True,
+            help = 'directory or glob of recordings; can be repeated')
+    parser.add_argument('-md', '--metadata', dest='metadata',
+            help = 'json file of per-file options, as {"defaults": {...}, "files": {"name.csv": {...}}}')
+    parser.add_argument('-od', '--output-dir', dest='output_dir',
+            help = 'directory for the png files (default: next to each recording)')
+    # Taken here so it isn't read as an abbreviation of -od.
+    parser.add_argument('-o', '--outputfile', dest='output',
+            help = argparse.SUPPRESS)
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int,
+            help = 'number of worker processes (default: one per core)')
+    parser.add_argument('-f', '--force', dest='force', action='store_true',
+            help = 'render every graph, even if nothing has changed')
+    return parser
+
+
+def load_options(args=None):
+    parser = build_parser()
+    options, remaining = parser.parse_known_args(args)
+    plot_defaults = runtime_plot.build_parser().parse_args(remaining)
+    if options.output:
+        # Every graph would be saved over the same file.
+        parser.error('-o/--outputfile can\'t be used for a batch; use -od/--output-dir, or "output" for a file in the -md metadata')
+    return options, plot_defaults
+
+
+def plot_options(filename, plot_defaults, defaults, files, output_dir):
+    options = copy.copy(plot_defaults)
+    for entry in [defaults, recording.file_metadata(files, filename)]:
+        for key, value in entry.items():
+            setattr(options, key.replace('-', '_'), value)
+    stem = recording.strip_extensions(os.path.basename(filename))
+    options.filename = filename
+    options.graph_title = options.graph_title or stem
+    options.graph_subtitle = options.graph_subtitle or ''
+    if not options.output:
+        options.output = os.path.join(output_dir or os.path.dirname(filename), stem + '.png')
+    return options
+
+
+def fingerprint(options):
+    stat = os.stat(options.filename)
+    settings = dict(vars(options), input_size=stat.st_size, input_mtime_ns=stat.st_mtime_ns)
+    return hashlib.blake2b(json.dumps(settings, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+
+def load_stamps(directory):
+    try:
+        with open(os.path.join(directory, STAMPS_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_stamps(directory, stamps):
+    filename = os.path.join(directory, STAMPS_FILE)
+    temp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(temp_filename, 'w') as f:
+        json.dump(stamps, f, indent=1)
+    os.replace(temp_filename, filename)
+
+
+def init_worker():
+    matplotlib.use('Agg')
+
+
+def render(options):
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            runtime_plot.runtimeplot(options)
+        error = None
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    return options.output, time.perf_counter() - start, error
+
+
+def main():
+    options, plot_defaults = load_options()
+    defaults, files = recording.load_metadata(options.metadata)
+    if options.output_dir:
+        os.makedirs(options.output_dir, exist_ok=True)
+
+    todo = []
+    stamps = {}
+    skipped = 0
+    for filename in recording.find_recordings(options.inputs):
+        file_options = plot_options(filename, plot_defaults, defaults, files, options.output_dir)
+        directory = os.path.dirname(os.path.abspath(file_options.output))
+        if directory not in stamps:
+            stamps[directory] = load_stamps(directory)
+        key = os.path.basename(file_options.output)
+        stamp = fingerprint(file_options)
+        if not options.force and stamps[directory].get(key) == stamp and os.path.isfile(file_options.output):
+            skipped += 1
+            continue
+        todo.append((file_options, directory, key, stamp))
+
+    print('{} graphs to render, {} unchanged'.format(len(todo), skipped))
+    failed = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=options.jobs, initializer=init_worker) as executor:
+        futures = {executor.submit(render, file_options): (directory, key, stamp) for file_options, directory, key, stamp in todo}
+        for future in as_completed(futures):
+            directory, key, stamp = futures[future]
+            output, seconds, error = future.result()
+            if error:
+                failed += 1
+                print('{:7.2f}s  {}  FAILED: {}'.format(seconds, output, error))
+                continue
+            stamps[directory][key] = stamp
+            print('{:7.2f}s  {}'.format(seconds, output))
+    for directory, directory_stamps in stamps.items():
+        save_stamps(directory, directory_stamps)
+    print('Rendered {} graphs in {:.2f}s{}'.format(len(todo) - failed, time.perf_counter() - start,
+            ', {} failed'.format(failed) if failed else ''))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
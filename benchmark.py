@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+
+# Benchmarks for the acquisition loop and the plotting scripts.
+#
+# The acquisition benchmark runs rutite.core() through a whole test (baseline,
+# waiting for the light, the 30s sampling period and the main recording) on
+# the simulated backend, once for every combination of sensors, output format
+# and acquisition mode asked for. Sensor reads take as long as the latencies
+# below. Sample rate and interval jitter are measured from the recording in
+# simulated seconds; write cost and CPU time are measured in real time.
+#
+# The plotting benchmark renders synthetic recordings of increasing length with
+# runtime_plot.py and multi_runtime_plot.py.
+#
+# Results are printed as a table and saved as json, and a previous results
+# file can be passed to --compare to see what changed.
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time as _time
+
+import recording
+import rutite
+import simulation
+
+# Typical seconds per read on a Pi Zero, not counting integration time.
+SENSOR_LATENCY = {
+    'tsl2591': 0.002,
+    'veml7700': 0.0015,
+    'mcp9808': 0.001,
+    'mcp9600': 0.004,
+}
+PLOT_DURATIONS = {'1h': 3600, '24h': 86400, '7d': 604800}
+
+
+def percentile(values, p):
+    if not values:
+        return math.nan
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    f = math.floor(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+class TimedRecording:
+    # Wraps a recording writer to time every write_sample call, including any
+    # flush it triggers.
+    def __init__(self, recording):
+        self.recording = recording
+        self.write_times = []
+
+    def write_sample(self, *args):
+        start = _time.perf_counter()
+        self.recording.write_sample(*args)
+        self.write_times.append(_time.perf_counter() - start)
+
+    def __getattr__(self, name):
+        return getattr(self.recording, name)
+
+
+def acquisition_case(light_sensor, temp_sensor, output_format, mode, args, directory):
+    name = '{}/{}/{}/{}'.format(light_sensor, temp_sensor or 'no-temp', output_format, mode)
+    filename = os.path.join(directory, name.replace('/', '-') + ('.rtb' if output_format == 'binary' else '.csv'))
+    argv = [
+        '-o', filename,
+        '-i', str(args.interval),
+        '-bi', str(min(args.interval, 0.1)),
+        '-d', str((30 + args.duration) / 60.0),
+        '-of', output_format,
+        '-ls', light_sensor,
+        '-pp', '0',
+        '-hw', 'simulated',
+        '--sim-speed', str(args.speed),
+        '--sim-on-delay', '1',
+        '--sim-noise', '0.002',
+        '--sim-light-latency', str(SENSOR_LATENCY[light_sensor]),
+        '--sim-temp-latency', str(SENSOR_LATENCY.get(temp_sensor, 0.0)),
+        '--sim-profile', '0:0,0.5:1000,{0}:800'.format(30 + args.duration),
+    ]
+    if temp_sensor:
+        argv += ['-ts', temp_sensor]
+        if args.temp_interval:
+            argv += ['-ti', str(args.temp_interval)]
+    if mode == 'threaded':
+        argv += ['-th']
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        options = rutite.load_options(argv)
+        light, temp = rutite.init(options)
+        timed = TimedRecording(rutite.open_recording(options))
+        cpu_start = _time.process_time()
+        wall_start = _time.perf_counter()
+        try:
+            rutite.add_header(timed)
+            timing = rutite.core(options, light, temp, timed)
+        finally:
+            timed.close()
+        wall = _time.perf_counter() - wall_start
+        cpu = _time.process_time() - cpu_start
+
+    data = recording.read_recording(filename)
+    times = list(data.Time)
+    main_start = times[0] + 30.0 if times else 0.0
+    times = [t for t in times if t >= main_start]
+    intervals = [b - a for a, b in zip(times, times[1:])]
+    jitter = [abs(i - args.interval) for i in intervals]
+    scheduler = getattr(timing, 'scheduler', timing)
+    samples = len(data)
+    return {
+        'name': name,
+        'light_sensor': light_sensor,
+        'temp_sensor': temp_sensor,
+        'output_format': output_format,
+        'mode': mode,
+        'interval': args.interval,
+        'samples': samples,
+        'sample_rate': (len(times) - 1) / (times[-1] - times[0]) if len(times) > 1 else 0.0,
+        'target_rate': 1.0 / args.interval,
+        'jitter_p50': percentile(jitter, 50),
+        'jitter_p90': percentile(jitter, 90),
+        'jitter_p99': percentile(jitter, 99),
+        'jitter_max': max(jitter) if jitter else math.nan,
+        'late_ticks': scheduler.late_ticks,
+        'missed_ticks': scheduler.missed_ticks,
+        'dropped_samples': getattr(timing, 'dropped_samples', 0),
+        'write_cost_mean': statistics.fmean(timed.write_times) if timed.write_times else math.nan,
+        'write_cost_p99': percentile(timed.write_times, 99),
+        'cpu_time': cpu,
+        'cpu_per_sample': cpu / samples if samples else math.nan,
+        'wall_time': wall,
+        'file_size': os.path.getsize(filename),
+    }
+
+
+def write_synthetic_recording(filename, duration, rate, temp_sensor=True):
+    # A recording shaped like a real regulated runtime: turbo, a step-down,
+    # a long sagging regulation and the battery cut-off near the end.
+    curve = simulation.Curve.from_profile('0:1200,{}:1200,{}:450,{}:400,{}:30,{}:0'.format(
+            duration * 0.02, duration * 0.02 + 1, duration * 0.9, duration * 0.95, duration))
+    writer = rutite.RecordingWriter(filename, relative_time=False, lux_to_lumen_factor=None,
+            flush_rows=10000, fsync='never')
+    writer.write_header()
+    start = 1600000000.0
+    samples = int(duration * rate)
+    for i in range(samples + 1):
+        t = i / rate
+        lux = curve.lux_at(t)
+        temp = 22.0 + 30.0 * (1.0 - math.exp(-t / 600.0)) * lux / 1200.0 if temp_sensor else None
+        writer.write_sample(start + t, lux, temp, start)
+    writer.close()
+
+
+def plot_case(script, label, filename, duration, args):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import runtime_plot
+    import multi_runtime_plot
+
+    module = runtime_plot if script == 'runtime_plot' else multi_runtime_plot
+    argv = [
+        '-lf', '1',
+        '-g', 'benchmark {} {}'.format(script, label),
+        '-gs', 'synthetic',
+        '-glmax', '1400',
+        '-dmax', str(duration),
+        '-dmajor', str(max(duration // 12, 1)),
+        '-dminor', str(max(duration // 24, 1)),
+        '--no-cache',
+    ]
+    if script == 'runtime_plot':
+        argv += ['-in', filename, '-ts', 'mcp9808']
+    else:
+        argv += ['-in', filename] * 6
+    options = module.build_parser().parse_args(argv)
+
+    cpu_start = _time.process_time()
+    wall_start = _time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        module.runtimeplot(options)
+    wall = _time.perf_counter() - wall_start
+    cpu = _time.process_time() - cpu_start
+    plt.close('all')
+    return {
+        'name': '{}/{}'.format(script, label),
+        'script': script,
+        'duration': duration,
+        'rows': int(duration * args.plot_rate) + 1,
+        'file_size': os.path.getsize(filename),
+        'wall_time': wall,
+        'cpu_time': cpu,
+    }
+
+
+def run_acquisition(args, directory):
+    results = []
+    for light_sensor in args.light_sensors:
+        for temp_sensor in args.temp_sensors:
+            temp_sensor = None if temp_sensor == 'none' else temp_sensor
+            for output_format in args.formats:
+                for mode in args.modes:
+                    result = acquisition_case(light_sensor, temp_sensor, output_format, mode, args, directory)
+                    print('{name:40} {sample_rate:8.2f}/s (target {target_rate:.2f})  jitter p50 {jitter_p50:.4f}s p99 {jitter_p99:.4f}s  '
+                          'missed {missed_ticks:4d}  write {write_cost_mean:.6f}s  cpu/sample {cpu_per_sample:.6f}s'.format(**result))
+                    results.append(result)
+    return results
+
+
+def run_plots(args, directory):
+    results = []
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        for label in args.plot_durations:
+            duration = PLOT_DURATIONS[label]
+            filename = os.path.join(directory, 'synthetic-{}.csv'.format(label))
+            write_synthetic_recording(filename, duration, args.plot_rate)
+            for script in ['runtime_plot', 'multi_runtime_plot']:
+                result = plot_case(script, label, filename, duration, args)
+                print('{name:40} {rows:9d} rows  {wall_time:8.2f}s wall  {cpu_time:8.2f}s cpu'.format(**result))
+                results.append(result)
+    finally:
+        os.chdir(cwd)
+    return results
+
+
+def compare(results, previous_filename):
+    with open(previous_filename) as f:
+        previous = json.load(f)
+    print('\nCompared with {}:'.format(previous_filename))
+    for section, metrics in [('acquisition', ['sample_rate', 'jitter_p99', 'write_cost_mean', 'cpu_per_sample']),
+                             ('plotting', ['wall_time', 'cpu_time'])]:
+        before = {r['name']: r for r in previous.get(section, [])}
+        for result in results.get(section, []):
+            old = before.get(result['name'])
+            if not old:
+                continue
+            changes = []
+            for metric in metrics:
+                if old.get(metric) and not math.isnan(old[metric]):
+                    changes.append('{} {:+.1f}%'.format(metric, (result[metric] - old[metric]) / old[metric] * 100.0))
+            print('{:40} {}'.format(result['name'], '  '.join(changes)))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='benchmark the RuTiTe acquisition loop and plotting scripts')
+    parser.add_argument('-p', '--part', dest='parts', choices=['acquisition', 'plotting'], action='append',
+            help = 'which benchmarks to run (default: both)')
+    parser.add_argument('-i', '--interval', dest='interval', type=float,
+            default = 0.05,
+            help = 'interval between measurements in seconds')
+    parser.add_argument('-d', '--duration', dest='duration', type=float,
+            default = 10.0,
+            help = 'seconds of main recording after the 30s sampling period')
+    parser.add_argument('-s', '--speed', dest='speed', type=float,
+            default = 1.0,
+            help = 'simulation speed; above 1 the loop overhead is magnified by the same factor')
+    parser.add_argument('-ls', '--light-sensor', dest='light_sensors', choices=sorted(rutite.LIGHT_SENSORS), action='append',
+            help = 'light sensors to benchmark (default: all)')
+    parser.add_argument('-ts', '--temp-sensor', dest='temp_sensors', choices=['none'] + sorted(rutite.TEMP_SENSORS), action='append',
+            help = 'temp sensors to benchmark (default: none and mcp9808)')
+    parser.add_argument('-ti', '--temp-interval', dest='temp_interval', type=float,
+            help = 'seconds between temperature measurements')
+    parser.add_argument('-of', '--output-format', dest='formats', choices=['csv', 'binary'], action='append',
+            help = 'output formats to benchmark (default: both)')
+    parser.add_argument('-m', '--mode', dest='modes', choices=['sequential', 'threaded'], action='append',
+            help = 'acquisition modes to benchmark (default: both)')
+    parser.add_argument('-pd', '--plot-duration', dest='plot_durations', choices=list(PLOT_DURATIONS), action='append',
+            help = 'synthetic recording lengths to plot (default: all)')
+    parser.add_argument('-pr', '--plot-rate', dest='plot_rate', type=float,
+            default = 1.0,
+            help = 'samples per second in the synthetic recordings')
+    parser.add_argument('-o', '--output', dest='output',
+            default = _time.strftime('benchmark-%Y-%m-%d-%H.%M.%S.json', _time.localtime()),
+            help = 'json file to save the results to')
+    parser.add_argument('-c', '--compare', dest='compare',
+            help = 'previous results file to compare against')
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    args.parts = args.parts or ['acquisition', 'plotting']
+    args.light_sensors = args.light_sensors or sorted(rutite.LIGHT_SENSORS)
+    args.temp_sensors = args.temp_sensors or ['none', 'mcp9808']
+    args.formats = args.formats or ['csv', 'binary']
+    args.modes = args.modes or ['sequential', 'threaded']
+    args.plot_durations = args.plot_durations or list(PLOT_DURATIONS)
+
+    results = {
+        'created': _time.time(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'settings': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+    }
+    with tempfile.TemporaryDirectory(prefix='rutite-benchmark-') as directory:
+        if 'acquisition' in args.parts:
+            results['acquisition'] = run_acquisition(args, directory)
+        if 'plotting' in args.parts:
+            results['plotting'] = run_plots(args, directory)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results saved as {}'.format(args.output))
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
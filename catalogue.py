@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+
+# A catalogue of recordings in SQLite, so questions about a whole archive
+# ("which lights held 1000 lumens for 5 minutes?") are answered from indexes
+# instead of by opening every recording.
+#
+#   runs      one row per recording: where it is, when it was recorded, its
+#             title, sensors, interval and lux to lumen factor, and the
+#             metrics from analysis.py
+#   labels    any other metadata for a run (subtitle, station, battery, ...)
+#   plateaus  each run's level stretches, indexed by level
+#   curves    a coarse curve of each run: the mean, lowest and highest output
+#             in every --curve-step seconds, as float32 arrays
+#
+#   python3 catalogue.py --scan results/            add new and changed recordings
+#   python3 catalogue.py --held 1000 --for 300      runs that held 1000 for 5 minutes
+#   python3 catalogue.py --where "runtime > 3600" --plot long.png
+#
+# Scanning is incremental: a recording is only analysed again if its size or
+# modification time has changed since it was catalogued. Recordings are
+# analysed in parallel and written to the catalogue from one process.
+# rutite.py -cat adds each test to the catalogue when it completes.
+
+import argparse
+import copy
+import csv
+import json
+import math
+import os.path
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+
+import analysis
+import recording
+
+CATALOGUE_FILE = 'rutite-catalogue.sqlite'
+SCHEMA_VERSION = 1
+METRICS = ['units', 'rows', 'duration', 'output_at_30s', 'peak_output', 'runtime', 'runtime_reached',
+        'first_step_down', 'first_step_down_from', 'first_step_down_to',
+        'regulation_start', 'regulation_end', 'regulation_output', 'regulation_flatness',
+        'average_output', 'lumen_hours', 'lux_hours', 'peak_temperature', 'peak_temperature_time',
+        'step_count', 'plateau_count', 'error']
+RUN_COLUMNS = ['path', 'size', 'mtime_ns', 'catalogued', 'started', 'title', 'light_sensor', 'temp_sensor',
+        'interval', 'lux_to_lumen_factor'] + METRICS
+LIST_COLUMNS = ['started', 'title', 'output_at_30s', 'runtime', 'units', 'path']
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    catalogued REAL,
+    started REAL,
+    title TEXT,
+    light_sensor TEXT,
+    temp_sensor TEXT,
+    interval REAL,
+    lux_to_lumen_factor REAL,
+    units TEXT,
+    rows INTEGER,
+    duration REAL,
+    output_at_30s REAL,
+    peak_output REAL,
+    runtime REAL,
+    runtime_reached INTEGER,
+    first_step_down REAL,
+    first_step_down_from REAL,
+    first_step_down_to REAL,
+    regulation_start REAL,
+    regulation_end REAL,
+    regulation_output REAL,
+    regulation_flatness REAL,
+    average_output REAL,
+    lumen_hours REAL,
+    lux_hours REAL,
+    peak_temperature REAL,
+    peak_temperature_time REAL,
+    step_count INTEGER,
+    plateau_count INTEGER,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+CREATE INDEX IF NOT EXISTS runs_runtime ON runs (runtime);
+CREATE INDEX IF NOT EXISTS runs_peak_output ON runs (peak_output);
+CREATE TABLE IF NOT EXISTS labels (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (run_id, name)
+);
+CREATE INDEX IF NOT EXISTS labels_value ON labels (name, value);
+CREATE TABLE IF NOT EXISTS plateaus (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    start REAL,
+    end REAL,
+    mean REAL,
+    min REAL,
+    max REAL,
+    flatness REAL
+);
+CREATE INDEX IF NOT EXISTS plateaus_level ON plateaus (min, end - start);
+CREATE INDEX IF NOT EXISTS plateaus_run ON plateaus (run_id);
+CREATE TABLE IF NOT EXISTS curves (
+    run_id INTEGER PRIMARY KEY REFERENCES runs (id) ON DELETE CASCADE,
+    step REAL,
+    seconds BLOB,
+    mean BLOB,
+    min BLOB,
+    max BLOB
+);
+'''
+
+
+def connect(filename):
+    db = sqlite3.connect(filename, timeout=30)
+    db.row_factory = sqlite3.Row
+    db.execute('PRAGMA foreign_keys = ON')
+    db.execute('PRAGMA journal_mode = WAL')
+    if db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+        db.executescript(SCHEMA)
+        db.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+    return db
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+            description='catalogue RuTiTe recordings in SQLite and query them; other options are passed to multi_runtime_plot.py for --plot')
+    parser.add_argument('-cat', '--catalogue', dest='catalogue',
+            default = CATALOGUE_FILE,
+            help = 'the catalogue file')
+    parser.add_argument('-sc', '--scan', dest='scan', action='append', default=[],
+            help = 'add new and changed recordings in this directory or glob; can be repeated')
+    parser.add_argument('-md', '--metadata', dest='metadata',
+            help = 'json file of titles and labels for scanned files, as {"defaults": {...}, "files": {"name.csv": {...}}}')
+    parser.add_argument('--prune', dest='prune', action='store_true',
+            help = 'remove runs whose recordings no longer exist')
+    parser.add_argument('-cs', '--curve-step', dest='curve_step', type=float,
+            default = 10.0,
+            help = 'seconds per point of the coarse curve kept for each run (0 for none)')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int,
+            help = 'number of worker processes when scanning (default: one per core)')
+    parser.add_argument('--held', dest='held', type=float,
+            help = 'only runs whose output stayed at or above this level for --for seconds')
+    parser.add_argument('--for', dest='held_for', type=float,
+            default = 60.0,
+            help = 'seconds the output has to stay at or above --held')
+    parser.add_argument('-wh', '--where', dest='where',
+            help = 'only runs matching this SQL condition on the runs table (e.g. "runtime > 3600 and light_sensor = \'veml7700\'")')
+    parser.add_argument('-lb', '--label', dest='labels', action='append', default=[],
+            help = 'only runs with this label, as name=value; can be repeated')
+    parser.add_argument('-f', '--format', dest='format', choices=['table', 'csv', 'json'],
+            default = 'table',
+            help = 'how matching runs are listed')
+    parser.add_argument('-p', '--plot', dest='plot',
+            help = 'draw the coarse curves of the matching runs on one graph, saved as this png')
+    parser.add_argument('-lf', '--lux-to-lumen-factor', dest='lux_to_lumen_factor', type=float,
+            help = 'lux to lumen factor for recordings that don\'t have their own')
+    analysis.add_metric_arguments(parser)
+    recording.add_cache_arguments(parser)
+    return parser
+
+
+def load_options(args=None):
+    return build_parser().parse_known_args(args)
+
+
+def recording_start(filename):
+    # When the test started, from a binary log's header or a csv file's
+    # first row.
+    rows = recording.csv_rows(filename)
+    next(rows)
+    for row in rows:
+        try:
+            t = float(row[0])
+        except (ValueError, IndexError):
+            continue
+        try:
+            relative = float(row[2])
+        except (ValueError, IndexError):
+            relative = math.nan
+        rows.close()
+        return t if math.isnan(relative) else t - relative
+    return None
+
+
+def coarse_curve(seconds, output, step):
+    # The mean, lowest and highest output in each `step` seconds that has a
+    # reading, by bucket start.
+    valid = ~np.isnan(output)
+    seconds, output = seconds[valid], output[valid]
+    order = np.argsort(seconds, kind='stable')
+    seconds, output = seconds[order], output[order]
+    buckets = np.floor(seconds / step).astype(np.int64)
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    counts = np.diff(np.r_[starts, len(output)])
+    return {
+        'step': step,
+        'seconds': (buckets[starts] * step).astype('<f4'),
+        'mean': (np.add.reduceat(output, starts) / counts).astype('<f4'),
+        'min': np.minimum.reduceat(output, starts).astype('<f4'),
+        'max': np.maximum.reduceat(output, starts).astype('<f4'),
+    }
+
+
+def describe(filename, options, metadata=None):
+    # Everything the catalogue keeps about one recording. Runs in a worker.
+    metadata = {key.replace('-', '_'): value for key, value in (metadata or {}).items()}
+    stat = os.stat(filename)
+    run = {'path': filename, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'catalogued': time.time()}
+    entry = {'run': run, 'labels': {}, 'plateaus': [], 'curve': None}
+    try:
+        if recording.is_binary(filename):
+            header = recording.read_binary_header(filename)
+            run.update(started=header['start_time'], light_sensor=header['light_sensor'],
+                    temp_sensor=header['temp_sensor'], interval=header['interval'] or None)
+        else:
+            run['started'] = recording_start(filename)
+        file_options = copy.copy(options)
+        file_options.lux_to_lumen_factor = metadata.get('lux_to_lumen_factor') or options.lux_to_lumen_factor
+        seconds, output, temps, units, factor = analysis.load(filename, file_options)
+        run.update(units=units, lux_to_lumen_factor=factor)
+        if not run.get('interval'):
+            valid = seconds[~np.isnan(output)]
+            run['interval'] = float(np.median(np.diff(valid))) if len(valid) > 1 else None
+        run['peak_output'] = analysis.clean(np.nanmax(output)) if not np.isnan(output).all() else None
+        if options.curve_step and len(seconds):
+            entry['curve'] = coarse_curve(seconds, output, options.curve_step)
+        metrics = analysis.analyse(seconds, output, temps, file_options)
+        metrics['lumen_hours' if units == 'lumens' else 'lux_hours'] = metrics.pop('output_hours')
+        entry['plateaus'] = analysis.clean(metrics.pop('plateaus'))
+        metrics.pop('steps')
+        run.update(analysis.clean(metrics))
+    except Exception as e:
+        run['error'] = '{}: {}'.format(type(e).__name__, e)
+    for key in ['light_sensor', 'temp_sensor', 'interval', 'lux_to_lumen_factor']:
+        if metadata.get(key) is not None:
+            run[key] = metadata.pop(key)
+    run['title'] = metadata.pop('graph_title', None) or recording.strip_extensions(os.path.basename(filename))
+    entry['labels'] = {key: value for key, value in metadata.items() if value is not None}
+    return entry
+
+
+def store(db, entry):
+    run = entry['run']
+    db.execute('DELETE FROM runs WHERE path = ?', (run['path'],))
+    columns = [column for column in RUN_COLUMNS if column in run]
+    cursor = db.execute('INSERT INTO runs ({}) VALUES ({})'.format(', '.join(columns), ', '.join('?' * len(columns))),
+            [run[column] for column in columns])
+    run_id = cursor.lastrowid
+    db.executemany('INSERT INTO labels (run_id, name, value) VALUES (?, ?, ?)',
+            [(run_id, name, str(value)) for name, value in entry['labels'].items()])
+    db.executemany('INSERT INTO plateaus (run_id, start, end, mean, min, max, flatness) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(run_id, p['start'], p['end'], p['mean'], p['min'], p['max'], p['flatness']) for p in entry['plateaus']])
+    curve = entry['curve']
+    if curve is not None:
+        db.execute('INSERT INTO curves (run_id, step, seconds, mean, min, max) VALUES (?, ?, ?, ?, ?, ?)',
+                (run_id, curve['step'], curve['seconds'].tobytes(), curve['mean'].tobytes(), curve['min'].tobytes(), curve['max'].tobytes()))
+
+
+def add(catalogue, filename, options=None, metadata=None):
+    # Catalogues one recording, e.g. a test that's just completed.
+    if options is None:
+        options = load_options([])[0]
+    db = connect(catalogue)
+    try:
+        with db:
+            store(db, describe(os.path.abspath(filename), options, metadata))
+    finally:
+        db.close()
+
+
+def scan(db, options):
+    defaults, files = recording.load_metadata(options.metadata)
+    filenames = recording.find_recordings(options.scan)
+    known = {row['path']: (row['size'], row['mtime_ns']) for row in db.execute('SELECT path, size, mtime_ns FROM runs')}
+    todo = []
+    for filename in filenames:
+        stat = os.stat(filename)
+        if known.get(filename) == (stat.st_size, stat.st_mtime_ns):
+            continue
+        todo.append((filename, dict(defaults, **recording.file_metadata(files, filename))))
+    start = time.perf_counter()
+    if len(todo) > 1 and options.jobs != 1:
+        executor = ProcessPoolExecutor(max_workers=options.jobs)
+        entries = executor.map(describe, [filename for filename, _ in todo], repeat(options),
+                [metadata for _, metadata in todo], chunksize=4)
+    else:
+        executor = None
+        entries = (describe(filename, options, metadata) for filename, metadata in todo)
+    failed = 0
+    try:
+        with db:
+            for entry in entries:
+                store(db, entry)
+                failed += 'error' in entry['run']
+    finally:
+        if executor:
+            executor.shutdown()
+    print('Catalogued {} recordings in {:.2f}s, {} unchanged{}'.format(len(todo), time.perf_counter() - start,
+            len(filenames) - len(todo), ', {} with errors'.format(failed) if failed else ''), file=sys.stderr)
+
+
+def prune(db):
+    missing = [row['path'] for row in db.execute('SELECT path FROM runs') if not os.path.exists(row['path'])]
+    with db:
+        db.executemany('DELETE FROM runs WHERE path = ?', [(path,) for path in missing])
+    print('Removed {} runs whose recordings are gone'.format(len(missing)), file=sys.stderr)
+
+
+def load_curve(row):
+    return {name: np.frombuffer(row[name], dtype='<f4') for name in ['seconds', 'mean', 'min', 'max']}
+
+
+def longest_held(curve, step, level):
+    # Seconds of the longest stretch of consecutive buckets whose lowest
+    # output is at or above `level`.
+    held = curve['min'] >= level
+    if not held.any():
+        return 0.0
+    # A bucket without readings (a gap) breaks a stretch.
+    index = np.round(curve['seconds'] / step).astype(np.int64)
+    breaks = ~held | np.r_[False, np.diff(index) != 1]
+    run = np.cumsum(breaks)
+    lengths = np.bincount(run[held])
+    return float(lengths.max() * step)
+
+
+def query(db, options):
+    conditions, parameters = [], []
+    if options.where:
+        conditions.append('({})'.format(options.where))
+    for label in options.labels:
+        name, _, value = label.partition('=')
+        conditions.append('id IN (SELECT run_id FROM labels WHERE name = ? AND value = ?)')
+        parameters += [name, value]
+    if options.held is not None:
+        # The index narrows it down to runs that reached the level at all.
+        conditions.append('peak_output >= ?')
+        parameters.append(options.held)
+    sql = 'SELECT * FROM runs'
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    runs = [dict(row) for row in db.execute(sql + ' ORDER BY started', parameters)]
+    if options.held is None:
+        return runs
+    matching = []
+    for run in runs:
+        curve = db.execute('SELECT * FROM curves WHERE run_id = ?', (run['id'],)).fetchone()
+        if curve is not None and curve['step']:
+            held = longest_held(load_curve(curve), curve['step'], options.held)
+        else:
+            held = db.execute('SELECT max(end - start) FROM plateaus WHERE run_id = ? AND min >= ?',
+                    (run['id'], options.held)).fetchone()[0] or 0.0
+        if held >= options.held_for:
+            run['held'] = held
+            matching.append(run)
+    return matching
+
+
+def format_started(started):
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(started)) if started else ''
+
+
+def list_runs(runs, options, f):
+    if options.format == 'json':
+        json.dump(runs, f, indent=1)
+        f.write('\n')
+        return
+    columns = LIST_COLUMNS + (['held'] if options.held is not None else [])
+    if options.format == 'csv':
+        writer = csv.DictWriter(f, ['id'] + RUN_COLUMNS + (['held'] if options.held is not None else []), extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(runs)
+        return
+    rows = [[format_started(run['started']) if column == 'started' else
+            '' if run.get(column) is None else
+            '{:.0f}'.format(run[column]) if isinstance(run[column], float) else str(run[column])
+            for column in columns] for run in runs]
+    widths = [max([len(column)] + [len(row[i]) for row in rows]) for i, column in enumerate(columns)]
+    for row in [columns] + rows:
+        f.write('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip() + '\n')
+
+
+def plot(db, runs, options, remaining):
+    # One line per run, drawn from its coarse curve.
+    import matplotlib
+    matplotlib.use('Agg')
+    import multi_runtime_plot
+    from runtime_plot import runtime_figure
+    plot_options = multi_runtime_plot.build_parser().parse_args(remaining)
+    plot_options.graph_title = plot_options.graph_title or 'Runtime comparison'
+    plot_options.graph_subtitle = plot_options.graph_subtitle or ''
+    lines = []
+    for run in runs:
+        curve = db.execute('SELECT * FROM curves WHERE run_id = ?', (run['id'],)).fetchone()
+        if curve is None:
+            print('{} has no curve in the catalogue'.format(run['path']), file=sys.stderr)
+            continue
+        curve = load_curve(curve)
+        colour = multi_runtime_plot.COLOURS[len(lines) % len(multi_runtime_plot.COLOURS)]
+        lines.append((curve['seconds'].astype(float), curve['mean'].astype(float), run['title'], colour))
+    if not lines:
+        sys.exit('nothing to plot')
+    figure = runtime_figure(plot_options, series=len(lines), multi=True)
+    figure.render(plot_options, lines)
+    figure.save(options.plot)
+    print('Saved as {}'.format(options.plot), file=sys.stderr)
+
+
+def main():
+    options, remaining = load_options()
+    if remaining and not options.plot:
+        sys.exit('unrecognized arguments: {}'.format(' '.join(remaining)))
+    db = connect(options.catalogue)
+    try:
+        if options.scan:
+            scan(db, options)
+        if options.prune:
+            prune(db)
+        if options.scan or options.prune:
+            if not (options.where or options.labels or options.held is not None or options.plot):
+                return
+        runs = query(db, options)
+        list_runs(runs, options, sys.stdout)
+        if options.plot:
+            plot(db, runs, options, remaining)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
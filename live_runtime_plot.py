@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+
+# Follows a recording while the test is running and keeps a runtime_plot.py
+# graph of it up to date, either as a png that's replaced at every refresh or
+# in a window.
+#
+# Only the rows appended since the last refresh are read. They're folded into
+# the first, last, lowest and highest point of each pixel-wide slice of the
+# time axis (the same points runtime_plot.py's downsampling keeps), and the
+# lines are blitted over a copy of the rest of the graph, which is only drawn
+# once. A refresh costs the same whether the test has been running for a
+# minute or a week. If the test runs past --duration-max, the time axis is
+# doubled, and so is the output axis if the output goes over
+# --graph-lumens-max.
+
+import os.path
+import signal
+import sys
+import time
+
+import numpy as np
+
+import recording
+import runtime_plot
+from runtime_plot import RuntimeFigure, COLOUR_LUMENS
+
+
+class RecordingFollower:
+    # Reads what's been appended to a csv or binary recording since the last
+    # call, by file offset. A row that's only partly written is kept until the
+    # rest of it arrives. Starts again if the file is replaced by a shorter one.
+    # A compressed recording is decompressed as it arrives, so new rows show
+    # up at each of its flush points.
+    def __init__(self, filename):
+        self.filename = filename
+        self.reset()
+
+    def reset(self):
+        self.offset = 0
+        self.partial = b''
+        self.binary = None
+        self.header = None
+        self.start = b''
+        self.stream = None
+
+    def read(self):
+        # Returns arrays of seconds, lux and temperature for the new rows.
+        try:
+            f = open(self.filename, 'rb')
+        except FileNotFoundError:
+            return self.rows([], [], [])
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size < self.offset:
+                self.reset()
+            f.seek(self.offset)
+            data = f.read(size - self.offset)
+        self.offset += len(data)
+        if self.start is not None:
+            # Enough of the file to recognise it by, compressed or not.
+            data = self.start + data
+            if len(data) < len(recording.BINARY_MAGIC):
+                self.start = data
+                return self.rows([], [], [])
+            compression = recording.detect_compression(data)
+            if compression:
+                self.stream = recording.StreamDecompressor(compression)
+            self.start = None
+        if self.stream:
+            data = self.stream.decompress(data)
+        data = self.partial + data
+        self.partial = b''
+
+        if self.binary is None:
+            if len(data) < len(recording.BINARY_MAGIC):
+                self.partial = data
+                return self.rows([], [], [])
+            self.binary = data.startswith(recording.BINARY_MAGIC)
+        if self.binary:
+            return self.read_binary(data)
+        return self.read_csv(data)
+
+    def read_binary(self, data):
+        if self.header is None:
+            if len(data) < recording.HEADER.size:
+                self.partial = data
+                return self.rows([], [], [])
+            self.header = recording.unpack_header(data)
+            data = data[recording.HEADER.size:]
+        record = recording.RECORDS[self.header['version']]
+        usable = len(data) - len(data) % record.size
+        self.partial = data[usable:]
+        records = np.frombuffer(data[:usable], dtype=recording.RECORD_DTYPES[self.header['version']])
+        return records['t'] / 1000.0, records['lux'].astype(float), records['temp'].astype(float)
+
+    def read_csv(self, data):
+        end = data.rfind(b'\n') + 1
+        self.partial = data[end:]
+        seconds, lux, temps = [], [], []
+        for line in data[:end].decode().splitlines():
+            row = line.split(',')
+            try:
+                t = float(row[0])
+            except ValueError:
+                continue # header
+            seconds.append(t)
+            lux.append(float(row[1]))
+            temps.append(float(row[5]) if len(row) > 5 and row[5] not in ('', 'None') else np.nan)
+        return self.rows(seconds, lux, temps)
+
+    def rows(self, seconds, lux, temps):
+        return np.asarray(seconds, dtype=float), np.asarray(lux, dtype=float), np.asarray(temps, dtype=float)
+
+
+class PixelBuckets:
+    # runtime_plot.downsample, a few rows at a time: the first, lowest,
+    # highest and last point of each of `buckets` equal slices of [0, x_max].
+    # Memory and the number of points drawn don't grow with the recording.
+    FIRST, LOWEST, HIGHEST, LAST = range(4)
+
+    def __init__(self, buckets, x_max):
+        self.buckets = buckets
+        self.x_max = x_max
+        size = (buckets // 2 + 1) * 2
+        self.count = np.zeros(size, dtype=np.int64)
+        self.x = np.full((size, 4), np.nan)
+        self.y = np.full((size, 4), np.nan)
+
+    def add(self, x, y):
+        if not len(x):
+            return
+        bucket = np.clip(np.floor(x * (self.buckets / self.x_max)), 0, self.buckets).astype(np.int64)
+        starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+        ends = np.r_[starts[1:], len(x)]
+        for start, end in zip(starts, ends):
+            self.update(bucket[start], x[start:end], y[start:end])
+
+    def update(self, i, x, y):
+        bx, by = self.x[i], self.y[i]
+        if not self.count[i]:
+            bx[self.FIRST], by[self.FIRST] = x[0], y[0]
+        bx[self.LAST], by[self.LAST] = x[-1], y[-1]
+        if not np.isnan(y).all():
+            # Like downsample, the earliest lowest and the latest highest.
+            lowest, highest = np.nanargmin(y), len(y) - 1 - np.nanargmax(y[::-1])
+            if np.isnan(by[self.LOWEST]) or y[lowest] < by[self.LOWEST]:
+                bx[self.LOWEST], by[self.LOWEST] = x[lowest], y[lowest]
+            if np.isnan(by[self.HIGHEST]) or y[highest] >= by[self.HIGHEST]:
+                bx[self.HIGHEST], by[self.HIGHEST] = x[highest], y[highest]
+        self.count[i] += len(x)
+
+    def grow(self):
+        # Doubles x_max by merging each pair of neighbouring slices, which
+        # gives the same points as going through the whole recording again.
+        left, right = slice(0, None, 2), slice(1, None, 2)
+        count_left, count_right = self.count[left], self.count[right]
+        x_left, x_right = self.x[left], self.x[right]
+        y_left, y_right = self.y[left], self.y[right]
+        pick_right = np.empty(x_left.shape, dtype=bool)
+        pick_right[:, self.FIRST] = count_left == 0
+        pick_right[:, self.LAST] = count_right > 0
+        pick_right[:, self.LOWEST] = np.isnan(y_left[:, self.LOWEST]) | (y_right[:, self.LOWEST] < y_left[:, self.LOWEST])
+        pick_right[:, self.HIGHEST] = np.isnan(y_left[:, self.HIGHEST]) | (y_right[:, self.HIGHEST] >= y_left[:, self.HIGHEST])
+        half = len(self.count) // 2
+        self.x[:half] = np.where(pick_right, x_right, x_left)
+        self.y[:half] = np.where(pick_right, y_right, y_left)
+        self.count[:half] = count_left + count_right
+        self.x[half:] = np.nan
+        self.y[half:] = np.nan
+        self.count[half:] = 0
+        self.x_max *= 2
+
+    def points(self):
+        used = self.count > 0
+        x, y = self.x[used], self.y[used]
+        order = np.argsort(x, axis=1, kind='stable')
+        x = np.take_along_axis(x, order, axis=1).ravel()
+        y = np.take_along_axis(y, order, axis=1).ravel()
+        drawn = ~np.isnan(x)
+        return x[drawn], y[drawn]
+
+
+class LivePlot:
+    def __init__(self, options):
+        self.options = options
+        self.figure = RuntimeFigure(options.width, options.height,
+                temperature=bool(options.temp_sensor), pyplot=options.window)
+        fig = self.figure.fig
+        if options.window:
+            self.canvas = fig.canvas
+        else:
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            self.canvas = FigureCanvasAgg(fig)
+        self.lumens = PixelBuckets(options.width, options.duration_max)
+        self.temps = PixelBuckets(options.width, options.duration_max) if options.temp_sensor else None
+        self.lux_to_lumen_factor = options.lux_to_lumen_factor
+        self.t_start = None
+        self.background = None
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        self.draw_template()
+
+    def draw_template(self):
+        # Everything but the lines, which are drawn separately at each refresh.
+        options = self.options
+        self.figure.render(options, [([], [], options.y_label, COLOUR_LUMENS)],
+                ([], []) if self.temps else None)
+        for line in self.animated():
+            line.set_animated(True)
+        self.canvas.draw()
+
+    def on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.figure.fig.bbox)
+        self.draw_lines()
+
+    def animated(self):
+        lines = list(self.figure.lines)
+        if self.figure.temperature:
+            lines.append(self.figure.temperature)
+        return lines
+
+    def draw_lines(self):
+        self.figure.lines[0].set_data(*self.lumens.points())
+        if self.temps:
+            self.figure.temperature.set_data(*self.temps.points())
+        for line in self.animated():
+            line.axes.draw_artist(line)
+
+    def add(self, seconds, lux, temps, header=None):
+        if not len(seconds):
+            return
+        if self.t_start is None:
+            self.t_start = seconds[0]
+        if not self.lux_to_lumen_factor:
+            # Without a factor, lux is plotted as it is.
+            self.lux_to_lumen_factor = (header or {}).get('lux_to_lumen_factor') or 1.0
+        seconds = seconds - self.t_start
+        while np.nanmax(seconds) > self.options.duration_max:
+            self.grow()
+        lumens = lux / self.lux_to_lumen_factor
+        while np.any(lumens > self.options.graph_lumens_max):
+            self.grow_output()
+        self.lumens.add(seconds, lumens)
+        if self.temps:
+            self.temps.add(seconds, temps)
+
+    def grow(self):
+        options = self.options
+        options.duration_max *= 2
+        options.duration_major *= 2
+        options.duration_minor *= 2
+        self.lumens.grow()
+        if self.temps:
+            self.temps.grow()
+        self.draw_template()
+
+    def grow_output(self):
+        # Only the axis changes, as the lines are kept in seconds and lumens.
+        self.options.graph_lumens_max *= 2
+        self.options.lumens_step *= 2
+        self.draw_template()
+
+    def refresh(self):
+        self.canvas.restore_region(self.background)
+        self.draw_lines()
+        if self.options.window:
+            self.canvas.blit(self.figure.fig.bbox)
+            self.canvas.flush_events()
+        else:
+            self.save()
+
+    def save(self):
+        # Replaced in one go, so anything watching the file never sees half
+        # a png.
+        import matplotlib.image
+        output = runtime_plot.output_filename(self.options)
+        temp_filename = '{}.{}.tmp'.format(output, os.getpid())
+        matplotlib.image.imsave(temp_filename, np.asarray(self.canvas.buffer_rgba()), format='png')
+        os.replace(temp_filename, output)
+
+    def wait(self, seconds):
+        if self.options.window:
+            self.canvas.start_event_loop(seconds)
+        elif seconds > 0:
+            time.sleep(seconds)
+
+
+def build_parser():
+    parser = runtime_plot.build_parser()
+    parser.description = 'keep a runtime_plot.py graph of a recording up to date while the test is running'
+    parser.add_argument('-ri', '--refresh-interval', dest='refresh_interval', type=float,
+            default = 10.0,
+            help = 'seconds between refreshes')
+    parser.add_argument('-win', '--window', dest='window', action='store_true',
+            help = 'show the graph in a window instead of saving a png')
+    parser.add_argument('-sa', '--stop-after', dest='stop_after', type=float,
+            help = 'stop once the recording has not grown for this many seconds (default: run until stopped)')
+    return parser
+
+
+def load_options(args=None):
+    parser = build_parser()
+    options = parser.parse_args(args)
+    if not options.filename:
+        parser.error('give the recording to follow with --inputfile')
+    stem = recording.strip_extensions(os.path.basename(options.filename))
+    options.graph_title = options.graph_title or stem
+    options.graph_subtitle = options.graph_subtitle or ''
+    options.output = options.output or recording.strip_extensions(options.filename) + '.png'
+    return options
+
+
+def exit_on_signal(signum, frame):
+    sys.exit(0)
+
+
+def follow(options):
+    follower = RecordingFollower(options.filename)
+    live = LivePlot(options)
+    if options.window:
+        import matplotlib.pyplot as plt
+        plt.show(block=False)
+    print('Following {}...'.format(options.filename))
+    last_growth = time.monotonic()
+    deadline = last_growth
+    try:
+        while True:
+            seconds, lux, temps = follower.read()
+            now = time.monotonic()
+            if len(seconds):
+                live.add(seconds, lux, temps, follower.header)
+                last_growth = now
+                live.refresh()
+            if options.stop_after is not None and now - last_growth > options.stop_after:
+                break
+            deadline = max(deadline + options.refresh_interval, time.monotonic())
+            live.wait(deadline - time.monotonic())
+    finally:
+        # Pick up anything written since the last refresh.
+        seconds, lux, temps = follower.read()
+        live.add(seconds, lux, temps, follower.header)
+        live.refresh()
+
+
+def main():
+    options = load_options()
+    signal.signal(signal.SIGTERM, exit_on_signal)
+    try:
+        follow(options)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,79 +1,61 @@
 #!/usr/bin/env python3
 
-from time import strftime, gmtime, sleep
-from datetime import datetime, timedelta
-from string import Template
-import time
-import math
 import os.path
-from os import path
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import json
+import numpy as np
 import pandas as pd
 import argparse
 import sys
 import matplotlib.pyplot as plt
-import copy
-from matplotlib.ticker import (MultipleLocator, FormatStrFormatter,
-                               AutoMinorLocator, FuncFormatter, NullFormatter)
-import matplotlib.font_manager
-
-CSV_COUNT = 6
-FILE_1 = 'imalent_ms12_mini_turbo.csv'
-FILE_2 = 'imalent_ms12_mini_high.csv'
-FILE_3 = 'imalent_ms12_mini_middle_2.csv'
-FILE_4 = 'imalent_ms12_mini_middle_1.csv'
-FILE_5 = 'imalent_ms12_mini_middle_low.csv'
-FILE_6 = 'imalent_ms12_mini_low.csv'
-LABEL_1 = 'Turbo'
-LABEL_2 = 'High'
-LABEL_3 = 'Middle 2'
-LABEL_4 = 'Middle 1'
-LABEL_5 = 'Middle Low'
-LABEL_6 = 'Low'
+from recording import read_recording, add_cache_arguments, open_cache, strip_extensions
+from runtime_plot import seconds_since_start, output_filename, runtime_figure
 
 plt.rcParams["font.family"] = 'sans-serif'
-PX = 1/plt.rcParams['figure.dpi']
-TEMP_STEP = 2
-SMALL_SIZE = 8
-MEDIUM_SIZE = 9 
-BIGGER_SIZE = 12
-TITLE_SIZE = 14
-SUBTITLE_SIZE = 10
-
-# https://xkcd.com/color/rgb/
-COLOUR_LUMENS = 'xkcd:bright blue'
-COLOUR_TEMP = 'xkcd:bright red'
-COLOUR_1 = 'xkcd:bright blue'
-COLOUR_2 = 'xkcd:bright red'
-COLOUR_3 = 'xkcd:goldenrod'
-COLOUR_4 = 'xkcd:kelly green'
-COLOUR_5 = 'xkcd:orange'
-COLOUR_6 = 'xkcd:light magenta'
 
-class DeltaTemplate(Template):
-    delimiter = "%"
-
-
-def strfdelta(tdelta, fmt):
-    d = {"D": tdelta.days}
-    hours, rem = divmod(int(tdelta.total_seconds()), 3600)
-    minutes, seconds = divmod(rem, 60)
-    d["H"] = '{:02d}'.format(hours)
-    d["M"] = '{:02d}'.format(minutes)
-    d["S"] = '{:02d}'.format(seconds)
-    t = DeltaTemplate(fmt)
-    return t.substitute(**d)
+ALIGN_STEP = 1.0
 
+# https://xkcd.com/color/rgb/
+# Used in order for series that don't specify a colour.
+COLOURS = [
+    'xkcd:bright blue',
+    'xkcd:bright red',
+    'xkcd:goldenrod',
+    'xkcd:kelly green',
+    'xkcd:orange',
+    'xkcd:light magenta',
+    'xkcd:teal',
+    'xkcd:purple',
+    'xkcd:brown',
+    'xkcd:grey',
+]
 
 def build_parser():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-in','--inputfile', dest='filename', 
-            help = 'filename for the csv input')
+    parser.add_argument('-in','--inputfile', dest='filenames', action='append', default=[],
+            help = 'filename for a csv or binary input; repeat for each series')
+    parser.add_argument('-la', '--label', dest='labels', action='append', default=[],
+            help = 'legend label for each input, in the same order (default: the filename)')
+    parser.add_argument('-co', '--colour', dest='colours', action='append', default=[],
+            help = 'colour for each input, in the same order (default: a fixed palette)')
+    parser.add_argument('-m', '--manifest', dest='manifest',
+            help = 'json file listing the series to plot, as {"series": [{"file": ..., "label": ..., "colour": ..., "lux_to_lumen_factor": ...}]}')
+    parser.add_argument('-al', '--align', dest='align', choices=['none', 'nearest'],
+            default = 'none',
+            help = 'none to plot each series on its own time base, or nearest to resample every series onto a common time base first')
+    parser.add_argument('-as', '--align-step', dest='align_step', type=float,
+            help = 'seconds between points of the common time base (default: the slowest sample interval, or 1 if no input has two measurements)')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int,
+            help = 'number of processes to load the inputs with (default: one per core)')
     parser.add_argument('-lf', '--lux-to-lumen-factor', dest='lux_to_lumen_factor', type=float, 
             help = 'lux to lumen conversion factor for use in calibrated integrating enclosures')
     parser.add_argument('-ts', '--temp-sensor', dest='temp_sensor', choices=['mcp9600', 'mcp9808'],
             help = 'temp sensor')
     parser.add_argument('-g', '--graph-title', dest='graph_title',
             help = 'graph title')
+    parser.add_argument('-o', '--outputfile', dest='output',
+            help = 'filename for the png output (default: the graph title)')
     parser.add_argument('-gs', '--graph-subtitle', dest='graph_subtitle',
             help = 'graph subtitle')
     parser.add_argument('-yl', '--y-label', dest='y_label',
@@ -118,193 +100,109 @@ def build_parser():
     parser.add_argument('-wy', '--watermark-y', dest='watermark_y', type=float,
             default = 0.3,
             help = 'y location of watermark')
+    parser.add_argument('-nd', '--no-downsample', dest='no_downsample', action='store_true',
+            help = 'plot every recorded point instead of the lowest, highest, first and last in each pixel')
+    add_cache_arguments(parser)
     return parser
 
 
 def load_options():
     parser = build_parser()
     options = parser.parse_args()
+    if not options.filenames and not options.manifest:
+        parser.error('give at least one --inputfile or a --manifest')
     return options
 
 
-def convert_time_to_seconds(data):
-    # Make Duration start at zero (use Time to calculate duration).
-    time_start = datetime.fromtimestamp(data.Time.min())
-    data.Time = data.Time.map(lambda x: (datetime.fromtimestamp(x) - time_start).total_seconds())
-    return data.Time
+def load_series_list(options):
+    # Each series is a dict with file, label, colour and lux_to_lumen_factor.
+    series = []
+    if options.manifest:
+        with open(options.manifest) as f:
+            manifest = json.load(f)
+        if isinstance(manifest, dict):
+            manifest = manifest['series']
+        base = os.path.dirname(os.path.abspath(options.manifest))
+        for entry in manifest:
+            if isinstance(entry, str):
+                entry = {'file': entry}
+            series.append(dict(entry, file=os.path.join(base, entry['file'])))
+    for i, filename in enumerate(options.filenames):
+        entry = {'file': filename}
+        if i < len(options.labels):
+            entry['label'] = options.labels[i]
+        if i < len(options.colours):
+            entry['colour'] = options.colours[i]
+        series.append(entry)
+    for i, entry in enumerate(series):
+        entry.setdefault('label', strip_extensions(os.path.basename(entry['file'])))
+        entry.setdefault('colour', COLOURS[i % len(COLOURS)])
+        entry.setdefault('lux_to_lumen_factor', options.lux_to_lumen_factor)
+    return series
+
+
+def load_series(filename, options):
+    # Make Duration start at zero (use Time to calculate duration). Also
+    # returns the longest interval the recording was made at and its lux to
+    # lumen factor, if it says.
+    data = read_recording(filename, open_cache(options))
+    longest_interval = None
+    if 'Interval (s)' in data and data['Interval (s)'].notna().any():
+        longest_interval = float(data['Interval (s)'].max())
+    return (seconds_since_start(data.Time), data.Lux.to_numpy(dtype=float), longest_interval,
+            data.attrs.get('lux_to_lumen_factor'))
+
+
+def load_all(series, options):
+    filenames = [entry['file'] for entry in series]
+    if len(filenames) == 1 or options.jobs == 1:
+        return [load_series(filename, options) for filename in filenames]
+    with ProcessPoolExecutor(max_workers=options.jobs) as executor:
+        return list(executor.map(load_series, filenames, repeat(options)))
+
+
+def align(loaded, step=None):
+    # Resamples every series onto one time base, taking the nearest
+    # measurement within a step of each point. A recording made with
+    # rutite.py --adaptive can go longer than a step between measurements,
+    # so its points are taken from as far away as its longest interval.
+    # Without a series long enough to measure the step from, it's ALIGN_STEP.
+    if step is None:
+        step = max((np.nanmedian(np.diff(seconds)) for seconds, _, _, _ in loaded if len(seconds) > 1), default=np.nan)
+        if not step > 0:
+            step = ALIGN_STEP
+    end = max((seconds[-1] for seconds, _, _, _ in loaded if len(seconds)), default=None)
+    if end is None:
+        sys.exit('none of the inputs have any measurements to align')
+    base = pd.DataFrame({'Time': np.arange(0, end + step, step)})
+    aligned = []
+    for seconds, lux, longest_interval, lux_to_lumen_factor in loaded:
+        values = pd.DataFrame({'Time': seconds, 'Lux': lux}).sort_values('Time')
+        tolerance = max(step, longest_interval or 0)
+        merged = pd.merge_asof(base, values, on='Time', direction='nearest', tolerance=tolerance)
+        aligned.append((base.Time.to_numpy(), merged.Lux.to_numpy(), longest_interval, lux_to_lumen_factor))
+    return aligned
 
 
 def runtimeplot(options):
     
     print('Creating plot...')
-    if CSV_COUNT >= 6:
-      data_6 = pd.read_csv(FILE_6)
-      if CSV_COUNT == 6:
-        time_start = datetime.fromtimestamp(data_6.Time.min()) # place after first CSV
-      data_6.Time = convert_time_to_seconds(data_6)
-      data_6.set_index('Time', drop=False)
-    if CSV_COUNT >= 5:
-      data_5 = pd.read_csv(FILE_5)
-      if CSV_COUNT == 5:
-        time_start = datetime.fromtimestamp(data_5.Time.min()) # place after first CSV
-      data_5.Time = convert_time_to_seconds(data_5)
-      data_5.set_index('Time', drop=False)
-    if CSV_COUNT >= 4:
-      data_4 = pd.read_csv(FILE_4)
-      if CSV_COUNT == 4:
-        time_start = datetime.fromtimestamp(data_4.Time.min()) # place after first CSV
-      data_4.Time = convert_time_to_seconds(data_4)
-      data_4.set_index('Time', drop=False)
-    if CSV_COUNT >= 3:
-      data_3 = pd.read_csv(FILE_3)
-      if CSV_COUNT == 3:
-        time_start = datetime.fromtimestamp(data_3.Time.min()) # place after first CSV
-      data_3.Time = convert_time_to_seconds(data_3)
-      data_3.set_index('Time', drop=False)
-    if CSV_COUNT >= 2:
-      data_2 = pd.read_csv(FILE_2)
-      if CSV_COUNT == 2:
-        time_start = datetime.fromtimestamp(data_2.Time.min()) # place after first CSV
-      data_2.Time = convert_time_to_seconds(data_2)
-      data_2.set_index('Time', drop=False)
-    if CSV_COUNT >= 1:
-      data_1 = pd.read_csv(FILE_1)
-      data_1.Time = convert_time_to_seconds(data_1)
-      if CSV_COUNT == 1:
-        time_start = datetime.fromtimestamp(data_1.Time.min()) # place after first CSV
-      data_1.set_index('Time', drop=False)
-
-    #Time,Lux,[relative time],Duration,Lumens,Temperature (C)
-
-    if CSV_COUNT >= 1:
-      data_1.columns = ['Time', 'FILE_1', 'rel_time', 'Duration', 'Lumens', 'temp']
-    if CSV_COUNT >= 2:
-      data_2.columns = ['Time', 'FILE_2', 'rel_time', 'Duration', 'Lumens', 'temp']
-    if CSV_COUNT >= 3:
-      data_3.columns = ['Time', 'FILE_3', 'rel_time', 'Duration', 'Lumens', 'temp']
-    if CSV_COUNT >= 4:
-      data_4.columns = ['Time', 'FILE_4', 'rel_time', 'Duration', 'Lumens', 'temp']
-    if CSV_COUNT >= 5:
-      data_5.columns = ['Time', 'FILE_5', 'rel_time', 'Duration', 'Lumens', 'temp']
-    if CSV_COUNT >= 6:
-      data_6.columns = ['Time', 'FILE_6', 'rel_time', 'Duration', 'Lumens', 'temp']
-
-    # FIXME iterate over a collection instead....
-    if CSV_COUNT == 6:
-      data = data_6.join(data_5[['FILE_5']])
-    if CSV_COUNT == 5:
-      data = data_5.join(data_4[['FILE_4']])
-    if CSV_COUNT == 4:
-      data = data_4.join(data_3[['FILE_3']])
-    if CSV_COUNT == 3:
-      data = data_3.join(data_2[['FILE_2']])
-    if CSV_COUNT == 2:
-      data = data_2.join(data_1[['FILE_1']])
-    if CSV_COUNT == 1:
-      data = data_1
-
-    if CSV_COUNT >= 6:
-      data = data.join(data_4[['FILE_4']])
-    if CSV_COUNT >= 5:
-      data = data.join(data_3[['FILE_3']])
-    if CSV_COUNT >= 4:
-      data = data.join(data_2[['FILE_2']])
-    if CSV_COUNT >= 3:
-      data = data.join(data_1[['FILE_1']])
-    
-    plt.rc('font', size=SMALL_SIZE)          # controls default text sizes
-    plt.rc('axes', titlesize=SMALL_SIZE)     # fontsize of the axes title
-    plt.rc('axes', labelsize=MEDIUM_SIZE)    # fontsize of the x and y labels
-    plt.rc('xtick', labelsize=SMALL_SIZE)    # fontsize of the tick labels
-    plt.rc('ytick', labelsize=SMALL_SIZE)    # fontsize of the tick labels
-    plt.rc('legend', fontsize=SMALL_SIZE)    # legend fontsize
-    plt.rc('figure', titlesize=BIGGER_SIZE)  # fontsize of the figure title
-
-    fig, ax = plt.subplots(figsize=(options.width*PX, options.height*PX))
-    plt.suptitle(options.graph_title + '\n', fontsize=TITLE_SIZE, x=0.01, ha='left')
-    plt.rcParams['axes.titlepad'] = TITLE_SIZE
-    #fig.text(0.01, 0.92, options.graph_subtitle, fontsize=SUBTITLE_SIZE, ha='left', alpha=0.8)
-    fig.text(0.011, 0.938, options.graph_subtitle, fontsize=SUBTITLE_SIZE, ha='left', alpha=0.8)
-
-    plt.grid(True, which='both')
-    ax.minorticks_on()
-
-    if CSV_COUNT >= 1:
-      data.FILE_1 = data.FILE_1 / options.lux_to_lumen_factor 
-    if CSV_COUNT >= 2:
-      data.FILE_2 = data.FILE_2 / options.lux_to_lumen_factor
-    if CSV_COUNT >= 3:
-      data.FILE_3 = data.FILE_3 / options.lux_to_lumen_factor
-    if CSV_COUNT >= 4:
-      data.FILE_4 = data.FILE_4 / options.lux_to_lumen_factor
-    if CSV_COUNT >= 5:
-      data.FILE_5 = data.FILE_5 / options.lux_to_lumen_factor
-    if CSV_COUNT >= 6:
-      data.FILE_6 = data.FILE_6 / options.lux_to_lumen_factor
-
-    if CSV_COUNT >= 1:
-      ax.plot(data.Time, data.FILE_1, color=COLOUR_1, label=LABEL_1)
-    if CSV_COUNT >= 2:
-      ax.plot(data.Time, data.FILE_2, color=COLOUR_2, label=LABEL_2)
-    if CSV_COUNT >= 3:
-      ax.plot(data.Time, data.FILE_3, color=COLOUR_3, label=LABEL_3)
-    if CSV_COUNT >= 4:
-      ax.plot(data.Time, data.FILE_4, color=COLOUR_4, label=LABEL_4)
-    if CSV_COUNT >= 5:
-      ax.plot(data.Time, data.FILE_5, color=COLOUR_5, label=LABEL_5)
-    if CSV_COUNT >= 6:
-      ax.plot(data.Time, data.FILE_6, color=COLOUR_6, label=LABEL_6)
-    ax.set_xlabel('Duration hh:mm:ss')
-    ax.set_ylabel(options.y_label)
-    ax.set_ylim((options.graph_lumens_min, options.graph_lumens_max))
-    ax.set_yticks([x for x in range(options.graph_lumens_min, options.graph_lumens_max + options.lumens_step, options.lumens_step)])
-    ax.yaxis.set_minor_locator(MultipleLocator(options.lumens_step))
-    ax.yaxis.set_minor_formatter(NullFormatter())
-
-    formatter = FuncFormatter(lambda s, x: strfdelta(((time_start + pd.to_timedelta(s, unit='s')) - time_start), '%H:%M:%S'))
-    ax.xaxis.set_major_formatter(formatter)
-    ax.xaxis.set_minor_locator(MultipleLocator(options.duration_minor))
-    ax.set_xticks([x for x in range(0, (options.duration_max * 60) + 1, options.duration_major)])
-    x_ticks = ax.xaxis.get_major_ticks()
-    x_ticks[0].label1.set_visible(False)
-    x_ticks[-1].label1.set_visible(False)
-
-    fig.text(options.watermark_x, options.watermark_y, options.watermark, alpha=0.5, fontsize=TITLE_SIZE, ha='left')
-
-    plt.xlim(left=0)
-    plt.xlim(right=options.duration_max)
-
-    # Hide borders
-    ax.spines['left'].set_visible(False)
-    #ax.spines['right'].set_visible(False)
-    ax.spines['top'].set_visible(False)
-    # Hide left ticks lines
-    y_ticks = ax.yaxis.get_major_ticks()
-    [t.tick1line.set_visible(False) for t in y_ticks]
-    #[t.tick2line.set_visible(False) for t in y_ticks]
-
-
-    lines_labels = [ax.get_legend_handles_labels() for ax in fig.axes]
-    lines, labels = [sum(lol, []) for lol in zip(*lines_labels)]
-
-    # legend line thickness
-    handles = [copy.copy(ha) for ha in lines]
-    [ha.set_linewidth(CSV_COUNT - 1) for ha in handles]
-
-    fig.legend(handles, labels,
-        ncol=4444,
-        loc='upper center',
-        frameon=False,
-#        bbox_to_anchor=(0.5, 0.92),
-        bbox_to_anchor=(0.5, 0.938),
-        borderaxespad=0,
-        bbox_transform=fig.transFigure,
-        handlelength=0.7
-    )
-
-    #plt.tight_layout()
-    plt.tight_layout(rect=[0, 0, 1, 0.99])
-    plt.savefig(options.graph_title.replace(' ', '-').lower()+'.png')
+    series = load_series_list(options)
+    loaded = load_all(series, options)
+    if options.align == 'nearest':
+        loaded = align(loaded, options.align_step)
+
+    lines = []
+    for entry, (seconds, lux, _, recorded_factor) in zip(series, loaded):
+        # A factor given for the series wins over the one the recording has.
+        lux_to_lumen_factor = entry['lux_to_lumen_factor'] or recorded_factor
+        if not lux_to_lumen_factor:
+            sys.exit('{} has no lux to lumen factor; give one with -lf or in the manifest'.format(entry['file']))
+        lines.append((seconds, lux / lux_to_lumen_factor, entry['label'], entry['colour']))
+
+    figure = runtime_figure(options, series=len(series), multi=True)
+    figure.render(options, lines)
+    figure.save(output_filename(options))
     print('plot saved')
 
 
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+# Gain and integration time for the light sensors.
+#
+# A light sensor only has a new reading once per integration period, however
+# often it's read, and its gain sets the brightest light it can measure. The
+# sensors keep the gain and integration time rutite.py has always used unless
+# they're given with -gn and -it. With -ar, the gain is switched while the test
+# runs: down a step as soon as a reading gets near the top of the current
+# range (or saturates), and up a step when the light is dim enough to fit in
+# the more sensitive range with room to spare. A switch only takes effect from
+# the sensor's next full integration period, so the reading after one waits
+# for it. Every row records the gain and integration time it was measured at,
+# so a switch can't be mistaken for a change in the light.
+#
+# --fast picks the longest integration time that still gives a new reading at
+# every measurement (the sensor's shortest, for intervals shorter than that)
+# and turns on -ar, so short windows don't cost resolution in dim light.
+
+import collections
+
+# Switch down a step at this fraction of the range's ceiling, and up a step
+# when a reading is below this fraction of the next range's ceiling.
+RANGE_DOWN = 0.9
+RANGE_UP = 0.45
+
+LightRange = collections.namedtuple('LightRange', ['gain', 'integration_time', 'ceiling'])
+
+
+class LightRanges:
+    # The gains (as multipliers) and integration times (in milliseconds) a
+    # light sensor can be set to, and the function that sets them. The
+    # sensor's ceiling is at its lowest gain and shortest integration time,
+    # and falls in proportion to both.
+    def __init__(self, ceiling, gains, integration_times, default, set_range):
+        self.ceiling = ceiling
+        self.gains = sorted(gains)
+        self.integration_times = sorted(integration_times)
+        self.default = default
+        self.set_range = set_range
+
+    def range(self, gain, integration_time):
+        ceiling = self.ceiling * (self.gains[0] / gain) * (self.integration_times[0] / integration_time)
+        return LightRange(gain, integration_time, ceiling)
+
+    def fastest(self, interval):
+        # The longest integration time that fits in `interval` seconds.
+        fitting = [t for t in self.integration_times if t <= interval * 1000.0]
+        return fitting[-1] if fitting else self.integration_times[0]
+
+
+class RangedLightSensor:
+    # Wraps a light sensor driver with its gain and integration time, and
+    # with auto ranging, switches the gain as the light changes. `range` is
+    # the gain, integration time and ceiling of the last reading, and
+    # `setting` what the sensor is set to now.
+    def __init__(self, light_sensor, ranges, set_range, gain=None, integration_time=None, auto=False, clock=None):
+        self.light_sensor = light_sensor
+        self.ranges = ranges
+        self.set_range = set_range
+        self.auto = auto
+        self.clock = clock
+        self.switches = 0
+        default_gain, default_integration_time = ranges.default
+        self.switch(ranges.range(gain or default_gain, integration_time or default_integration_time))
+        self.range = self.setting
+
+    def switch(self, light_range):
+        self.set_range(self.light_sensor, light_range)
+        self.setting = light_range
+        # The period under way finishes with the old settings, so the first
+        # reading in the new range is the one after it.
+        self.settled = self.clock.monotonic() + 2 * light_range.integration_time / 1000.0
+
+    def step(self, direction):
+        gains = self.ranges.gains
+        i = gains.index(self.setting.gain) + direction
+        if 0 <= i < len(gains):
+            return self.ranges.range(gains[i], self.setting.integration_time)
+        return None
+
+    def read(self):
+        if self.settled is not None:
+            remaining = self.settled - self.clock.monotonic()
+            if remaining > 0:
+                self.clock.sleep(remaining)
+            self.settled = None
+        self.range = self.setting
+        try:
+            lux = self.light_sensor.lux
+        except RuntimeError:
+            return None # the TSL2591 driver raises when its counts overflow
+        return lux if lux < self.range.ceiling else None
+
+    @property
+    def lux(self):
+        lux = self.read()
+        if self.auto:
+            # A reading that's cut off is taken again a step down, as many
+            # times as it takes.
+            while lux is None:
+                light_range = self.step(-1)
+                if light_range is None:
+                    break
+                self.switch(light_range)
+                self.switches += 1
+                lux = self.read()
+            if lux is not None:
+                light_range = None
+                if lux >= self.range.ceiling * RANGE_DOWN:
+                    light_range = self.step(-1)
+                else:
+                    up = self.step(1)
+                    if up and lux < up.ceiling * RANGE_UP:
+                        light_range = up
+                if light_range:
+                    # This reading is good, so the switch is for the next one.
+                    self.switch(light_range)
+                    self.switches += 1
+        if lux is None:
+            return self.range.ceiling
+        return lux
+
+
+def add_arguments(parser):
+    parser.add_argument('-gn', '--gain', dest='gain', type=float,
+            help = 'light sensor gain as a multiplier, e.g. 1, 25, 428 or 9876 for the tsl2591, 0.125, 0.25, 1 or 2 for the veml7700 (default: the lowest for the tsl2591, 0.125 for the veml7700)')
+    parser.add_argument('-it', '--integration-time', dest='integration_time', type=int,
+            help = 'light sensor integration time in milliseconds, e.g. 100 to 600 for the tsl2591, 25 to 800 for the veml7700 (default: 100)')
+    parser.add_argument('-ar', '--auto-range', dest='auto_range', action='store_true',
+            help = 'switch the light sensor\'s gain as the light gets brighter or dimmer, instead of saturating or losing resolution')
+    parser.add_argument('-fast', '--fast', dest='fast', action='store_true',
+            help = 'use the longest integration time that gives a new reading at every measurement, with auto ranging')
+
+
+def prepare_options(options, ranges, name=None):
+    # Checks the gain and integration time against the sensor, and picks the
+    # integration time for --fast from the fastest interval the test uses.
+    label = ' for {}'.format(name) if name else ''
+    if options.gain is not None and options.gain not in ranges.gains:
+        raise ValueError('the {} can\'t use a gain of {:g}{} (it has {})'.format(options.light_sensor, options.gain, label,
+                ', '.join('{:g}'.format(gain) for gain in ranges.gains)))
+    if options.integration_time is not None and options.integration_time not in ranges.integration_times:
+        raise ValueError('the {} can\'t integrate for {}ms{} (it has {})'.format(options.light_sensor, options.integration_time, label,
+                ', '.join('{}ms'.format(t) for t in ranges.integration_times)))
+    if options.fast:
+        interval = min(options.delay, options.sampling_interval, options.min_interval)
+        if options.integration_time is None:
+            options.integration_time = ranges.fastest(interval)
+        options.auto_range = True
+        if options.integration_time > interval * 1000.0:
+            print('The {}{} only gives a new reading every {}ms, so measurements closer together than that repeat the last one'.format(
+                    options.light_sensor, label, options.integration_time))
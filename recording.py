@@ -0,0 +1,580 @@
+#!/usr/bin/env python3
+
+# Reading and writing RuTiTe recordings.
+#
+# Besides the csv layout, rutite.py can write a compact binary log: an 80 byte
+# header followed by fixed-width 21 byte records (12 bytes in version 1, 16 in
+# version 2, 20 in version 3). The header holds everything that would
+# otherwise be repeated on every csv row.
+#
+#   header  magic, version, flags, test start (epoch seconds), interval,
+#           lux to lumen factor (0 if not set), light sensor, temp sensor,
+#           light sensor integration time in ms (uint16, 0 if not known)
+#   record  milliseconds since test start (uint32), lux (float32),
+#           temperature (float32, NaN if there's no temp sensor), interval
+#           the measurement was taken at in seconds (float32, version 2 on),
+#           light sensor gain (float32, NaN if not known, version 3 on),
+#           event detected at the measurement (uint8 index into EVENTS,
+#           0 for none, version 4 on)
+#
+# The plotting scripts memory-map the records with numpy instead of parsing
+# text, and `python3 recording.py -in test.rtb` converts a binary log back to
+# the csv layout.
+#
+# Parsed csv recordings are cached as numpy arrays (see RecordingCache), so
+# re-rendering the same file skips parsing it again.
+#
+# Either layout can be written compressed with gzip, lzma (xz) or bz2 (see
+# CompressedWriter). Everything here that reads a recording recognises a
+# compressed one by its first bytes and decompresses it as it goes, so the
+# plotting scripts read test.csv.gz just like test.csv.
+
+import argparse
+import bz2
+import csv
+import glob
+import hashlib
+import io
+import json
+import lzma
+import math
+import os
+import os.path
+import struct
+import zipfile
+import zlib
+
+# Interval is the time between the previous measurement and this one, as
+# scheduled. It varies through a test with rutite.py --adaptive, so anything
+# that needs the time between rows should use it (or the timestamps) rather
+# than assume a fixed rate. Older recordings don't have it. A row without a
+# reading (a NaN lux) marks a gap, where rutite.py --resume picked up a test.
+# Gain and integration time are the light sensor's settings for the row, which
+# change through a test with rutite.py --auto-range (see ranging.py). Event
+# names what rutite.py --events detected at the row (see streaming.py).
+CSV_HEADER = ["Time", "Lux", "[relative time]", "Duration", "Lumens", "Temperature (C)", "Interval (s)",
+        "Gain", "Integration (ms)", "Event"]
+EVENTS = ['', 'step_down', 'step_up', 'regulation_start']
+
+BINARY_MAGIC = b'RUTITEB\0'
+BINARY_VERSION = 4
+BINARY_EXTENSION = '.rtb'
+FLAG_RELATIVE_TIME = 0x1
+FLAG_TEMPERATURE = 0x2
+HEADER = struct.Struct('<8sHHddd16s16sH10x')
+RECORDS = {
+    1: struct.Struct('<Iff'),
+    2: struct.Struct('<Ifff'),
+    3: struct.Struct('<Iffff'),
+    4: struct.Struct('<IffffB'),
+}
+RECORD_DTYPES = {
+    1: [('t', '<u4'), ('lux', '<f4'), ('temp', '<f4')],
+    2: [('t', '<u4'), ('lux', '<f4'), ('temp', '<f4'), ('interval', '<f4')],
+    3: [('t', '<u4'), ('lux', '<f4'), ('temp', '<f4'), ('interval', '<f4'), ('gain', '<f4')],
+    4: [('t', '<u4'), ('lux', '<f4'), ('temp', '<f4'), ('interval', '<f4'), ('gain', '<f4'), ('event', 'u1')],
+}
+RECORD = RECORDS[BINARY_VERSION]
+RECORD_DTYPE = RECORD_DTYPES[BINARY_VERSION]
+CACHE_SIZE_MB = 512
+COMPRESSION_EXTENSIONS = {'gzip': '.gz', 'lzma': '.xz', 'bz2': '.bz2'}
+COMPRESSION_MAGIC = {'gzip': b'\x1f\x8b', 'lzma': b'\xfd7zXZ\x00', 'bz2': b'BZh'}
+READ_SIZE = 1 << 16
+RECORDING_PATTERNS = ['*.csv', '*.rtb'] + ['*' + extension + compressed
+        for extension in ['.csv', '.rtb'] for compressed in COMPRESSION_EXTENSIONS.values()]
+
+
+def pack_header(start_time, interval, lux_to_lumen_factor=None, light_sensor=None, temp_sensor=None, relative_time=False,
+        integration_time=None):
+    flags = 0
+    if relative_time:
+        flags |= FLAG_RELATIVE_TIME
+    if temp_sensor:
+        flags |= FLAG_TEMPERATURE
+    return HEADER.pack(BINARY_MAGIC, BINARY_VERSION, flags, start_time, interval,
+            lux_to_lumen_factor or 0.0,
+            (light_sensor or '').encode('ascii'),
+            (temp_sensor or '').encode('ascii'),
+            integration_time or 0)
+
+
+def unpack_header(data):
+    magic, version, flags, start_time, interval, factor, light_sensor, temp_sensor, integration_time = HEADER.unpack(data[:HEADER.size])
+    if magic != BINARY_MAGIC:
+        raise ValueError('not a RuTiTe binary recording')
+    if version not in RECORDS:
+        raise ValueError('unsupported RuTiTe binary recording version {}'.format(version))
+    return {
+        'start_time': start_time,
+        'interval': interval,
+        'lux_to_lumen_factor': factor or None,
+        'light_sensor': light_sensor.rstrip(b'\0').decode('ascii') or None,
+        'temp_sensor': temp_sensor.rstrip(b'\0').decode('ascii') or None,
+        'relative_time': bool(flags & FLAG_RELATIVE_TIME),
+        'integration_time': integration_time or None,
+        'version': version,
+    }
+
+
+def pack_record(t_offset, lux, temp, interval=None, gain=None, event=None, version=BINARY_VERSION):
+    fields = [max(0, int(round(t_offset * 1000))), lux,
+            math.nan if temp is None else temp,
+            math.nan if interval is None else interval,
+            math.nan if gain is None else gain,
+            EVENTS.index(event or '')]
+    record = RECORDS[version]
+    return record.pack(*fields[:len(record.format) - 1])
+
+
+def compressor(compression):
+    if compression == 'gzip':
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if compression == 'lzma':
+        return lzma.LZMACompressor(lzma.FORMAT_XZ)
+    if compression == 'bz2':
+        return bz2.BZ2Compressor()
+    raise ValueError('unknown compression {}'.format(compression))
+
+
+def decompressor(compression):
+    if compression == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if compression == 'lzma':
+        return lzma.LZMADecompressor(lzma.FORMAT_XZ)
+    return bz2.BZ2Decompressor()
+
+
+def detect_compression(data):
+    for compression, magic in COMPRESSION_MAGIC.items():
+        if data.startswith(magic):
+            return compression
+    return None
+
+
+def compression_of(filename):
+    with open(filename, 'rb') as f:
+        return detect_compression(f.read(8))
+
+
+def strip_extensions(filename):
+    # test.csv.gz -> test
+    stem, extension = os.path.splitext(filename)
+    if extension in COMPRESSION_EXTENSIONS.values():
+        stem = os.path.splitext(stem)[0]
+    return stem
+
+
+class CompressedWriter(io.RawIOBase):
+    # Compresses everything written to it into `file`. block() makes a flush
+    # point: a sync flush for gzip, and for lzma and bz2 (which can't flush
+    # part way through a stream) the end of the stream, with the next block
+    # starting a new one. Everything before the last flush point can be read
+    # back even if the file is never closed, so a crash only loses the block
+    # being written. Appending to an existing file just adds another stream.
+    def __init__(self, file, compression):
+        self.file = file
+        self.compression = compression
+        self.compressor = None
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.compressor is None:
+            self.compressor = compressor(self.compression)
+        self.file.write(self.compressor.compress(data))
+        return len(data)
+
+    def block(self):
+        if self.compressor is None:
+            return
+        if self.compression == 'gzip':
+            self.file.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        else:
+            self.file.write(self.compressor.flush())
+            self.compressor = None
+        self.file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.compressor is not None:
+                self.file.write(self.compressor.flush())
+                self.compressor = None
+            self.file.close()
+        finally:
+            super().close()
+
+
+class StreamDecompressor:
+    # Decompresses a compressed recording a piece at a time, including one
+    # made of several streams (see CompressedWriter). Anything after the last
+    # complete flush point, like the end of a file that's still being
+    # written, just isn't returned yet.
+    def __init__(self, compression):
+        self.compression = compression
+        self.decompressor = decompressor(compression)
+
+    def decompress(self, data):
+        chunks = []
+        while data:
+            chunks.append(self.decompressor.decompress(data))
+            if not self.decompressor.eof:
+                break
+            data = self.decompressor.unused_data
+            self.decompressor = decompressor(self.compression)
+        return b''.join(chunks)
+
+
+class DecompressingReader(io.RawIOBase):
+    def __init__(self, file, compression):
+        self.file = file
+        self.stream = StreamDecompressor(compression)
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            data = self.file.read(READ_SIZE)
+            if not data:
+                return 0
+            self.pending = self.stream.decompress(data)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+        super().close()
+
+
+def open_input(filename, text=False):
+    # Opens a recording for reading, decompressing it if it's compressed.
+    f = open(filename, 'rb')
+    compression = detect_compression(f.peek(8)[:8])
+    if compression:
+        f = io.BufferedReader(DecompressingReader(f, compression), READ_SIZE)
+    if text:
+        return io.TextIOWrapper(f, newline='')
+    return f
+
+
+def find_recordings(inputs):
+    # Every recording in each directory, plus whatever each glob matches.
+    filenames = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            for recording_pattern in RECORDING_PATTERNS:
+                filenames += glob.glob(os.path.join(pattern, recording_pattern))
+        else:
+            filenames += glob.glob(pattern)
+    return sorted(set(os.path.abspath(filename) for filename in filenames))
+
+
+def load_metadata(filename):
+    # Per-file settings, as {"defaults": {...}, "files": {"name.csv": {...}}},
+    # with each file's name relative to the metadata file. Returns the
+    # defaults and the entries by path and by name.
+    if not filename:
+        return {}, {}
+    with open(filename) as f:
+        metadata = json.load(f)
+    base = os.path.dirname(os.path.abspath(filename))
+    files = {}
+    for name, entry in metadata.get('files', {}).items():
+        files[os.path.abspath(os.path.join(base, name))] = entry
+        files.setdefault(os.path.basename(name), entry)
+    return metadata.get('defaults', {}), files
+
+
+def file_metadata(files, filename):
+    return files.get(filename) or files.get(os.path.basename(filename)) or {}
+
+
+def trim_recording(filename):
+    # Cuts a recording back to its last complete row or record, so rows can be
+    # appended to it after a crash (see rutite.py --resume), and returns the
+    # time of that row (None if it has none). A compressed recording is
+    # rewritten with everything up to its last flush point, as a stream cut
+    # off part way can't be added to.
+    compression = compression_of(filename)
+    if compression:
+        with open_input(filename) as f:
+            data = f.read()
+    else:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    last_time = None
+    if data.startswith(BINARY_MAGIC) and len(data) >= HEADER.size:
+        header = unpack_header(data)
+        record = RECORDS[header['version']]
+        end = len(data) - (len(data) - HEADER.size) % record.size
+        if end > HEADER.size:
+            last_time = header['start_time'] + record.unpack(data[end - record.size:end])[0] / 1000.0
+    else:
+        end = data.rfind(b'\n') + 1
+        last_row = data[data.rfind(b'\n', 0, end - 1) + 1:end]
+        try:
+            last_time = float(last_row.split(b',')[0])
+        except ValueError:
+            pass # only the header
+    if not compression:
+        if end < len(data):
+            with open(filename, 'r+b') as f:
+                f.truncate(end)
+        return last_time
+    temp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    with CompressedWriter(open(temp_filename, 'wb'), compression) as f:
+        f.write(data[:end])
+    os.replace(temp_filename, filename)
+    return last_time
+
+
+def read_csv(filename):
+    import pandas as pd
+    with open_input(filename, text=True) as f:
+        return pd.read_csv(f)
+
+
+def is_binary(filename):
+    with open_input(filename) as f:
+        return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+def read_binary_header(filename):
+    with open_input(filename) as f:
+        return unpack_header(f.read(HEADER.size))
+
+
+def load_binary(filename):
+    # Returns the header and a read-only memory-mapped record array, or for a
+    # compressed recording an array of the decompressed records. A record cut
+    # short by a crash mid-write is left off the end.
+    import numpy as np
+    if compression_of(filename):
+        with open_input(filename) as f:
+            header = unpack_header(f.read(HEADER.size))
+            data = f.read()
+        record = RECORDS[header['version']]
+        usable = len(data) - len(data) % record.size
+        return header, np.frombuffer(data[:usable], dtype=RECORD_DTYPES[header['version']])
+    header = read_binary_header(filename)
+    dtype = RECORD_DTYPES[header['version']]
+    count = (os.path.getsize(filename) - HEADER.size) // RECORDS[header['version']].size
+    if count <= 0:
+        return header, np.zeros(0, dtype=dtype)
+    return header, np.memmap(filename, dtype=dtype, mode='r', offset=HEADER.size, shape=(count,))
+
+
+def read_binary_recording(filename):
+    import numpy as np
+    import pandas as pd
+    header, records = load_binary(filename)
+    t_relative = records['t'] / 1000.0
+    lux = records['lux'].astype(np.float64)
+    nan = np.full(len(records), np.nan)
+    data = pd.DataFrame({
+        'Time': header['start_time'] + t_relative,
+        'Lux': lux,
+        '[relative time]': t_relative if header['relative_time'] else nan,
+        'Duration': t_relative / 86400 if header['relative_time'] else nan,
+        'Lumens': lux / header['lux_to_lumen_factor'] if header['lux_to_lumen_factor'] else nan,
+        'Temperature (C)': records['temp'].astype(np.float64),
+        'Interval (s)': records['interval'].astype(np.float64) if 'interval' in records.dtype.names else nan,
+        'Gain': records['gain'].astype(np.float64) if 'gain' in records.dtype.names else nan,
+        'Integration (ms)': np.where(np.isnan(records['gain']), np.nan, header['integration_time'] or np.nan)
+                if 'gain' in records.dtype.names else nan,
+        'Event': np.array(EVENTS, dtype=object)[records['event']] if 'event' in records.dtype.names else nan,
+    }, columns=CSV_HEADER)
+    data.attrs.update(header)
+    return data
+
+
+def read_recording(filename, cache=None):
+    # Loads a csv or binary recording into a DataFrame with the csv columns.
+    # Binary recordings are memory-mapped (or for compressed ones, read
+    # straight into an array), so they're never worth caching.
+    if is_binary(filename):
+        return read_binary_recording(filename)
+    if cache:
+        return cache.read(filename)
+    return read_csv(filename)
+
+
+def content_hash(filename):
+    digest = hashlib.blake2b(digest_size=20)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class RecordingCache:
+    # Parsed csv recordings, saved as uncompressed numpy arrays named after a
+    # hash of the file's contents. An index maps each path, size and mtime to
+    # its hash, so an unchanged file is found without reading it, and a copied
+    # or touched file is only hashed rather than parsed again. Least recently
+    # used entries are removed once the cache grows past max_bytes.
+    def __init__(self, directory=None, max_bytes=CACHE_SIZE_MB * 1024 * 1024):
+        if directory is None:
+            directory = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'rutite')
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_filename = os.path.join(directory, 'index.json')
+        os.makedirs(directory, exist_ok=True)
+
+    def load_index(self):
+        try:
+            with open(self.index_filename) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_index(self, index):
+        temp_filename = '{}.{}.tmp'.format(self.index_filename, os.getpid())
+        with open(temp_filename, 'w') as f:
+            json.dump(index, f)
+        os.replace(temp_filename, self.index_filename)
+
+    def read(self, filename):
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        index = self.load_index()
+        entry = index.get(path)
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            digest = entry['hash']
+        else:
+            digest = content_hash(path)
+            index[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': digest}
+            self.save_index(index)
+
+        cached = os.path.join(self.directory, digest + '.npz')
+        data = self.load(cached)
+        if data is None:
+            data = read_csv(path)
+            self.store(cached, data)
+            self.evict()
+        return data
+
+    def load(self, cached):
+        import numpy as np
+        import pandas as pd
+        try:
+            with np.load(cached, allow_pickle=False) as arrays:
+                meta = json.loads(str(arrays['meta']))
+                data = pd.DataFrame({name: arrays['c{}'.format(i)] for i, name in enumerate(meta['columns'])},
+                        columns=meta['columns'])
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            return None
+        os.utime(cached)
+        return data
+
+    def store(self, cached, data):
+        import numpy as np
+        import pandas as pd
+        arrays = {}
+        for i, name in enumerate(data.columns):
+            column = data[name]
+            if column.dtype == object:
+                # Text columns (like Event) are kept as text.
+                numeric = pd.to_numeric(column, errors='coerce')
+                column = numeric if numeric.count() >= column.count() else column.fillna('').astype(str)
+            arrays['c{}'.format(i)] = column.to_numpy()
+        temp_filename = '{}.{}.tmp'.format(cached, os.getpid())
+        with open(temp_filename, 'wb') as f:
+            np.savez(f, meta=np.array(json.dumps({'columns': list(data.columns)})), **arrays)
+        os.replace(temp_filename, cached)
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+
+def add_cache_arguments(parser):
+    parser.add_argument('-nc', '--no-cache', dest='no_cache', action='store_true',
+            help = 'parse the input again instead of using the cached copy')
+    parser.add_argument('--cache-dir', dest='cache_dir',
+            help = 'directory for cached recordings (default: ~/.cache/rutite)')
+    parser.add_argument('--cache-size', dest='cache_size', type=int,
+            default = CACHE_SIZE_MB,
+            help = 'maximum size of the cache in MB')
+
+
+def open_cache(options):
+    if options.no_cache:
+        return None
+    return RecordingCache(options.cache_dir, options.cache_size * 1024 * 1024)
+
+
+def csv_rows(filename):
+    # Yields the csv layout, header row first, for either kind of recording.
+    if not is_binary(filename):
+        with open_input(filename, text=True) as f:
+            yield from csv.reader(f, delimiter=',')
+        return
+    with open_input(filename) as f:
+        header = unpack_header(f.read(HEADER.size))
+        record = RECORDS[header['version']]
+        yield CSV_HEADER
+        while True:
+            data = f.read(record.size)
+            if len(data) < record.size:
+                break
+            t_ms, lux, temp, *rest = record.unpack(data)
+            interval, gain, event = (rest + [math.nan, math.nan, 0])[:3]
+            t_relative = t_ms / 1000.0
+            yield [
+                header['start_time'] + t_relative,
+                lux,
+                t_relative if header['relative_time'] else '',
+                t_relative / 86400 if header['relative_time'] else '',
+                lux / header['lux_to_lumen_factor'] if header['lux_to_lumen_factor'] else '',
+                '' if math.isnan(temp) else temp,
+                # Stored as a float32, so written as the value it was set to.
+                '' if math.isnan(interval) else '{:g}'.format(interval),
+                '' if math.isnan(gain) else '{:g}'.format(gain),
+                (header['integration_time'] or '') if not math.isnan(gain) else '',
+                EVENTS[event],
+            ]
+
+
+def convert_to_csv(filename, output):
+    with open(output, 'w') as f:
+        csv.writer(f, delimiter=',').writerows(csv_rows(filename))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='convert a binary RuTiTe recording to csv')
+    parser.add_argument('-in','--inputfile', dest='filename', required=True,
+            help = 'filename for the binary input, which can be compressed')
+    parser.add_argument('-o','--outputfile', dest='output',
+            help = 'filename for the csv output (default: the input name with a .csv extension)')
+    return parser
+
+
+def main():
+    options = build_parser().parse_args()
+    output = options.output or strip_extensions(options.filename) + '.csv'
+    convert_to_csv(options.filename, output)
+    print('Saved as {}'.format(output))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,12 @@
 #!/usr/bin/env python3
 
-from time import strftime, gmtime, sleep
-from datetime import datetime, timedelta
-from string import Template
-import time
-import math
-import os.path
-from os import path
-import pandas as pd
+import numpy as np
 import argparse
-import sys
 import matplotlib.pyplot as plt
 import copy
 from matplotlib.ticker import (MultipleLocator, FormatStrFormatter,
-                               AutoMinorLocator, FuncFormatter, NullFormatter)
-import matplotlib.font_manager
+                               FuncFormatter, NullFormatter)
+from recording import read_recording, add_cache_arguments, open_cache
 
 plt.rcParams["font.family"] = 'sans-serif'
 PX = 1/plt.rcParams['figure.dpi']
@@ -34,31 +26,221 @@ COLOUR_MEDIUM = 'xkcd:goldenrod'
 COLOUR_LOW = 'xkcd:kelly green'
 
 
-class DeltaTemplate(Template):
-    delimiter = "%"
+def seconds_since_start(times):
+    # Rebases epoch timestamps so the first measurement is at zero, in one
+    # vectorized subtraction rather than a datetime round trip per row.
+    times = np.asarray(times, dtype=float)
+    if len(times) == 0:
+        return times
+    return times - np.nanmin(times)
 
 
-def strfdelta(tdelta, fmt):
-    d = {"D": tdelta.days}
-    hours, rem = divmod(int(tdelta.total_seconds()), 3600)
+def format_duration(seconds, pos=None):
+    hours, rem = divmod(int(seconds), 3600)
     minutes, seconds = divmod(rem, 60)
-    d["H"] = '{:02d}'.format(hours)
-    d["M"] = '{:02d}'.format(minutes)
-    d["S"] = '{:02d}'.format(seconds)
-    t = DeltaTemplate(fmt)
-    return t.substitute(**d)
+    return '{:02d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+
+def set_duration_axis(ax, options):
+    # Major ticks only across the visible range, labelled hh:mm:ss. The label
+    # at zero is hidden.
+    ax.xaxis.set_major_formatter(FuncFormatter(format_duration))
+    ax.xaxis.set_minor_locator(MultipleLocator(options.duration_minor))
+    ax.set_xticks(np.arange(0, options.duration_max + 1, options.duration_major))
+    x_ticks = ax.xaxis.get_major_ticks()
+    x_ticks[0].label1.set_visible(False)
+
+
+def downsample(x, y, buckets, x_max):
+    # Keeps the first, last, lowest and highest point in each of `buckets`
+    # equal slices of [0, x_max] (one per pixel of width), which draws exactly
+    # the same line as the full data. Spikes, step-downs and the final point are
+    # all kept, and so are rows without a reading, which mark a gap in the
+    # recording. Points past x_max carry on in slices of the same size.
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if len(x) <= 4 * buckets or x_max <= 0:
+        return x, y
+    if np.any(np.diff(x) < 0):
+        order = np.argsort(x, kind='stable')
+        x = x[order]
+        y = y[order]
+    bucket = np.floor(x * (buckets / x_max)).astype(np.int64)
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    ends = np.r_[starts[1:], len(x)] - 1
+    valid = ~np.isnan(y)
+    by_min = np.lexsort((np.where(valid, y, np.inf), bucket))
+    by_max = np.lexsort((np.where(valid, y, -np.inf), bucket))
+    keep = np.unique(np.concatenate((starts, ends, by_min[starts], by_max[ends], np.flatnonzero(~valid))))
+    return x[keep], y[keep]
+
+
+def plot_points(options, x, y):
+    if options.no_downsample:
+        return x, y
+    return downsample(x, y, options.width, options.duration_max)
+
+
+def output_filename(options):
+    return options.output or options.graph_title.replace(' ', '-').lower()+'.png'
+
+
+def set_style():
+    plt.rc('font', size=SMALL_SIZE)          # controls default text sizes
+    plt.rc('axes', titlesize=SMALL_SIZE)     # fontsize of the axes title
+    plt.rc('axes', labelsize=MEDIUM_SIZE)    # fontsize of the x and y labels
+    plt.rc('xtick', labelsize=SMALL_SIZE)    # fontsize of the tick labels
+    plt.rc('ytick', labelsize=SMALL_SIZE)    # fontsize of the tick labels
+    plt.rc('legend', fontsize=SMALL_SIZE)    # legend fontsize
+    plt.rc('figure', titlesize=BIGGER_SIZE)  # fontsize of the figure title
+    plt.rcParams['axes.titlepad'] = TITLE_SIZE
+
+
+class RuntimeFigure:
+    # The styled skeleton of a runtime graph. The figure, axes, grid, spines,
+    # titles, watermark and lines are created once; render() swaps in the data,
+    # limits and text for a recording and only redoes the layout if something
+    # that changes the size of the axes labels has changed. A legend of one
+    # line per series, in order, is used when `multi` is set (as in
+    # multi_runtime_plot.py), otherwise the lumens and temperature legend.
+    # The figure is only managed by pyplot, so it can be shown in a window,
+    # when `pyplot` is set.
+    def __init__(self, width, height, series=1, temperature=False, multi=False, pyplot=False):
+        from matplotlib.figure import Figure
+        set_style()
+        self.multi = multi
+        if pyplot:
+            self.fig = fig = plt.figure(figsize=(width*PX, height*PX))
+        else:
+            self.fig = fig = Figure(figsize=(width*PX, height*PX))
+        self.ax = ax = fig.add_subplot()
+        self.title = fig.suptitle('\n', fontsize=TITLE_SIZE, x=0.01, ha='left')
+        self.subtitle = fig.text(0.011, 0.938, '', fontsize=SUBTITLE_SIZE, ha='left', alpha=0.8)
+        self.watermark = fig.text(0, 0, '', alpha=0.5, fontsize=TITLE_SIZE, ha='left')
+
+        ax.grid(True, which='both')
+        ax.minorticks_on()
+        ax.set_xlabel('Duration hh:mm:ss')
+        ax.yaxis.set_minor_formatter(NullFormatter())
+        self.lines = [ax.plot([], [])[0] for _ in range(series)]
+
+        self.twin = None
+        self.temperature = None
+        if temperature:
+            self.twin = twin = ax.twinx()
+            self.temperature, = twin.plot([], [], color=COLOUR_TEMP, label='Temperature (C)')
+            twin.set_ylabel('Temperature (C)')
+            twin.yaxis.set_major_locator(MultipleLocator(TEMP_STEP))
+            twin.yaxis.set_major_formatter(FormatStrFormatter('%d'))
+            twin.yaxis.set_minor_locator(MultipleLocator(1))
+            twin.yaxis.set_minor_formatter(NullFormatter())
+
+        # Hide borders and left tick lines
+        for axes in [ax, self.twin]:
+            if axes:
+                axes.spines['left'].set_visible(False)
+                axes.spines['top'].set_visible(False)
+                axes.tick_params(axis='y', which='major', left=False)
+
+        self.legend = None
+        self.legend_key = None
+        self.layout_key = None
+
+    def render(self, options, lines, temperature=None):
+        # `lines` is a list of (seconds, lumens, label, colour), one per
+        # series; `temperature` is (seconds, temperature) if there's a twin axis.
+        ax = self.ax
+        self.title.set_text(options.graph_title + '\n')
+        self.subtitle.set_text(options.graph_subtitle)
+        self.watermark.set_text(options.watermark)
+        self.watermark.set_position((options.watermark_x, options.watermark_y))
+
+        for line, (x, y, label, colour) in zip(self.lines, lines):
+            line.set_data(*plot_points(options, x, y))
+            line.set_color(colour)
+            line.set_label(label)
+        ax.set_ylabel(options.y_label)
+        ax.set_ylim((options.graph_lumens_min, options.graph_lumens_max))
+        ax.set_yticks(range(options.graph_lumens_min, options.graph_lumens_max + options.lumens_step, options.lumens_step))
+        ax.yaxis.set_minor_locator(MultipleLocator(options.lumens_step))
+        set_duration_axis(ax, options)
+        ax.set_xlim(0, options.duration_max)
+
+        if self.twin:
+            self.temperature.set_data(*plot_points(options, *temperature))
+            self.twin.set_ylim((options.graph_temp_min, options.graph_temp_max))
+
+        self.update_legend()
+
+        # The titles are always the same height, so the layout only depends
+        # on the axes labels and ticks.
+        layout_key = (options.y_label, options.graph_lumens_min, options.graph_lumens_max, options.lumens_step,
+                options.duration_max, options.duration_major, options.duration_minor)
+        if self.twin:
+            layout_key += (options.graph_temp_min, options.graph_temp_max)
+        if layout_key != self.layout_key:
+            self.fig.tight_layout(rect=[0, 0, 1, 0.99])
+            self.layout_key = layout_key
+
+    def update_legend(self):
+        lines = list(self.lines)
+        if self.temperature:
+            lines.append(self.temperature)
+        if not self.multi:
+            lines.reverse()
+        legend_key = [(line.get_label(), line.get_color()) for line in lines]
+        if legend_key == self.legend_key:
+            return
+        if self.legend:
+            self.legend.remove()
+
+        # legend line thickness
+        handles = [copy.copy(line) for line in lines]
+        [ha.set_linewidth(max(len(lines) - 1, 1) if self.multi else 3) for ha in handles]
+
+        if self.multi:
+            layout = {'ncol': 4444}
+        else:
+            layout = {'ncol': 2, 'mode': 'expand'}
+        self.legend = self.fig.legend(handles, [label for label, _ in legend_key],
+            loc='upper center',
+            frameon=False,
+            bbox_to_anchor=(0.5, 0.938),
+            borderaxespad=0,
+            bbox_transform=self.fig.transFigure,
+            handlelength=0.7,
+            **layout
+        )
+        self.legend_key = legend_key
+
+    def save(self, filename):
+        self.fig.savefig(filename)
+
+
+FIGURES = {}
+
+
+def runtime_figure(options, series=1, temperature=False, multi=False):
+    # One figure per layout is kept for the life of the process, so batch and
+    # live rendering only pay for building it once.
+    key = (options.width, options.height, series, temperature, multi)
+    if key not in FIGURES:
+        FIGURES[key] = RuntimeFigure(*key)
+    return FIGURES[key]
 
 
 def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-in','--inputfile', dest='filename', 
-            help = 'filename for the csv input')
+            help = 'filename for the csv or binary input')
     parser.add_argument('-lf', '--lux-to-lumen-factor', dest='lux_to_lumen_factor', type=float, 
             help = 'lux to lumen conversion factor for use in calibrated integrating enclosures')
     parser.add_argument('-ts', '--temp-sensor', dest='temp_sensor', choices=['mcp9600', 'mcp9808'],
             help = 'temp sensor')
     parser.add_argument('-g', '--graph-title', dest='graph_title',
             help = 'graph title')
+    parser.add_argument('-o', '--outputfile', dest='output',
+            help = 'filename for the png output (default: the graph title)')
     parser.add_argument('-gs', '--graph-subtitle', dest='graph_subtitle',
             help = 'graph subtitle')
     parser.add_argument('-yl', '--y-label', dest='y_label',
@@ -103,6 +285,9 @@ def build_parser():
     parser.add_argument('-wy', '--watermark-y', dest='watermark_y', type=float,
             default = 0.3,
             help = 'y location of watermark')
+    parser.add_argument('-nd', '--no-downsample', dest='no_downsample', action='store_true',
+            help = 'plot every recorded point instead of the lowest, highest, first and last in each pixel')
+    add_cache_arguments(parser)
     return parser
 
 
@@ -115,107 +300,21 @@ def load_options():
 def runtimeplot(options):
     
     print('Creating plot...')
-    data = pd.read_csv(options.filename)
-    
-    plt.rc('font', size=SMALL_SIZE)          # controls default text sizes
-    plt.rc('axes', titlesize=SMALL_SIZE)     # fontsize of the axes title
-    plt.rc('axes', labelsize=MEDIUM_SIZE)    # fontsize of the x and y labels
-    plt.rc('xtick', labelsize=SMALL_SIZE)    # fontsize of the tick labels
-    plt.rc('ytick', labelsize=SMALL_SIZE)    # fontsize of the tick labels
-    plt.rc('legend', fontsize=SMALL_SIZE)    # legend fontsize
-    plt.rc('figure', titlesize=BIGGER_SIZE)  # fontsize of the figure title
-
-    fig, ax = plt.subplots(figsize=(options.width*PX, options.height*PX))
-    plt.suptitle(options.graph_title + '\n', fontsize=TITLE_SIZE, x=0.01, ha='left')
-    plt.rcParams['axes.titlepad'] = TITLE_SIZE
-    #fig.text(0.01, 0.92, options.graph_subtitle, fontsize=SUBTITLE_SIZE, ha='left', alpha=0.8)
-    fig.text(0.011, 0.938, options.graph_subtitle, fontsize=SUBTITLE_SIZE, ha='left', alpha=0.8)
+    data = read_recording(options.filename, open_cache(options))
 
-    plt.grid(True, which='both')
-    ax.minorticks_on()
+    # Make Duration start at zero (use Time to calculate duration).
+    data.Time = seconds_since_start(data.Time)
 
+    lux_to_lumen_factor = options.lux_to_lumen_factor or data.attrs.get('lux_to_lumen_factor')
+    data.Lumens = data.Lux / lux_to_lumen_factor
+    lines = [(data.Time, data.Lumens, options.y_label, COLOUR_LUMENS)]
+    temperature = None
     if options.temp_sensor:
-        twin = ax.twinx()
+        temperature = (data.Time, data['Temperature (C)'])
 
-    # Make Duration start at zero (use Time to calculate duration).
-    # FIXME is this working? Chopped start off?
-    time_start = datetime.fromtimestamp(data.Time.min())
-    data.Time = data.Time.map(lambda x: (datetime.fromtimestamp(x) - time_start).total_seconds())
-
-    data.Lumens = data.Lux / options.lux_to_lumen_factor
-    ax.plot(data.Time, data.Lumens, color=COLOUR_LUMENS, label=options.y_label)
-    ax.set_xlabel('Duration hh:mm:ss')
-    ax.set_ylabel(options.y_label)
-    ax.set_ylim((options.graph_lumens_min, options.graph_lumens_max))
-    ax.set_yticks([x for x in range(options.graph_lumens_min, options.graph_lumens_max + options.lumens_step, options.lumens_step)])
-    ax.yaxis.set_minor_locator(MultipleLocator(options.lumens_step))
-    ax.yaxis.set_minor_formatter(NullFormatter())
-
-    formatter = FuncFormatter(lambda s, x: strfdelta(((time_start + pd.to_timedelta(s, unit='s')) - time_start), '%H:%M:%S'))
-    ax.xaxis.set_major_formatter(formatter)
-    ax.xaxis.set_minor_locator(MultipleLocator(options.duration_minor))
-    ax.set_xticks([x for x in range(0, (options.duration_max * 60) + 1, options.duration_major)])
-    x_ticks = ax.xaxis.get_major_ticks()
-    x_ticks[0].label1.set_visible(False)
-    x_ticks[-1].label1.set_visible(False)
-
-    if options.temp_sensor: 
-        twin.plot(
-            data.Time,
-            data['Temperature (C)'],
-            color=COLOUR_TEMP,
-            label='Temperature (C)'
-        )
-        twin.set_ylabel('Temperature (C)')
-        twin.set_ylim((options.graph_temp_min, options.graph_temp_max))
-        twin.yaxis.set_major_locator(MultipleLocator(2))
-        twin.yaxis.set_major_formatter(FormatStrFormatter('%d'))
-        twin.yaxis.set_minor_locator(MultipleLocator(1))
-        twin.yaxis.set_minor_formatter(NullFormatter())
-
-    fig.text(options.watermark_x, options.watermark_y, options.watermark, alpha=0.5, fontsize=TITLE_SIZE, ha='left')
-
-    plt.xlim(left=0)
-    plt.xlim(right=options.duration_max)
-
-    # Hide borders
-    ax.spines['left'].set_visible(False)
-#    ax.spines['right'].set_visible(False)
-    ax.spines['top'].set_visible(False)
-    if options.temp_sensor: 
-        twin.spines['left'].set_visible(False)
-#    twin.spines['right'].set_visible(False)
-        twin.spines['top'].set_visible(False)
-    # Hide left ticks lines
-    y_ticks = ax.yaxis.get_major_ticks()
-    [t.tick1line.set_visible(False) for t in y_ticks]
-    if options.temp_sensor: 
-        y_ticks = twin.yaxis.get_major_ticks()
-        [t.tick1line.set_visible(False) for t in y_ticks]
-
-
-    lines_labels = [ax.get_legend_handles_labels() for ax in fig.axes]
-    lines, labels = [reversed(sum(lol, [])) for lol in zip(*lines_labels)]
-
-    # legend line thickness
-    handles = [copy.copy(ha) for ha in lines]
-    [ha.set_linewidth(3) for ha in handles]
-
-    fig.legend(handles, labels,
-        ncol=2,
-        loc='upper center',
-        frameon=False,
-        mode='expand',
-#        bbox_to_anchor=(0.5, 0.92),
-        bbox_to_anchor=(0.5, 0.938),
-        borderaxespad=0,
-        bbox_transform=fig.transFigure,
-        handlelength=0.7
-    )
-
-    #plt.tight_layout()
-    plt.tight_layout(rect=[0, 0, 1, 0.99])
-    plt.savefig(options.graph_title.replace(' ', '-').lower()+'.png')
+    figure = runtime_figure(options, temperature=bool(options.temp_sensor))
+    figure.render(options, lines, temperature)
+    figure.save(output_filename(options))
     print('plot saved')
 
 
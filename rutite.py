@@ -1,74 +1,559 @@
 #!/usr/bin/env python3
 
-from time import strftime, gmtime, sleep
 import time
 import math
 import os.path
-from os import path
 import csv
-import board
-import busio
-import adafruit_tsl2591
-import adafruit_veml7700
-import adafruit_mcp9808
-import adafruit_mcp9600
-import RPi.GPIO as GPIO
 import argparse
+import copy
+import heapq
+import io
+import json
+import queue
+import signal
 import sys
-import matplotlib.pyplot as plt
+import threading
+import ranging
+import recording as recording_format
+import simulation
+import streaming
+import telemetry as telemetry_server
 
 ready_led = 17
 running_led = 27
 complete_led = 22
-sensor_ceiling = 88000.0
 light_sensor = None
 temp_sensor = None
+GPIO = None
 
+# Sensor drivers, keyed by the name used on the command line. Each entry's
+# setup function imports its Adafruit driver when it's called, so only the
+# sensors actually in use are ever imported. A light sensor's gains and
+# integration times, if it has them, are in LIGHT_RANGES (see ranging.py).
+LIGHT_SENSORS = {}
+LIGHT_RANGES = {}
+TEMP_SENSORS = {}
 
-def init(options):
-    i2c = busio.I2C(board.SCL, board.SDA)
-    if options.light_sensor:
-        if options.light_sensor == 'veml7700':
-            light_sensor = adafruit_veml7700.VEML7700(i2c)
-            light_sensor.light_gain = light_sensor.ALS_GAIN_1_8
-            light_sensor.light_integration_time = light_sensor.ALS_100MS
-            sensor_ceiling = 120000.0
-        elif options.light_sensor == 'tsl2591':
-            light_sensor = adafruit_tsl2591.TSL2591(i2c)
-            light_sensor.gain = adafruit_tsl2591.GAIN_LOW
-            #light_sensor.gain = adafruit_tsl2591.GAIN_HIGH
-    else:
-        light_sensor = adafruit_tsl2591.TSL2591(i2c)
-        light_sensor.gain = adafruit_tsl2591.GAIN_LOW
-        #light_sensor.gain = adafruit_tsl2591.GAIN_HIGH
 
-    if options.temp_sensor:
-        if options.temp_sensor == 'mcp9808':
-            temp_sensor = adafruit_mcp9808.MCP9808(i2c)
-        elif options.temp_sensor == 'mcp9600':
-            temp_sensor = adafruit_mcp9600.MCP9600(i2c)
-    else:
-        temp_sensor = None
+class RecordingWriter:
+    # Keeps the recording open for the whole test and batches rows in memory,
+    # so each sample costs a list append instead of an open/append/close.
+    # With compression, rows are compressed as they're written and a flush
+    # point is made every block_interval seconds, so a crash loses at most
+    # the last block.
+    mode = "a"
+
+    def __init__(self, filename, relative_time=False, lux_to_lumen_factor=None,
+            flush_rows=50, flush_interval=5.0, fsync='interval', fsync_interval=30.0,
+            compression=None, block_interval=60.0):
+        self.filename = filename
+        self.relative_time = relative_time
+        self.lux_to_lumen_factor = lux_to_lumen_factor
+        self.flush_rows = max(1, flush_rows)
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.rows = []
+        self.compressed = None
+        self.block_interval = block_interval
+        if compression:
+            self.compressed = recording_format.CompressedWriter(open(filename, 'ab'), compression)
+            self.file = self.compressed if 'b' in self.mode else io.TextIOWrapper(io.BufferedWriter(self.compressed))
+        else:
+            self.file = open(filename, self.mode)
+        self.last_flush = time.monotonic()
+        self.last_fsync = self.last_flush
+        self.last_block = self.last_flush
+
+    def write_header(self):
+        self.writerow(recording_format.CSV_HEADER)
+
+    def resume(self):
+        pass
+
+    def write_sample(self, t, lux, temp, t_test_start, interval=None, light_range=None, event=None):
+        if self.relative_time:
+            t_relative = t - t_test_start
+            duration = t_relative / 86400
+        else:
+            t_relative = ''
+            duration = ''
+
+        if self.lux_to_lumen_factor:
+            lumens = lux / self.lux_to_lumen_factor
+        else:
+            lumens = ''
+
+        if light_range:
+            gain, integration_time = '{:g}'.format(light_range.gain), light_range.integration_time
+        else:
+            gain, integration_time = '', ''
+
+        self.writerow([t, lux, t_relative, duration, lumens, temp, '' if interval is None else interval, gain, integration_time,
+                event or ''])
+
+    def writerow(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.flush_rows or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def write_rows(self, rows):
+        csv.writer(self.file, delimiter=",").writerows(rows)
+
+    def flush(self, block=False):
+        now = time.monotonic()
+        if self.rows:
+            self.write_rows(self.rows)
+            self.rows = []
+        self.file.flush()
+        self.last_flush = now
+        if self.compressed:
+            if not block and now - self.last_block < self.block_interval:
+                return # nothing more can be read back until the next flush point
+            self.compressed.block()
+            self.last_block = now
+        if self.fsync == 'flush' or (self.fsync == 'interval' and now - self.last_fsync >= self.fsync_interval):
+            os.fsync(self.file.fileno())
+            self.last_fsync = now
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush(block=True)
+        if self.fsync != 'never':
+            os.fsync(self.file.fileno())
+        self.file.close()
+
+
+class BinaryRecordingWriter(RecordingWriter):
+    # Writes the fixed-width binary log described in recording.py. The header
+    # holds the test start time, so it's written along with the first sample.
+    mode = "ab"
+
+    def __init__(self, filename, interval=None, light_sensor=None, temp_sensor=None, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.interval = interval
+        self.light_sensor = light_sensor
+        self.temp_sensor = temp_sensor
+        self.start_time = None
+        self.version = recording_format.BINARY_VERSION
+
+    def write_header(self):
+        pass
+
+    def resume(self):
+        # Records carry on from the start time in the existing header, in the
+        # layout of the version it was written with.
+        if os.path.getsize(self.filename):
+            header = recording_format.read_binary_header(self.filename)
+            self.start_time = header['start_time']
+            self.version = header['version']
+
+    def write_sample(self, t, lux, temp, t_test_start, interval=None, light_range=None, event=None):
+        if self.start_time is None:
+            self.start_time = t_test_start
+            self.file.write(recording_format.pack_header(t_test_start, self.interval or 0.0,
+                    self.lux_to_lumen_factor, self.light_sensor, self.temp_sensor, self.relative_time,
+                    light_range.integration_time if light_range else None))
+        self.writerow(recording_format.pack_record(t - self.start_time, lux, temp, interval,
+                light_range.gain if light_range else None, event, self.version))
+
+    def write_rows(self, rows):
+        self.file.write(b''.join(rows))
+
+
+class Scheduler:
+    # Paces the loop against absolute deadlines on the monotonic clock, so the
+    # time spent reading sensors and writing rows doesn't stretch the interval.
+    # Ticks that can't be met are counted and skipped rather than made up with
+    # a burst of back-to-back samples.
+    def __init__(self, stats=None):
+        self.stats = stats
+        if stats:
+            stats.schedulers.append(self)
+        self.next_deadline = None
+        self.ticks = 0
+        self.late_ticks = 0
+        self.missed_ticks = 0
+        self.max_lateness = 0.0
+
+    def reset(self):
+        self.next_deadline = time.monotonic()
+
+    def wait(self, interval):
+        remaining = self.advance(interval)
+        if remaining > 0:
+            time.sleep(remaining)
+            if self.stats:
+                self.stats.add('sleep_overshoot', max(0.0, time.monotonic() - self.next_deadline))
+
+    def advance(self, interval):
+        # Moves on to the next deadline and returns the time left until it,
+        # without sleeping.
+        now = time.monotonic()
+        if self.next_deadline is None:
+            self.next_deadline = now
+        self.next_deadline += interval
+        self.ticks += 1
+        remaining = self.next_deadline - now
+        if remaining > 0:
+            return remaining
+        lateness = -remaining
+        self.late_ticks += 1
+        self.max_lateness = max(self.max_lateness, lateness)
+        if interval > 0 and lateness >= interval:
+            missed = int(lateness // interval)
+            self.missed_ticks += missed
+            self.next_deadline += missed * interval
+        return 0.0
+
+    def summary(self):
+        return '{} ticks, {} late, {} missed, max lateness {:.1f} ms'.format(
+                self.ticks, self.late_ticks, self.missed_ticks, self.max_lateness * 1000)
+
+
+class Histogram:
+    # Fixed-size histogram of durations in power-of-two microsecond buckets.
+    # Adding a value is a couple of integer operations, so it can stay on for
+    # a whole test without growing.
+    BUCKETS = 40
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        bucket = int(seconds * 1000000).bit_length()
+        self.counts[min(bucket, self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        # Upper edge of the bucket the percentile falls in, capped at the max.
+        target = self.count * p / 100.0
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return min((1 << bucket) / 1000000.0, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class Instrumentation:
+    # Times each phase of the acquisition loop (sensor reads, writing, GPIO,
+    # printing and how far each wake-up overshoots its deadline) and writes the
+    # histograms to a sidecar file next to the recording every few seconds.
+    def __init__(self, filename, interval=60.0):
+        self.filename = filename
+        self.interval = interval
+        self.phases = {}
+        self.events = {}
+        self.schedulers = []
+        self.pipeline = None
+        self.next_write = time.monotonic() + interval
+
+    def add(self, phase, seconds):
+        histogram = self.phases.get(phase)
+        if histogram is None:
+            histogram = self.phases[phase] = Histogram()
+        histogram.add(seconds)
+
+    def event(self, name):
+        self.events[name] = self.events.get(name, 0) + 1
+
+    def timed(self, phase, function):
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(phase, time.perf_counter() - start)
+        return call
+
+    def summary(self):
+        events = dict(self.events)
+        for scheduler in self.schedulers:
+            events['late_ticks'] = events.get('late_ticks', 0) + scheduler.late_ticks
+            events['missed_deadlines'] = events.get('missed_deadlines', 0) + scheduler.missed_ticks
+        if self.pipeline:
+            events['dropped_samples'] = self.pipeline.dropped_samples
+            events['max_queue_depth'] = self.pipeline.max_queue_depth
+        return {
+            'updated': time.time(),
+            'phases': {phase: histogram.summary() for phase, histogram in self.phases.items()},
+            'events': events,
+        }
 
+    def maybe_write(self):
+        if time.monotonic() >= self.next_write:
+            self.write()
+
+    def write(self):
+        self.next_write = time.monotonic() + self.interval
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w') as f:
+            json.dump(self.summary(), f, indent=1)
+        os.replace(temp_filename, self.filename)
+
+    def print_summary(self):
+        summary = self.summary()
+        print('\tPhase timings (ms):      count     p50     p99     max')
+        for phase, stats in sorted(summary['phases'].items()):
+            print('\t  {:20} {:9d} {:7.2f} {:7.2f} {:7.2f}'.format(
+                    phase, stats['count'], stats['p50'] * 1000, stats['p99'] * 1000, stats['max'] * 1000))
+        print('\tEvents: {}'.format(', '.join('{} {}'.format(name, count) for name, count in sorted(summary['events'].items())) or 'none'))
+
+
+class Checkpoint:
+    # The state machine, saved next to the recording whenever the state
+    # changes and every `interval` seconds in between, so --resume can carry
+    # on with a test after a reboot or a dropped ssh session. It's written to
+    # a temporary file that replaces the old one, so a crash part way through
+    # leaves the previous checkpoint rather than half of this one.
+    def __init__(self, filename, interval=30.0, fsync=True):
+        self.filename = filename
+        self.interval = interval
+        self.fsync = fsync
+        self.next_write = time.monotonic() + interval
+
+    def maybe_write(self, test, state_changed=False):
+        if state_changed or time.monotonic() >= self.next_write:
+            self.write(test)
+
+    def remove(self):
+        try:
+            os.remove(self.filename)
+        except FileNotFoundError:
+            pass
+
+    def write(self, test):
+        self.next_write = time.monotonic() + self.interval
+        checkpoint = {
+            'updated': time.time(),
+            'options': vars(test.options),
+            'test': test.checkpoint_state(),
+        }
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w') as f:
+            json.dump(checkpoint, f, indent=1)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temp_filename, self.filename)
+
+
+def checkpoint_filename(filename):
+    return filename + '.state.json'
+
+
+def load_checkpoint(filename):
+    with open(checkpoint_filename(filename)) as f:
+        return json.load(f)
+
+
+def state_interval(options, state):
+    if state in ['set_baseline', 'waiting_for_threshold']:
+        return options.baseline_interval
+    if state == 'sampling_period':
+        return options.sampling_interval
+    return options.delay
+
+
+def open_recording(options):
+    kwargs = dict(relative_time=options.relative_time,
+            lux_to_lumen_factor=options.lux_to_lumen_factor,
+            flush_rows=options.flush_rows,
+            flush_interval=options.flush_interval,
+            fsync=options.fsync,
+            fsync_interval=options.fsync_interval,
+            compression=options.compression,
+            block_interval=options.compress_block)
+    if options.output_format == 'binary':
+        return BinaryRecordingWriter(options.filename,
+                interval=options.delay,
+                light_sensor=options.light_sensor,
+                temp_sensor=options.temp_sensor,
+                **kwargs)
+    return RecordingWriter(options.filename, **kwargs)
+
+
+def register_light_sensor(name, ceiling):
+    def register(setup):
+        LIGHT_SENSORS[name] = (setup, ceiling)
+        return setup
+    return register
+
+
+def register_light_range(name, gains, integration_times, default):
+    # Registers the function that sets the gain and integration time of an
+    # already registered light sensor.
+    def register(set_range):
+        LIGHT_RANGES[name] = ranging.LightRanges(LIGHT_SENSORS[name][1], gains, integration_times, default, set_range)
+        return set_range
+    return register
+
+
+def register_temp_sensor(name):
+    def register(setup):
+        TEMP_SENSORS[name] = setup
+        return setup
+    return register
+
+
+@register_light_sensor('tsl2591', 88000.0)
+def setup_tsl2591(i2c):
+    import adafruit_tsl2591
+    return adafruit_tsl2591.TSL2591(i2c)
+
+
+@register_light_range('tsl2591', [1.0, 25.0, 428.0, 9876.0], [100, 200, 300, 400, 500, 600], (1.0, 100))
+def set_tsl2591_range(light_sensor, light_range):
+    import adafruit_tsl2591
+    light_sensor.gain = {
+        1.0: adafruit_tsl2591.GAIN_LOW,
+        25.0: adafruit_tsl2591.GAIN_MED,
+        428.0: adafruit_tsl2591.GAIN_HIGH,
+        9876.0: adafruit_tsl2591.GAIN_MAX,
+    }[light_range.gain]
+    light_sensor.integration_time = getattr(adafruit_tsl2591, 'INTEGRATIONTIME_{}MS'.format(light_range.integration_time))
+
+
+@register_light_sensor('veml7700', 120000.0)
+def setup_veml7700(i2c):
+    import adafruit_veml7700
+    return adafruit_veml7700.VEML7700(i2c)
+
+
+@register_light_range('veml7700', [0.125, 0.25, 1.0, 2.0], [25, 50, 100, 200, 400, 800], (0.125, 100))
+def set_veml7700_range(light_sensor, light_range):
+    light_sensor.light_gain = {
+        0.125: light_sensor.ALS_GAIN_1_8,
+        0.25: light_sensor.ALS_GAIN_1_4,
+        1.0: light_sensor.ALS_GAIN_1,
+        2.0: light_sensor.ALS_GAIN_2,
+    }[light_range.gain]
+    light_sensor.light_integration_time = getattr(light_sensor, 'ALS_{}MS'.format(light_range.integration_time))
+
+
+@register_temp_sensor('mcp9808')
+def setup_mcp9808(i2c):
+    import adafruit_mcp9808
+    return adafruit_mcp9808.MCP9808(i2c)
+
+
+@register_temp_sensor('mcp9600')
+def setup_mcp9600(i2c):
+    import adafruit_mcp9600
+    return adafruit_mcp9600.MCP9600(i2c)
+
+
+def init_gpio(options, t_resume=None):
+    # The GPIO and clock are shared by every station in the process. A
+    # resumed simulation's clock carries on from t_resume.
+    global GPIO, time
+    if options.hardware == 'simulated':
+        time = simulation.SimulatedClock(options.sim_speed, t_resume)
+        GPIO = simulation.SimulatedGPIO()
+    else:
+        import RPi.GPIO
+        GPIO = RPi.GPIO
     GPIO.setwarnings(False)
     GPIO.setmode(GPIO.BCM)
-    GPIO.setup(ready_led, GPIO.OUT)
-    GPIO.setup(running_led, GPIO.OUT)
-    GPIO.setup(complete_led, GPIO.OUT)
-    GPIO.output(ready_led, GPIO.HIGH)
-    GPIO.output(running_led, GPIO.LOW)
-    GPIO.output(complete_led, GPIO.LOW)
+
+
+def open_i2c(options, buses):
+    # The bus, or multiplexer channel, a station's sensors are on. Each bus
+    # and multiplexer is only opened once, however many stations use it.
+    if options.i2c_bus not in buses:
+        if options.i2c_bus is None:
+            import board
+            import busio
+            buses[None] = busio.I2C(board.SCL, board.SDA)
+        else:
+            from adafruit_extended_bus import ExtendedI2C
+            buses[options.i2c_bus] = ExtendedI2C(options.i2c_bus)
+    i2c = buses[options.i2c_bus]
+    if options.mux_channel is None:
+        return i2c
+    mux = (options.i2c_bus, options.mux_address)
+    if mux not in buses:
+        import adafruit_tca9548a
+        buses[mux] = adafruit_tca9548a.TCA9548A(i2c, address=options.mux_address)
+    return buses[mux][options.mux_channel]
+
+
+def setup_sensors(options, buses):
+    setup_light_sensor, ceiling = LIGHT_SENSORS[options.light_sensor]
+    ranges = LIGHT_RANGES.get(options.light_sensor)
+    if options.hardware == 'simulated':
+        light_sensor, temp_sensor = simulation.create_sensors(options, ceiling, time)
+        set_range = simulation.SimulatedLightSensor.set_range
+    else:
+        i2c = open_i2c(options, buses)
+        light_sensor = setup_light_sensor(i2c)
+        if options.temp_sensor:
+            temp_sensor = TEMP_SENSORS[options.temp_sensor](i2c)
+        else:
+            temp_sensor = None
+        set_range = ranges and ranges.set_range
+    if ranges:
+        light_sensor = ranging.RangedLightSensor(light_sensor, ranges, set_range,
+                options.gain, options.integration_time, options.auto_range, time)
+    return light_sensor, temp_sensor
+
+
+def setup_leds(options):
+    for pin in [options.ready_led, options.running_led, options.complete_led]:
+        if pin is not None:
+            GPIO.setup(pin, GPIO.OUT)
+    set_led(options.ready_led, GPIO.HIGH)
+    set_led(options.running_led, GPIO.LOW)
+    set_led(options.complete_led, GPIO.LOW)
+
+
+def init(options, t_resume=None):
+    init_gpio(options, t_resume)
+    light_sensor, temp_sensor = setup_sensors(options, {})
+    setup_leds(options)
     return light_sensor, temp_sensor
 
 
 def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-o','--outputfile', dest='filename', 
-            default=time.strftime('RuTiTe%Y-%m-%d-%H.%M.%S.csv', time.localtime()),
-            help = 'filename for the csv output')
+            help = 'filename for the output (default: a timestamp)')
+    parser.add_argument('-of','--output-format', dest='output_format', choices=['csv', 'binary'],
+            default = 'csv',
+            help = 'csv, or a compact binary log that the plotting scripts can read directly and recording.py can convert to csv')
     parser.add_argument('-i','--interval', dest='delay', type=float, 
             default = 0.1, 
-            help = 'interval between measurements in seconds (halved during the 30s sampling period at the beginning of the test)')
+            help = 'interval between measurements in seconds during the main recording')
+    parser.add_argument('-bi','--baseline-interval', dest='baseline_interval', type=float,
+            help = 'interval between measurements in seconds while setting the baseline and waiting for the light (default: the smaller of -i and 0.5)')
+    parser.add_argument('-si','--sampling-interval', dest='sampling_interval', type=float,
+            help = 'interval between measurements in seconds during the 30s sampling period (default: the smaller of -i and 0.5)')
+    parser.add_argument('-ad','--adaptive', dest='adaptive', action='store_true',
+            help = 'during the main recording, measure at --min-interval while the output is changing and slow down towards --max-interval while it is steady')
+    parser.add_argument('-imin','--min-interval', dest='min_interval', type=float,
+            help = 'fastest interval in seconds in adaptive mode (default: -i)')
+    parser.add_argument('-imax','--max-interval', dest='max_interval', type=float,
+            help = 'slowest interval in seconds in adaptive mode (default: the larger of -i and 5)')
+    parser.add_argument('-ac','--adaptive-change', dest='adaptive_change', type=float,
+            default = 0.5,
+            help = 'change in output between measurements, in percent of the output at 30s, that switches adaptive mode back to --min-interval')
     parser.add_argument('-d','--duration', dest='test_duration', type=float, 
             help = 'maximum duration of the test in minutes')
     parser.add_argument('-tp','--termination-percentage', dest='termination_percentage', type=float, 
@@ -84,169 +569,716 @@ def build_parser():
             help = 'record relative time, with the first measurement at t=0', action='store_true')
     parser.add_argument('-g', '--graph-title', dest='graph_title',
             help = 'string to use for a basic plot of the recorded data - only works if you let the script run until it stops based on time or percent output')
-    parser.add_argument('-ls', '--light-sensor', dest='light_sensor', choices=['tsl2591', 'veml7700'],
+    parser.add_argument('-ls', '--light-sensor', dest='light_sensor', choices=sorted(LIGHT_SENSORS),
+            default = 'tsl2591',
             help = 'light sensor')
-    parser.add_argument('-ts', '--temp-sensor', dest='temp_sensor', choices=['mcp9600', 'mcp9808'],
+    parser.add_argument('-ts', '--temp-sensor', dest='temp_sensor', choices=sorted(TEMP_SENSORS),
             help = 'temp sensor')
+    ranging.add_arguments(parser)
+    parser.add_argument('-ti', '--temp-interval', dest='temp_interval', type=float,
+            help = 'seconds between temperature measurements; measurements in between record the last temperature read (default: every measurement)')
+    parser.add_argument('-ib', '--i2c-bus', dest='i2c_bus', type=int,
+            help = 'number of the I2C bus the sensors are on, for buses other than the default (needs adafruit-circuitpython-extended-bus)')
+    parser.add_argument('-mc', '--mux-channel', dest='mux_channel', type=int,
+            help = 'channel of a TCA9548A I2C multiplexer the sensors are on')
+    parser.add_argument('-ma', '--mux-address', dest='mux_address', type=lambda x: int(x, 0),
+            default = 0x70,
+            help = 'I2C address of the multiplexer')
+    parser.add_argument('--ready-led', dest='ready_led', type=int,
+            default = ready_led,
+            help = 'GPIO pin of the ready LED')
+    parser.add_argument('--running-led', dest='running_led', type=int,
+            default = running_led,
+            help = 'GPIO pin of the running LED')
+    parser.add_argument('--complete-led', dest='complete_led', type=int,
+            default = complete_led,
+            help = 'GPIO pin of the complete LED')
+    parser.add_argument('-sc', '--stations', dest='stations',
+            help = 'json file describing several stations to run at once, each with its own sensors, LEDs, options and output file')
+    parser.add_argument('-fr', '--flush-rows', dest='flush_rows', type=int,
+            default = 50,
+            help = 'number of buffered rows that triggers a write to the output file')
+    parser.add_argument('-fi', '--flush-interval', dest='flush_interval', type=float,
+            default = 5.0,
+            help = 'maximum seconds buffered rows are held before being written to the output file')
+    parser.add_argument('-fs', '--fsync', dest='fsync', choices=['never', 'interval', 'flush'],
+            default = 'interval',
+            help = 'when to force written rows onto the SD card: never, every --fsync-interval seconds, or on every flush')
+    parser.add_argument('-fsi', '--fsync-interval', dest='fsync_interval', type=float,
+            default = 30.0,
+            help = 'seconds between forced syncs when --fsync is interval')
+    parser.add_argument('-z', '--compress', dest='compression', choices=['gzip', 'lzma', 'bz2'],
+            help = 'write the recording compressed; the plotting scripts read it as it is')
+    parser.add_argument('-zb', '--compress-block', dest='compress_block', type=float,
+            default = 60.0,
+            help = 'seconds between flush points in a compressed recording, which is the most a crash can lose')
+    parser.add_argument('-th', '--threaded', dest='threaded',
+            help = 'read the sensors on a dedicated thread, so writing, printing and LEDs never delay the next measurement', action='store_true')
+    parser.add_argument('-qd', '--queue-depth', dest='queue_depth', type=int,
+            default = 1000,
+            help = 'number of measurements that can wait to be written in threaded mode before new ones are dropped')
+    parser.add_argument('-st', '--stats', dest='stats',
+            help = 'time each part of every measurement and save the timings next to the output file', action='store_true')
+    parser.add_argument('-sti', '--stats-interval', dest='stats_interval', type=float,
+            default = 60.0,
+            help = 'seconds between updates to the timings file')
+    parser.add_argument('-cpi', '--checkpoint-interval', dest='checkpoint_interval', type=float,
+            default = 30.0,
+            help = 'seconds between saves of the test\'s progress next to the output file, for --resume (0 for none)')
+    parser.add_argument('-re', '--resume', dest='resume',
+            help = 'carry on with the test recording to this file after a reboot or crash, with the options it was started with')
+    parser.add_argument('-lp', '--live-plot', dest='live_plot', type=float,
+            help = 'keep a graph of the recording up to date while the test runs, refreshed every LIVE_PLOT seconds by live_runtime_plot.py in a lower priority process')
+    parser.add_argument('-cat', '--catalogue', dest='catalogue',
+            help = 'add the recording to this catalogue file when the test completes (see catalogue.py)')
+    streaming.add_arguments(parser)
+    telemetry_server.add_arguments(parser)
+    simulation.add_arguments(parser)
     return parser
 
 
-def load_options():
+def load_options(args=None):
     parser = build_parser()
-    options = parser.parse_args()
+    options = parser.parse_args(args)
+    if options.resume:
+        return resume_options(options, parser)
+    if options.stations:
+        if options.threaded:
+            parser.error('--threaded can\'t be used with --stations')
+        return options
+    return prepare_options(options)
+
+
+def resume_options(options, parser):
+    # A resumed test carries on with the options saved in its checkpoint.
+    # Only the name of the recording comes from the command line.
+    try:
+        checkpoint = load_checkpoint(options.resume)
+    except FileNotFoundError:
+        parser.error('{} has no checkpoint ({})'.format(options.resume, checkpoint_filename(options.resume)))
+    if checkpoint['test']['state'] == 'exit':
+        parser.error('the test recorded in {} has already finished'.format(options.resume))
+    resumed = copy.copy(options)
+    vars(resumed).update(checkpoint['options'])
+    resumed.filename = options.resume
+    resumed.resume = options.resume
+    resumed.stations = None
+    print ("{}Resuming the test recorded in {}".format(current_timestamp(), resumed.filename))
+    return resumed
+
+
+def prepare_options(options, name=None):
     if options.time_between_prints:
         options.time_between_prints *= 60
     if options.test_duration:
         options.test_duration *= 60
+    if options.baseline_interval is None:
+        options.baseline_interval = min(options.delay, 0.5)
+    if options.sampling_interval is None:
+        options.sampling_interval = min(options.delay, 0.5)
+    if options.min_interval is None:
+        options.min_interval = options.delay
+    if options.max_interval is None:
+        options.max_interval = max(options.delay, 5.0)
+    if options.adaptive and options.min_interval > options.max_interval:
+        raise ValueError('--min-interval can\'t be longer than --max-interval')
+    if options.light_sensor in LIGHT_RANGES:
+        ranging.prepare_options(options, LIGHT_RANGES[options.light_sensor], name)
+    elif options.gain or options.integration_time or options.auto_range or options.fast:
+        raise ValueError('the {} doesn\'t have a gain or integration time to set'.format(options.light_sensor))
+    extension = recording_format.BINARY_EXTENSION if options.output_format == 'binary' else '.csv'
+    if options.compression:
+        extension += recording_format.COMPRESSION_EXTENSIONS[options.compression]
+    suffix = '-' + name if name else ''
+    if not options.filename:
+        options.filename = time.strftime('RuTiTe%Y-%m-%d-%H.%M.%S', time.localtime()) + suffix + extension
     if os.path.isfile(options.filename):
         print ("{}{} already exists. Checking for an an available name to avoid overwriting something important...".format(current_timestamp(), options.filename))
-        options.filename = time.strftime('RuTiTe%Y-%m-%d-%H.%M.%S.csv', time.localtime())
-    print ("{}Saving as {}".format(current_timestamp(),options.filename))
+        options.filename = time.strftime('RuTiTe%Y-%m-%d-%H.%M.%S', time.localtime()) + suffix + extension
+    print ("{}Saving {}as {}".format(current_timestamp(), name + ' ' if name else '', options.filename))
     return options
 
 
+def load_stations(options):
+    # Each station starts from the command line options, and its entry in the
+    # stations file overrides any of them by long name (e.g. "light_sensor",
+    # "mux_channel", "outputfile", "termination_percentage"). LEDs are only used
+    # for the stations that give their pins, and output files are named after
+    # the station unless given.
+    with open(options.stations) as f:
+        config = json.load(f)
+    entries = config['stations'] if isinstance(config, dict) else config
+    names = {'name': 'name'}
+    for action in build_parser()._actions:
+        names[action.dest] = action.dest
+        for option in action.option_strings:
+            if option.startswith('--'):
+                names[option[2:].replace('-', '_')] = action.dest
+    stations = []
+    for i, entry in enumerate(entries):
+        station = copy.copy(options)
+        station.name = 'station{}'.format(i + 1)
+        station.filename = None
+        station.ready_led = station.running_led = station.complete_led = None
+        for key, value in entry.items():
+            dest = names.get(key.replace('-', '_'))
+            if dest in (None, 'help', 'stations'):
+                raise ValueError('unknown setting {} for station {} in {}'.format(key, i + 1, options.stations))
+            setattr(station, dest, value)
+        if station.light_sensor not in LIGHT_SENSORS:
+            raise ValueError('unknown light sensor {} for {}'.format(station.light_sensor, station.name))
+        if station.temp_sensor and station.temp_sensor not in TEMP_SENSORS:
+            raise ValueError('unknown temp sensor {} for {}'.format(station.temp_sensor, station.name))
+        stations.append(prepare_options(station, station.name))
+    filenames = [station.filename for station in stations]
+    if len(set(filenames)) != len(filenames):
+        raise ValueError('each station needs its own output file')
+    return stations
+
+
 def blink_led(pin):
-    GPIO.output(pin, not GPIO.input(pin))
+    if pin is not None:
+        GPIO.output(pin, not GPIO.input(pin))
+
+
+def set_led(pin, value):
+    if pin is not None:
+        GPIO.output(pin, value)
 
 
 def current_timestamp():
     return time.strftime("%H:%M:%S ", time.localtime())
 
 
-def add_csv_header(filename):
-    with open (filename, "a") as f:
-        writer = csv.writer(f, delimiter=",")
-        writer.writerow(["Time", "Lux", "[relative time]", "Duration", "Lumens", "Temperature (C)"])
-        blink_led(running_led)
+def add_header(recording, led=running_led):
+    recording.write_header()
+    recording.flush()
+    blink_led(led)
 
 
-def write_to_csv(options, t, lux, temp, t_test_start):
-    if options.relative_time:
-        t_relative = t - t_test_start
-        duration = t_relative / 86400
-    else:
-        t_relative = ''
-        duration = ''
+class RuntimeTest:
+    # The test's state machine. Takes one timestamped sample at a time and
+    # handles everything that follows from it: recording, LEDs and printed
+    # updates. It never touches the sensors, so it can run on its own thread.
+    # Every sample and change of state is also published to the telemetry
+    # clients, if there are any. Everything a test needs to know about its
+    # station (LEDs, sensor, name) comes from its options, so several can run
+    # side by side.
 
-    if options.lux_to_lumen_factor:
-        lumens = lux / options.lux_to_lumen_factor
-    else:
-        lumens = ''
+    # Everything the state machine has worked out so far, which is saved in
+    # each checkpoint and restored by --resume.
+    CHECKPOINT_FIELDS = ['state', 'baseline_sum', 'baseline_measurement_count', 'threshold_lux',
+            't_test_start', 't_sampling_complete', 't_test_complete', 'sampling_lux_min', 'sampling_lux_max',
+            'lux_at_30s', 'last_lux', 'last_print_time', 'last_printed_percent', 'percent_output',
+            't_output_termination', 'ceiling_reached', 'adaptive_interval']
 
-    with open (options.filename, "a") as f:
-        writer = csv.writer(f, delimiter=",")
-        writer.writerow([t, lux, t_relative, duration, lumens, temp])
+    def __init__(self, options, recording, stats=None, telemetry=None, name=None, checkpoint=None):
+        self.options = options
+        self.recording = recording
+        self.stats = stats
+        self.telemetry = telemetry
+        self.name = name
+        self.checkpoint = checkpoint
+        self.sensor_ceiling = LIGHT_SENSORS[options.light_sensor][1]
+        self.ready_led = options.ready_led
+        self.running_led = options.running_led
+        self.complete_led = options.complete_led
+        self.output = station_print(name) if name else print
+        self.print = self.output
+        self.blink_led = blink_led
+        self.write_sample = recording.write_sample
+        if stats:
+            self.print = stats.timed('print', self.output)
+            self.blink_led = stats.timed('gpio', blink_led)
+            self.write_sample = stats.timed('write', recording.write_sample)
+        self.state = 'set_baseline'
+        self.baseline_sum = 0.0
+        self.baseline_measurement_count = 0
+        self.ceiling_reached = False
+        self.percent_output = None
+        self.adaptive_interval = options.min_interval
+        self.light_range = None
+        # The moving average and event detector (see streaming.py) only run
+        # during the main recording.
+        self.smoothing = None
+        if options.events or options.termination_smoothed:
+            self.smoothing = streaming.Ema(options.smoothing)
+        self.smoothed = None
+        self.detector = None
 
+    def checkpoint_state(self):
+        state = {name: getattr(self, name) for name in self.CHECKPOINT_FIELDS if hasattr(self, name)}
+        if self.smoothing:
+            state['smoothing'] = self.smoothing.state()
+        if self.detector:
+            state['detector'] = self.detector.state()
+        return state
 
-def core(options, light_sensor, temp_sensor):
-    state = 'set_baseline'
-    baseline_sum = 0.0
-    baseline_measurement_count = 0
-    ceiling_reached = False
+    def resume(self, state, t):
+        # Picks up where the checkpoint left off. If the test had started,
+        # a row without a reading marks the gap in the recording.
+        state = dict(state)
+        smoothing = state.pop('smoothing', None)
+        detector = state.pop('detector', None)
+        for name, value in state.items():
+            setattr(self, name, value)
+        if self.smoothing and smoothing:
+            self.smoothing.restore(smoothing)
+            self.smoothed = self.smoothing.value
+        if self.options.events and detector:
+            self.detector = streaming.create_detector(self.options, self.lux_at_30s)
+            self.detector.restore(detector)
+        self.event('resumed', t, state=self.state)
+        self.print('{}Resuming the test ({}).'.format(current_timestamp(), self.state.replace('_', ' ')))
+        if self.state in ['sampling_period', 'main_recording', 'checking_termination']:
+            self.write_sample(t, math.nan, None, self.t_test_start)
+        if self.state in ['main_recording', 'checking_termination']:
+            self.print('\tStarted {:.0f} minutes ago. The output at 30s was {:.1f} lux.'.format(
+                    (t - self.t_test_start) / 60, self.lux_at_30s))
 
-    while state != 'exit':
-        lux = light_sensor.lux
-        t = time.time()
-        temp = None
-        if temp_sensor:
-            temp = temp_sensor.temperature
-
-        if lux == sensor_ceiling and ceiling_reached == False:
-            print("{}Sensor is saturated. The light is too bright to measure with your current setup. Consider adding a filter between the source and the sensor. The test will continue, but will be cut off at the high end.".format(current_timestamp()))
-            ceiling_reached = True
-
-        if state == 'set_baseline':
-            baseline_measurement_count += 1
-            baseline_sum += lux
-
-        if state == 'waiting_for_threshold':
-            blink_led(ready_led)
-
-        if state in ['sampling_period', 'main_recording']:
-            write_to_csv(options, t, lux, temp, t_test_start)
-            blink_led(running_led)
-
-        if state == 'sampling_period':
-            if lux < sampling_lux_min:
-                sampling_lux_min = lux
-            if lux > sampling_lux_max:
-                sampling_lux_max = lux
-
-        if state == 'main_recording':
-            percent_output = lux / lux_at_30s * 100.0
-
-            if options.time_between_prints and (t - last_print_time) > options.time_between_prints:
-                print("{}Output is at {:.0f}% ({:.0f} lux)".format(current_timestamp(),percent_output, lux))
-                last_print_time = t
-                last_printed_percent = percent_output
-            elif options.percent_change_to_print and abs(percent_output - last_printed_percent) >= options.percent_change_to_print:
-                print("{}Output is at {:.0f}% ({:.0f} lux)".format(current_timestamp(),percent_output, lux))
-                last_print_time = t
-                last_printed_percent = percent_output
-
-        if state in ['set_baseline', 'waiting_for_threshold', 'sampling_period'] and options.delay > 0.5:
-            time.sleep(0.5)
+    def event(self, name, t, **fields):
+        if self.telemetry:
+            self.telemetry.event(name, t, station=self.name, **fields)
+
+    def termination_percent(self):
+        if self.options.termination_smoothed and self.smoothed is not None:
+            return self.smoothed / self.lux_at_30s * 100.0
+        return self.percent_output
+
+    def report(self, event):
+        # An event from the detector, to the console and telemetry clients.
+        name = event['event']
+        fields = {key: value for key, value in event.items() if key not in ('event', 't')}
+        self.event(name, event['t'], **fields)
+        seconds = event['t'] - self.t_test_start
+        if name == 'regulation_start':
+            self.print('{}Regulating at {:.1f} lux (sd {:.1f}) since {:.0f}s into the test'.format(
+                    current_timestamp(), event['level'], event['std'], seconds))
+        else:
+            self.print('{}Step {} from {:.1f} to {:.1f} lux at {:.0f}s into the test'.format(
+                    current_timestamp(), 'down' if name == 'step_down' else 'up', event['from'], event['to'], seconds))
+
+    def next_interval(self):
+        if self.options.adaptive and self.state in ['main_recording', 'checking_termination']:
+            return self.adaptive_interval
+        return state_interval(self.options, self.state)
+
+    def adapt(self, lux):
+        # Straight back to the fastest rate when the output moves, then
+        # doubling the interval with every steady measurement.
+        change = abs(lux - self.last_lux) / self.lux_at_30s * 100.0
+        if change >= self.options.adaptive_change:
+            self.adaptive_interval = self.options.min_interval
         else:
-            time.sleep(options.delay)
-
-        if state == 'set_baseline' and baseline_measurement_count >= 5:
-            threshold_lux = baseline_sum / baseline_measurement_count * 3.0
-            state = 'waiting_for_threshold'
-            print ("{}Ready to start the test. Turn on the light now.".format(current_timestamp()))
-
-        if state == 'waiting_for_threshold' and lux >= threshold_lux:
-            state = 'sampling_period'
-            GPIO.output(ready_led, GPIO.HIGH)
-            t_test_start = time.time()
-            t_sampling_complete = t_test_start + 30.0
+            self.adaptive_interval = min(self.adaptive_interval * 2, self.options.max_interval)
+
+    def process(self, t, lux, temp, light_range=None, interval=None):
+        # `light_range` is the gain and integration time the light sensor
+        # measured at (see ranging.py) and `interval` the interval this
+        # measurement was scheduled at, both of which are recorded with it.
+        options = self.options
+        previous_state = self.state
+
+        if light_range and self.light_range and light_range[:2] != self.light_range[:2]:
+            if self.stats:
+                self.stats.event('range_changed')
+            self.event('range_changed', t, lux=lux, gain=light_range.gain, integration_time=light_range.integration_time,
+                    previous_gain=self.light_range.gain)
+            self.print('{}Light sensor gain switched from {:g}x to {:g}x at {:.1f} lux'.format(
+                    current_timestamp(), self.light_range.gain, light_range.gain, lux))
+        self.light_range = light_range
+        saturated = lux >= (light_range.ceiling if light_range else self.sensor_ceiling)
+
+        if saturated and self.stats:
+            self.stats.event('sensor_saturated')
+        if saturated and self.ceiling_reached == False:
+            self.event('sensor_saturated', t, lux=lux)
+            self.print("{}Sensor is saturated. The light is too bright to measure with your current setup. Consider adding a filter between the source and the sensor. The test will continue, but will be cut off at the high end.".format(current_timestamp()))
+            self.ceiling_reached = True
+
+        if self.state == 'set_baseline':
+            self.baseline_measurement_count += 1
+            self.baseline_sum += lux
+
+        if self.state == 'waiting_for_threshold':
+            self.blink_led(self.ready_led)
+
+        event = None
+        if self.state in ['main_recording', 'checking_termination']:
+            if self.smoothing:
+                self.smoothed = self.smoothing.add(t, lux)
+            if self.detector:
+                event = self.detector.add(t, lux, self.smoothed)
+
+        if self.state in ['sampling_period', 'main_recording']:
+            self.write_sample(t, lux, temp, self.t_test_start, interval, light_range, event and event['event'])
+            self.blink_led(self.running_led)
+
+        if event:
+            self.report(event)
+
+        if self.state == 'sampling_period':
+            if lux < self.sampling_lux_min:
+                self.sampling_lux_min = lux
+            if lux > self.sampling_lux_max:
+                self.sampling_lux_max = lux
+
+        if self.state in ['main_recording', 'checking_termination'] and options.adaptive:
+            self.adapt(lux)
+
+        if self.state == 'main_recording':
+            self.percent_output = lux / self.lux_at_30s * 100.0
+
+            if options.time_between_prints and (t - self.last_print_time) > options.time_between_prints:
+                self.event('output', t, percent_output=self.percent_output, lux=lux)
+                self.print("{}Output is at {:.0f}% ({:.0f} lux)".format(current_timestamp(), self.percent_output, lux))
+                self.last_print_time = t
+                self.last_printed_percent = self.percent_output
+            elif options.percent_change_to_print and abs(self.percent_output - self.last_printed_percent) >= options.percent_change_to_print:
+                self.event('output', t, percent_output=self.percent_output, lux=lux)
+                self.print("{}Output is at {:.0f}% ({:.0f} lux)".format(current_timestamp(), self.percent_output, lux))
+                self.last_print_time = t
+                self.last_printed_percent = self.percent_output
+
+        if self.state == 'set_baseline' and self.baseline_measurement_count >= 5:
+            self.threshold_lux = self.baseline_sum / self.baseline_measurement_count * 3.0
+            self.state = 'waiting_for_threshold'
+            self.event('ready', t, threshold_lux=self.threshold_lux)
+            self.print ("{}Ready to start the test. Turn on the light now.".format(current_timestamp()))
+
+        if self.state == 'waiting_for_threshold' and lux >= self.threshold_lux:
+            self.state = 'sampling_period'
+            set_led(self.ready_led, GPIO.HIGH)
+            self.t_test_start = t
+            self.t_sampling_complete = self.t_test_start + 30.0
             if options.test_duration:
-                t_test_complete = t_test_complete = t_test_start + options.test_duration
-            sampling_lux_min = sensor_ceiling
-            sampling_lux_max = 0.0
-            print ("{}Light detected. Recording started.".format(current_timestamp()))
-            time.sleep(0.1)
-
-        if state == 'sampling_period' and t >= t_sampling_complete:
-            state = 'main_recording'
-            lux_at_30s = lux
-            print("{}Sampling period complete. The output at 30s was {:.1f} lux. Sampling period max = {:.1f} lux, min = {:.1f} lux.".format(current_timestamp(), lux_at_30s, sampling_lux_max, sampling_lux_min))
+                self.t_test_complete = self.t_test_start + options.test_duration
+            self.sampling_lux_min = self.sensor_ceiling
+            self.sampling_lux_max = 0.0
+            self.event('light_detected', t, lux=lux, t_test_start=t)
+            self.print ("{}Light detected. Recording started.".format(current_timestamp()))
+
+        if self.state == 'sampling_period' and t >= self.t_sampling_complete:
+            self.state = 'main_recording'
+            self.lux_at_30s = lux
+            self.event('sampling_complete', t, lux_at_30s=self.lux_at_30s,
+                    sampling_lux_max=self.sampling_lux_max, sampling_lux_min=self.sampling_lux_min)
+            self.print("{}Sampling period complete. The output at 30s was {:.1f} lux. Sampling period max = {:.1f} lux, min = {:.1f} lux.".format(current_timestamp(), self.lux_at_30s, self.sampling_lux_max, self.sampling_lux_min))
             text_to_print = '\tThe test will run until you stop it'
             if options.test_duration:
                 text_to_print += ', or it has recorded for {:.0f} minutes'.format(options.test_duration/60)
             if options.termination_percentage:
-                termination_output = lux_at_30s * options.termination_percentage / 100
+                termination_output = self.lux_at_30s * options.termination_percentage / 100
                 text_to_print += ', or it reaches {:.1f} lux ({:.1f}% of the output at 30s)'.format(termination_output, options.termination_percentage)
-            print(text_to_print + '.')
-            last_printed_percent = 100.0
-            last_print_time = t
-            percent_output = 100.0
-
-        if state == 'main_recording':
-            if options.test_duration and t >= t_test_complete:
-                state = 'exit'
-            if options.termination_percentage and percent_output <= options.termination_percentage:
-                state = 'checking_termination'
-                print("{}Output has reached {:.0f}% ({:.0f} lux), which is at or below your {}% target. The test will stop if output doesn't increase within 5 minutes.".format(current_timestamp(), percent_output, lux, options.termination_percentage))
-                last_print_time = t
-                last_printed_percent = percent_output
-                t_output_termination = t + 5.0 * 60.0
+            self.print(text_to_print + '.')
+            self.last_printed_percent = 100.0
+            self.last_print_time = t
+            self.percent_output = 100.0
+            if options.events:
+                self.detector = streaming.create_detector(options, self.lux_at_30s)
+
+        if self.state == 'main_recording':
+            if options.test_duration and t >= self.t_test_complete:
+                self.state = 'exit'
+                self.event('duration_reached', t)
+            if options.termination_percentage and self.termination_percent() <= options.termination_percentage:
+                self.state = 'checking_termination'
+                self.event('termination_check', t, percent_output=self.percent_output, lux=lux,
+                        termination_percentage=options.termination_percentage)
+                self.print("{}Output has reached {:.0f}% ({:.0f} lux), which is at or below your {}% target. The test will stop if output doesn't increase within 5 minutes.".format(current_timestamp(), self.percent_output, lux, options.termination_percentage))
+                self.last_print_time = t
+                self.last_printed_percent = self.percent_output
+                self.t_output_termination = t + 5.0 * 60.0
                 options.test_duration = True
-                
-        if state == 'checking_termination':
-            if t > t_output_termination:
-                state = 'exit'
-            elif percent_output > options.termination_percentage:
-                state = 'main_recording'
-                print('{}Output increased. Continuing to record.'.format(current_timestamp()))
 
-    print("{}Test complete".format(current_timestamp()))
-    GPIO.output(ready_led, GPIO.LOW)
-    GPIO.output(running_led, GPIO.LOW)
-    GPIO.output(complete_led, GPIO.HIGH)
+        if self.state == 'checking_termination':
+            if t > self.t_output_termination:
+                self.state = 'exit'
+                self.event('termination_confirmed', t, percent_output=self.percent_output)
+            elif self.termination_percent() > options.termination_percentage:
+                self.state = 'main_recording'
+                self.event('termination_cancelled', t, percent_output=self.percent_output)
+                self.print('{}Output increased. Continuing to record.'.format(current_timestamp()))
+
+        self.last_lux = lux
+        if self.telemetry:
+            self.telemetry.sample(t, lux, temp, self.state, self.percent_output, station=self.name)
+        if self.checkpoint:
+            self.checkpoint.maybe_write(self, self.state != previous_state)
+
+    def finish(self):
+        self.recording.close()
+        if self.checkpoint:
+            # A finished test can't be resumed, so its checkpoint only
+            # outlasts the recording if it wasn't closed cleanly.
+            self.checkpoint.remove()
+        self.event('test_complete', time.time())
+        self.output("{}Test complete".format(current_timestamp()))
+        if self.detector and self.detector.output.count:
+            output, counts = self.detector.output, self.detector.counts
+            self.output("\tOutput: mean {:.1f} lux, sd {:.1f}, min {:.1f}, max {:.1f}. {} step-downs, {} step-ups, {} regulated stretches".format(
+                    output.mean, output.std, output.min, output.max,
+                    counts['step_down'], counts['step_up'], counts['regulation_start']))
+        set_led(self.ready_led, GPIO.LOW)
+        set_led(self.running_led, GPIO.LOW)
+        set_led(self.complete_led, GPIO.HIGH)
+
+
+def station_print(name):
+    def print_line(text):
+        print('[{}] {}'.format(name, text))
+    return print_line
+
+
+class SamplePipeline:
+    # Threaded acquisition: the sampling thread only reads the sensors and
+    # timestamps, and hands samples to the state machine over a bounded queue.
+    # If the writer falls behind, new samples are dropped and counted rather
+    # than blocking the next read.
+    def __init__(self, test, queue_depth, stats=None):
+        self.test = test
+        self.stats = stats
+        if stats:
+            stats.pipeline = self
+        self.queue = queue.Queue(maxsize=max(1, queue_depth))
+        self.stop = threading.Event()
+        self.dropped_samples = 0
+        self.max_queue_depth = 0
+        self.scheduler = Scheduler(stats)
+        self.error = None
+
+    def sample(self, reader):
+        interval = None
+        try:
+            while not self.stop.is_set():
+                try:
+                    self.queue.put_nowait(reader.read() + (interval,))
+                except queue.Full:
+                    self.dropped_samples += 1
+                self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+                interval = self.test.next_interval()
+                self.scheduler.wait(interval)
+        except Exception as e:
+            self.error = e
+        finally:
+            while not self.stop.is_set():
+                try:
+                    self.queue.put(None, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def run(self, reader):
+        sampler = threading.Thread(target=self.sample, args=(reader,), name='rutite-sampler', daemon=True)
+        sampler.start()
+        try:
+            while self.test.state != 'exit':
+                sample = self.queue.get()
+                if sample is None:
+                    break
+                if self.stats:
+                    start = time.perf_counter()
+                    self.test.process(*sample)
+                    self.stats.add('process', time.perf_counter() - start)
+                    self.stats.maybe_write()
+                else:
+                    self.test.process(*sample)
+        finally:
+            self.stop.set()
+            sampler.join(timeout=1.0)
+        if self.error:
+            raise self.error
+
+    def summary(self):
+        return '{}, queue depth max {} of {}, {} dropped samples'.format(
+                self.scheduler.summary(), self.max_queue_depth, self.queue.maxsize, self.dropped_samples)
+
+
+class SensorReader:
+    # Reads the light sensor on every sample, but the temperature sensor only
+    # every temp_interval seconds (when set). Temperature changes slowly, so
+    # samples in between carry the last reading rather than paying for another
+    # slow I2C transaction.
+    def __init__(self, light_sensor, temp_sensor, temp_interval=None, stats=None):
+        self.stats = stats
+        self.light_sensor = light_sensor
+        self.temp_sensor = temp_sensor
+        self.temp_interval = temp_interval
+        self.temp = None
+        self.next_temp_read = None
+
+    def read(self):
+        if self.stats:
+            start = time.perf_counter()
+        lux = self.light_sensor.lux
+        t = time.time()
+        light_range = getattr(self.light_sensor, 'range', None)
+        if self.stats:
+            self.stats.add('light_read', time.perf_counter() - start)
+        if self.temp_sensor:
+            now = time.monotonic()
+            if not self.temp_interval or self.next_temp_read is None or now >= self.next_temp_read:
+                if self.stats:
+                    start = time.perf_counter()
+                self.temp = self.temp_sensor.temperature
+                if self.stats:
+                    self.stats.add('temp_read', time.perf_counter() - start)
+                if self.temp_interval:
+                    if self.next_temp_read is None or now - self.next_temp_read >= self.temp_interval:
+                        self.next_temp_read = now
+                    self.next_temp_read += self.temp_interval
+        return t, lux, self.temp, light_range
+
+
+def open_checkpoint(options):
+    if not options.checkpoint_interval:
+        return None
+    return Checkpoint(checkpoint_filename(options.filename), options.checkpoint_interval, options.fsync != 'never')
+
+
+def core(options, light_sensor, temp_sensor, recording, telemetry=None, resumed=None):
+    stats = None
+    if options.stats:
+        stats = Instrumentation(options.filename + '.stats.json', options.stats_interval)
+    test = RuntimeTest(options, recording, stats, telemetry, checkpoint=open_checkpoint(options))
+    if resumed:
+        test.resume(resumed, time.time())
+    reader = SensorReader(light_sensor, temp_sensor, options.temp_interval, stats)
+
+    if options.threaded:
+        pipeline = SamplePipeline(test, options.queue_depth, stats)
+        pipeline.run(reader)
+        test.finish()
+        print("\tTiming: {}".format(pipeline.summary()))
+        finish_stats(stats)
+        return pipeline
+
+    scheduler = Scheduler(stats)
+    interval = None
+    while test.state != 'exit':
+        if stats:
+            start = time.perf_counter()
+        test.process(*reader.read(), interval)
+        if stats:
+            stats.add('iteration', time.perf_counter() - start)
+            stats.maybe_write()
+        if test.state != 'exit':
+            interval = test.next_interval()
+            scheduler.wait(interval)
+    test.finish()
+    print("\tTiming: {}".format(scheduler.summary()))
+    finish_stats(stats)
+    return scheduler
+
+
+def finish_stats(stats):
+    if stats:
+        stats.write()
+        stats.print_summary()
+
+
+class Station:
+    # One rig in multi-station mode: its sensors, recording, state machine,
+    # schedule and timing stats.
+    def __init__(self, options, buses, telemetry=None):
+        self.options = options
+        self.name = options.name
+        self.light_sensor, self.temp_sensor = setup_sensors(options, buses)
+        setup_leds(options)
+        self.stats = None
+        if options.stats:
+            self.stats = Instrumentation(options.filename + '.stats.json', options.stats_interval)
+        self.recording = open_recording(options)
+        self.test = RuntimeTest(options, self.recording, self.stats, telemetry, self.name, open_checkpoint(options))
+        self.reader = SensorReader(self.light_sensor, self.temp_sensor, options.temp_interval, self.stats)
+        self.scheduler = Scheduler(self.stats)
+        self.interval = None
+
+    def step(self):
+        if self.stats:
+            start = time.perf_counter()
+        self.test.process(*self.reader.read(), self.interval)
+        if self.stats:
+            self.stats.add('iteration', time.perf_counter() - start)
+            self.stats.maybe_write()
+
+    def finish(self):
+        self.test.finish()
+        self.test.output("\tTiming: {}".format(self.scheduler.summary()))
+        finish_stats(self.stats)
+
+
+def core_stations(stations):
+    # Every station keeps its own schedule. One loop sleeps until the
+    # earliest deadline, takes that station's measurement and works out its
+    # next deadline, so a slow sensor on one station only delays the others
+    # by the time it takes to read.
+    deadlines = [(time.monotonic(), i) for i in range(len(stations))]
+    heapq.heapify(deadlines)
+    while deadlines:
+        deadline, i = heapq.heappop(deadlines)
+        station = stations[i]
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+            if station.stats:
+                station.stats.add('sleep_overshoot', max(0.0, time.monotonic() - deadline))
+        station.step()
+        if station.test.state == 'exit':
+            station.finish()
+            continue
+        station.interval = station.test.next_interval()
+        station.scheduler.advance(station.interval)
+        heapq.heappush(deadlines, (station.scheduler.next_deadline, i))
+
+
+def run_stations(options):
+    station_options = load_stations(options)
+    init_gpio(options)
+    buses = {}
+    stations = []
+    live_plots = []
+    telemetry = telemetry_server.start(options) if options.telemetry_port else None
+    try:
+        for station_option in station_options:
+            stations.append(Station(station_option, buses, telemetry))
+        for station in stations:
+            add_header(station.recording, station.options.running_led)
+            if station.options.live_plot:
+                live_plots.append(start_live_plot(station.options))
+        core_stations(stations)
+    finally:
+        for station in stations:
+            station.recording.close()
+        for live_plot in live_plots:
+            stop_live_plot(live_plot)
+        if telemetry:
+            telemetry.close()
+    for station in stations:
+        if station.options.catalogue:
+            catalogue_run(station.options)
+        if station.options.graph_title:
+            runtimeplot(station.options)
+
+
+def plot_value(cell):
+    # An empty cell, like the temperature in the row that marks where a test
+    # was resumed, is a gap in the line.
+    return float(cell) if cell else math.nan
+
+
+def graph_filename(options):
+    # A station's graph is named after it as well, as stations often share
+    # a title.
+    name = options.graph_title
+    if getattr(options, 'name', None):
+        name += ' ' + options.name
+    return name.replace(' ', '_').lower() + '.png'
 
 
 def runtimeplot(options):
-    
+    import matplotlib.pyplot as plt
+
     print('Creating plot...')
     fig = plt.figure(figsize=(15, 10))
 
@@ -254,19 +1286,18 @@ def runtimeplot(options):
     brightness = []
     temperature = []
 
-    with open(options.filename, 'r') as csvfile:
-        data = csv.reader(csvfile, delimiter=',')
-        next(data)
-        for row in data:
-            time.append(float(row[0]))
-            if options.lux_to_lumen_factor:
-                brightness.append(float(row[4]))
-                y_label = 'Lumens'
-            else:
-                brightness.append(float(row[1]))
-                y_label = 'Lux'
-            if options.temp_sensor:
-                temperature.append(float(row[5]))
+    data = recording_format.csv_rows(options.filename)
+    next(data)
+    for row in data:
+        time.append(float(row[0]))
+        if options.lux_to_lumen_factor:
+            brightness.append(plot_value(row[4]))
+            y_label = 'Lumens'
+        else:
+            brightness.append(plot_value(row[1]))
+            y_label = 'Lux'
+        if options.temp_sensor:
+            temperature.append(plot_value(row[5]))
 
     t_test_start = time[1]
     time = [(x - t_test_start) / 60 for x in time]
@@ -282,15 +1313,98 @@ def runtimeplot(options):
     plt.grid(True)
     plt.xlim(left=0)
     plt.ylim(bottom=0)
-    plt.savefig(options.graph_title.replace(' ', '_').lower()+'.png')
+    plt.savefig(graph_filename(options))
     print('plot saved')
 
 
+def catalogue_run(options):
+    # Adds the completed test to the catalogue (see catalogue.py), with what
+    # the recording itself doesn't say.
+    import catalogue
+    metadata = {
+        'graph_title': options.graph_title,
+        'light_sensor': options.light_sensor,
+        'temp_sensor': options.temp_sensor,
+        'interval': options.delay,
+        'lux_to_lumen_factor': options.lux_to_lumen_factor,
+        'station': getattr(options, 'name', None),
+    }
+    try:
+        catalogue.add(options.catalogue, options.filename, metadata=metadata)
+    except Exception as e:
+        print('{}Couldn\'t add {} to the catalogue: {}'.format(current_timestamp(), options.filename, e))
+        return
+    print('{}Added {} to {}'.format(current_timestamp(), options.filename, options.catalogue))
+
+
+def start_live_plot(options):
+    # Runs in its own process at a lower priority, so drawing never holds up
+    # a measurement. The graph is saved next to the recording.
+    import subprocess
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'live_runtime_plot.py'),
+            '-in', options.filename,
+            '-o', recording_format.strip_extensions(options.filename) + '.png',
+            '-ri', str(options.live_plot)]
+    if options.lux_to_lumen_factor:
+        command += ['-lf', str(options.lux_to_lumen_factor)]
+    else:
+        command += ['-yl', 'Lux']
+    if options.temp_sensor:
+        command += ['-ts', options.temp_sensor]
+    if options.graph_title:
+        command += ['-g', options.graph_title]
+    print("{}Live plot saved as {}".format(current_timestamp(), command[command.index('-o') + 1]))
+    return subprocess.Popen(command, preexec_fn=lambda: os.nice(10))
+
+
+def stop_live_plot(live_plot):
+    # The live plot picks up the last rows and saves the graph once more
+    # before it exits.
+    live_plot.terminate()
+    live_plot.wait()
+
+
+def exit_on_signal(signum, frame):
+    # Turn SIGTERM/SIGHUP (e.g. a dropped ssh session) into a normal exit so the
+    # recording still gets its final flush.
+    sys.exit(128 + signum)
+
+
 def main():
     options = load_options()
-    light_sensor, temp_sensor = init(options)
-    add_csv_header(options.filename)
-    core(options, light_sensor, temp_sensor)
+    signal.signal(signal.SIGTERM, exit_on_signal)
+    signal.signal(signal.SIGHUP, exit_on_signal)
+    if options.stations:
+        run_stations(options)
+        return
+    resumed = None
+    t_resume = None
+    if options.resume:
+        checkpoint = load_checkpoint(options.filename)
+        resumed = checkpoint['test']
+        # The last row can be up to -cpi seconds later than the checkpoint.
+        t_resume = recording_format.trim_recording(options.filename) or checkpoint['updated']
+        if options.hardware == 'simulated' and resumed.get('t_test_start') is not None:
+            # The simulated light carries on along its curve from there.
+            options.sim_on_delay = resumed['t_test_start'] - t_resume
+    light_sensor, temp_sensor = init(options, t_resume)
+    recording = open_recording(options)
+    live_plot = start_live_plot(options) if options.live_plot else None
+    telemetry = telemetry_server.start(options) if options.telemetry_port else None
+    try:
+        if resumed:
+            recording.resume()
+        else:
+            add_header(recording, options.running_led)
+        core(options, light_sensor, temp_sensor, recording, telemetry, resumed)
+    finally:
+        recording.close()
+        if telemetry:
+            telemetry.close()
+        if live_plot:
+            stop_live_plot(live_plot)
+    if options.catalogue:
+        catalogue_run(options)
     if options.graph_title:
         runtimeplot(options)
 
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+# Simulated hardware for running rutite.py without a Raspberry Pi.
+#
+# `python3 rutite.py -hw simulated` swaps the I2C sensors and RPi.GPIO for the
+# stand-ins below. The simulated light turns on a few seconds after startup and
+# either follows a synthetic runtime curve or replays an existing recording,
+# with configurable read latency and noise. A simulated clock lets the whole
+# test run faster than real time.
+
+import bisect
+import math
+import random
+import time as _time
+
+import recording
+
+# Seconds after the light turns on, and lux: ramp-up, a step-down after a
+# minute, slowly sagging regulation, then the battery cut-off.
+DEFAULT_PROFILE = '0:0,0.5:1000,60:1000,61:400,3600:350,3660:40,3700:0'
+AMBIENT_LUX = 1.0
+AMBIENT_TEMP = 22.0
+
+
+class SimulatedClock:
+    # Stands in for the time module. Simulated time runs `speed` times faster
+    # than real time, so sleeps are shortened and timestamps stretched to match.
+    # Simulated time starts now, or at epoch_start if given.
+    def __init__(self, speed=1.0, epoch_start=None):
+        if speed <= 0:
+            raise ValueError('simulation speed must be greater than zero')
+        self.speed = speed
+        self.real_start = _time.monotonic()
+        self.epoch_start = _time.time() if epoch_start is None else epoch_start
+
+    def elapsed(self):
+        return (_time.monotonic() - self.real_start) * self.speed
+
+    def time(self):
+        return self.epoch_start + self.elapsed()
+
+    def monotonic(self):
+        return self.elapsed()
+
+    def perf_counter(self):
+        return self.elapsed()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            _time.sleep(seconds / self.speed)
+
+    def localtime(self, secs=None):
+        return _time.localtime(self.time() if secs is None else secs)
+
+    def strftime(self, fmt, t=None):
+        return _time.strftime(fmt, self.localtime() if t is None else t)
+
+
+class SimulatedGPIO:
+    # Enough of RPi.GPIO for rutite.py. Pin levels are kept so they can be
+    # checked, along with how many times each pin was written.
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+
+    def __init__(self):
+        self.pins = {}
+        self.writes = {}
+
+    def setwarnings(self, flag):
+        pass
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, mode):
+        self.pins.setdefault(pin, self.LOW)
+
+    def output(self, pin, value):
+        self.pins[pin] = self.HIGH if value else self.LOW
+        self.writes[pin] = self.writes.get(pin, 0) + 1
+
+    def input(self, pin):
+        return self.pins.get(pin, self.LOW)
+
+    def cleanup(self):
+        self.pins.clear()
+
+
+class Curve:
+    # Piecewise-linear lux (and optionally temperature) against seconds since
+    # the light was turned on.
+    def __init__(self, times, lux, temps=None):
+        self.times = times
+        self.lux = lux
+        self.temps = temps
+
+    @classmethod
+    def from_profile(cls, profile):
+        points = sorted(tuple(float(x) for x in point.split(':')) for point in profile.split(','))
+        return cls([t for t, _ in points], [lux for _, lux in points])
+
+    @classmethod
+    def from_recording(cls, filename):
+        rows = recording.csv_rows(filename)
+        next(rows)
+        times, lux, temps = [], [], []
+        for row in rows:
+            times.append(float(row[0]))
+            lux.append(float(row[1]))
+            temps.append(float(row[5]) if row[5] not in ('', 'None') else math.nan)
+        if not times:
+            raise ValueError('{} has no recorded measurements'.format(filename))
+        times = [t - times[0] for t in times]
+        if all(math.isnan(temp) for temp in temps):
+            temps = None
+        return cls(times, lux, temps)
+
+    def interpolate(self, values, t):
+        if t <= self.times[0]:
+            return values[0]
+        if t >= self.times[-1]:
+            return values[-1]
+        i = bisect.bisect_right(self.times, t)
+        t0, t1 = self.times[i - 1], self.times[i]
+        v0, v1 = values[i - 1], values[i]
+        if t1 == t0:
+            return v1
+        return v0 + (v1 - v0) * (t - t0) / (t1 - t0)
+
+    def lux_at(self, t):
+        return self.interpolate(self.lux, t)
+
+    def temp_at(self, t):
+        if self.temps is None:
+            return None
+        return self.interpolate(self.temps, t)
+
+
+class SimulatedLight:
+    # The light under test. It's off until on_delay seconds after startup, then
+    # follows the curve; a replayed recording ends with the light turning off.
+    def __init__(self, clock, curve, on_delay=5.0, replay=False):
+        self.clock = clock
+        self.curve = curve
+        self.t_on = clock.monotonic() + on_delay
+        self.replay = replay
+        self.peak_lux = max(curve.lux) or 1.0
+
+    def seconds_on(self):
+        return self.clock.monotonic() - self.t_on
+
+    def lux(self):
+        t = self.seconds_on()
+        if t < 0 or (self.replay and t > self.curve.times[-1]):
+            return 0.0
+        return self.curve.lux_at(t)
+
+
+class SimulatedLightSensor:
+    # Once it's been given a gain and integration time (see ranging.py), it
+    # saturates at that range's ceiling and, like the real sensors, only has a
+    # new reading at the end of each integration period.
+    def __init__(self, light, ceiling, latency=0.0, noise=0.0):
+        self.light = light
+        self.ceiling = ceiling
+        self.latency = latency
+        self.noise = noise
+        self.integration_time = None
+        self.period = None
+        self.reading = None
+
+    def set_range(self, light_range):
+        self.ceiling = light_range.ceiling
+        self.integration_time = light_range.integration_time / 1000.0
+        self.period = None
+
+    def measure(self):
+        lux = self.light.lux()
+        if self.noise:
+            lux += random.gauss(0.0, self.noise * lux)
+        lux += AMBIENT_LUX * random.uniform(0.8, 1.2)
+        return min(max(lux, 0.0), self.ceiling)
+
+    @property
+    def lux(self):
+        self.light.clock.sleep(self.latency)
+        if not self.integration_time:
+            return self.measure()
+        period = int(self.light.clock.monotonic() // self.integration_time)
+        if period != self.period:
+            self.period = period
+            self.reading = self.measure()
+        return self.reading
+
+
+class SimulatedTempSensor:
+    # Replays the recorded temperature if there is one, otherwise heats up
+    # towards a level set by the light's output with a first order lag.
+    def __init__(self, light, latency=0.0, noise=0.0, rise=40.0, time_constant=120.0):
+        self.light = light
+        self.latency = latency
+        self.noise = noise
+        self.rise = rise
+        self.time_constant = time_constant
+        self.temp = AMBIENT_TEMP
+        self.last_read = light.clock.monotonic()
+
+    @property
+    def temperature(self):
+        self.light.clock.sleep(self.latency)
+        now = self.light.clock.monotonic()
+        temp = self.light.curve.temp_at(self.light.seconds_on()) if self.light.seconds_on() >= 0 else None
+        if temp is None or math.isnan(temp):
+            target = AMBIENT_TEMP + self.rise * self.light.lux() / self.light.peak_lux
+            self.temp += (target - self.temp) * (1.0 - math.exp(-(now - self.last_read) / self.time_constant))
+            temp = self.temp
+        self.last_read = now
+        if self.noise:
+            temp += random.gauss(0.0, self.noise)
+        return round(temp, 4)
+
+
+def add_arguments(parser):
+    parser.add_argument('-hw', '--hardware', dest='hardware', choices=['pi', 'simulated'],
+            default = 'pi',
+            help = 'pi to use the sensors and LEDs, or simulated to run without any hardware')
+    parser.add_argument('--sim-source', dest='sim_source',
+            default = 'synthetic',
+            help = 'synthetic to follow --sim-profile, or a recording to replay')
+    parser.add_argument('--sim-profile', dest='sim_profile',
+            default = DEFAULT_PROFILE,
+            help = 'synthetic curve as comma separated seconds:lux points after the light turns on')
+    parser.add_argument('--sim-speed', dest='sim_speed', type=float,
+            default = 1.0,
+            help = 'how many times faster than real time the simulation runs')
+    parser.add_argument('--sim-on-delay', dest='sim_on_delay', type=float,
+            default = 5.0,
+            help = 'seconds after startup before the simulated light turns on')
+    parser.add_argument('--sim-noise', dest='sim_noise', type=float,
+            default = 0.0,
+            help = 'relative noise added to each simulated lux reading (e.g. 0.005)')
+    parser.add_argument('--sim-light-latency', dest='sim_light_latency', type=float,
+            default = 0.0,
+            help = 'seconds each simulated light sensor read takes')
+    parser.add_argument('--sim-temp-latency', dest='sim_temp_latency', type=float,
+            default = 0.0,
+            help = 'seconds each simulated temperature sensor read takes')
+
+
+def create_sensors(options, ceiling, clock):
+    # A simulated light and its sensors. Several can share one clock, one for
+    # each station.
+    replay = options.sim_source != 'synthetic'
+    if replay:
+        curve = Curve.from_recording(options.sim_source)
+    else:
+        curve = Curve.from_profile(options.sim_profile)
+    light = SimulatedLight(clock, curve, on_delay=options.sim_on_delay, replay=replay)
+    light_sensor = SimulatedLightSensor(light, ceiling, latency=options.sim_light_latency, noise=options.sim_noise)
+    temp_sensor = None
+    if options.temp_sensor:
+        temp_sensor = SimulatedTempSensor(light, latency=options.sim_temp_latency, noise=0.05 if options.sim_noise else 0.0)
+    return light_sensor, temp_sensor
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+# Running statistics and event detection for a test while it runs, so step
+# changes and regulation show up as they happen rather than after working
+# through the whole recording with analysis.py.
+#
+# Everything here costs the same for every measurement, however long the test
+# has been running: a running mean and variance (Welford's method), an
+# exponential moving average that allows for uneven intervals, and a detector
+# that follows the level the light is holding.
+#
+#   step_down, step_up  the smoothed output has moved away from the level it
+#                       was holding by -es percent of the output at 30s for
+#                       -ec seconds. It's reported once the output has stopped
+#                       moving, with the level it moved from and to.
+#   regulation_start    after a step-down, the output has held a level for -rm
+#                       seconds.
+#
+# rutite.py -ev runs the detector during the main recording, and -tsm makes
+# the termination check (-tp) use the smoothed output, so noise doesn't start
+# the 5 minute countdown.
+
+import math
+
+
+class RunningStats:
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        self.min = min(self.min, x)
+        self.max = max(self.max, x)
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def std(self):
+        return math.sqrt(self.variance)
+
+    def state(self):
+        return dict(vars(self))
+
+    @classmethod
+    def from_state(cls, state):
+        stats = cls()
+        vars(stats).update(state)
+        return stats
+
+
+class Ema:
+    # An exponential moving average with a time constant in seconds. Each
+    # value is weighted by the time since the last one, so adaptive intervals
+    # and gaps are allowed for. A time constant of 0 means no smoothing.
+    def __init__(self, time_constant):
+        self.time_constant = time_constant
+        self.value = None
+        self.t = None
+
+    def add(self, t, x):
+        if self.value is None or self.time_constant <= 0:
+            self.value = x
+        else:
+            self.value += (x - self.value) * (1.0 - math.exp(-max(t - self.t, 0.0) / self.time_constant))
+        self.t = t
+        return self.value
+
+    def state(self):
+        return {'value': self.value, 't': self.t}
+
+    def restore(self, state):
+        self.value = state['value']
+        self.t = state['t']
+
+
+class EventDetector:
+    # Follows the level the smoothed output is holding. While it holds, each
+    # reading is added to the level's running stats. Once the smoothed output
+    # has been a step away from the level's mean for `confirm` seconds it's
+    # moving, and the next level starts when it's stayed within half a step
+    # for `settle` seconds.
+    def __init__(self, reference, step_percent=10.0, confirm=1.0, settle=5.0, regulation_min=30.0):
+        self.threshold = reference * step_percent / 100.0
+        self.confirm = confirm
+        self.settle = settle
+        self.regulation_min = regulation_min
+        self.output = RunningStats()
+        self.level = RunningStats()
+        self.moving = False
+        self.t_level = None
+        self.t_departed = None
+        self.step_from = None
+        self.anchor = None
+        self.t_anchor = None
+        self.stepped_down = False
+        self.regulated = False
+        self.counts = {'step_down': 0, 'step_up': 0, 'regulation_start': 0}
+
+    def add(self, t, lux, smoothed):
+        # Returns the event this reading completes, if any, as a dict.
+        if math.isnan(lux):
+            return None
+        self.output.add(lux)
+        if self.moving:
+            return self.follow_step(t, lux, smoothed)
+        if self.level.count and abs(smoothed - self.level.mean) >= self.threshold:
+            if self.t_departed is None:
+                self.t_departed = t
+            if t - self.t_departed >= self.confirm:
+                self.moving = True
+                self.step_from = self.level.mean
+                self.anchor, self.t_anchor = smoothed, t
+            return None
+        self.t_departed = None
+        if self.t_level is None:
+            self.t_level = t
+        self.level.add(lux)
+        if self.stepped_down and not self.regulated and t - self.t_level >= self.regulation_min:
+            self.regulated = True
+            return self.emit('regulation_start', self.t_level, level=self.level.mean, std=self.level.std)
+        return None
+
+    def follow_step(self, t, lux, smoothed):
+        if abs(smoothed - self.anchor) >= self.threshold / 2.0:
+            self.anchor, self.t_anchor = smoothed, t
+            return None
+        if t - self.t_anchor < self.settle:
+            return None
+        # Settled, so a new level starts here.
+        t_step = self.t_departed
+        self.moving = False
+        self.t_departed = None
+        self.level = RunningStats()
+        self.level.add(lux)
+        self.t_level = t
+        self.regulated = False
+        if abs(smoothed - self.step_from) < self.threshold:
+            return None # back where it was, so only a blip
+        name = 'step_down' if smoothed < self.step_from else 'step_up'
+        if name == 'step_down':
+            self.stepped_down = True
+        return self.emit(name, t_step, **{'from': self.step_from, 'to': smoothed})
+
+    def emit(self, name, t, **fields):
+        self.counts[name] += 1
+        return dict(fields, event=name, t=t)
+
+    def state(self):
+        state = {name: value for name, value in vars(self).items() if name not in ('output', 'level')}
+        state['output'] = self.output.state()
+        state['level'] = self.level.state()
+        return state
+
+    def restore(self, state):
+        vars(self).update(state)
+        self.output = RunningStats.from_state(state['output'])
+        self.level = RunningStats.from_state(state['level'])
+
+
+def add_arguments(parser):
+    parser.add_argument('-ev', '--events', dest='events', action='store_true',
+            help = 'detect step-downs, step-ups and the start of regulation while the test runs, and mark them in the recording')
+    parser.add_argument('-sm', '--smoothing', dest='smoothing', type=float,
+            default = 2.0,
+            help = 'time constant in seconds of the moving average used by -ev and -tsm (0 for none)')
+    parser.add_argument('-es', '--event-step', dest='event_step', type=float,
+            default = 10.0,
+            help = 'smallest change, in percent of the output at 30s, that -ev counts as a step')
+    parser.add_argument('-ec', '--event-confirm', dest='event_confirm', type=float,
+            default = 1.0,
+            help = 'seconds a change has to last before -ev counts it as a step')
+    parser.add_argument('-rm', '--regulation-min', dest='regulation_min', type=float,
+            default = 30.0,
+            help = 'seconds the output has to hold a level after a step-down before -ev reports regulation')
+    parser.add_argument('-tsm', '--termination-smoothed', dest='termination_smoothed', action='store_true',
+            help = 'check -tp against the moving average of the output instead of each measurement')
+
+
+def create_detector(options, reference):
+    # Readings settle within a few time constants of a step.
+    return EventDetector(reference, options.event_step, options.event_confirm,
+            max(options.event_confirm, 3 * options.smoothing), options.regulation_min)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+# Live telemetry for a running test, so you don't have to ssh in and tail the
+# csv file.
+#
+# `python3 rutite.py --telemetry 8787` keeps the most recent measurements and
+# test events in a fixed-size ring buffer and serves them as json over HTTP on
+# localhost (use `ssh -L 8787:localhost:8787 pi@rpi0` to reach it from
+# another machine):
+#
+#   /status              the current state, last measurement and test results
+#   /recent?since=SEQ    everything in the buffer after sequence number SEQ
+#   /events?since=SEQ    a server-sent event stream: the buffer after SEQ,
+#                        then every measurement and event as it happens
+#
+# Publishing never waits on a client. Each streaming client has a bounded
+# queue, and a client that falls far enough behind to fill it is dropped.
+
+import collections
+import itertools
+import json
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+BUFFER_SIZE = 1000
+CLIENT_QUEUE_SIZE = 256
+KEEPALIVE_INTERVAL = 15.0
+
+
+class Telemetry:
+    def __init__(self, size=BUFFER_SIZE, client_queue_size=CLIENT_QUEUE_SIZE):
+        self.items = collections.deque(maxlen=size)
+        self.client_queue_size = client_queue_size
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.clients = set()
+        self.dropped_clients = 0
+        self.status = {'state': None, 'sample': None}
+        self.server = None
+        self.closed = threading.Event()
+
+    def publish(self, item, status, station=None):
+        with self.lock:
+            if station is None:
+                self.status.update(status)
+            else:
+                self.status.setdefault('stations', {}).setdefault(station, {}).update(status)
+            self.seq += 1
+            item['seq'] = self.seq
+            self.items.append(item)
+            for client in list(self.clients):
+                try:
+                    client.put_nowait(item)
+                except queue.Full:
+                    self.clients.discard(client)
+                    self.dropped_clients += 1
+
+    # With several stations, each item names its station and /status has the
+    # status of each one under "stations".
+    def sample(self, t, lux, temp, state, percent_output=None, station=None):
+        item = {'type': 'sample', 't': t, 'lux': lux, 'temp': temp, 'state': state}
+        if percent_output is not None:
+            item['percent_output'] = percent_output
+        if station:
+            item['station'] = station
+        self.publish(item, {'state': state, 'sample': item}, station)
+
+    def event(self, name, t, station=None, **fields):
+        item = dict(fields, type='event', event=name, t=t)
+        if station:
+            item['station'] = station
+        self.publish(item, dict(fields, last_event=item), station)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.status, seq=self.seq, buffered=len(self.items),
+                    clients=len(self.clients), dropped_clients=self.dropped_clients)
+
+    def recent(self, since=0):
+        # Sequence numbers are consecutive, so the items after `since` are
+        # the last (seq - since) in the buffer.
+        with self.lock:
+            start = max(len(self.items) - (self.seq - since), 0)
+            return self.seq, list(itertools.islice(self.items, start, None))
+
+    def subscribe(self, since=None):
+        client = queue.Queue(maxsize=self.client_queue_size)
+        with self.lock:
+            if since is not None:
+                start = max(len(self.items) - (self.seq - since), 0)
+                for item in itertools.islice(self.items, start, None):
+                    if client.full():
+                        break
+                    client.put_nowait(item)
+            self.clients.add(client)
+        return client
+
+    def unsubscribe(self, client):
+        with self.lock:
+            self.clients.discard(client)
+
+    def is_subscribed(self, client):
+        with self.lock:
+            return client in self.clients
+
+    def serve(self, port, host='127.0.0.1'):
+        self.server = ThreadingHTTPServer((host, port), TelemetryHandler)
+        self.server.daemon_threads = True
+        self.server.telemetry = self
+        threading.Thread(target=self.server.serve_forever, name='telemetry', daemon=True).start()
+
+    def close(self):
+        self.closed.set()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class TelemetryHandler(BaseHTTPRequestHandler):
+    # A client that stops reading can only hold up its own thread, and only
+    # until the socket times out.
+    timeout = 30
+
+    def do_GET(self):
+        telemetry = self.server.telemetry
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        try:
+            since = int(query['since'][0]) if 'since' in query else None
+        except ValueError:
+            self.send_error(400, 'since must be a sequence number')
+            return
+        if url.path in ('/', '/status'):
+            self.send_json(telemetry.snapshot())
+        elif url.path == '/recent':
+            seq, items = telemetry.recent(since or 0)
+            self.send_json({'seq': seq, 'items': items})
+        elif url.path == '/events':
+            self.stream(telemetry, since)
+        else:
+            self.send_error(404)
+
+    def send_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream(self, telemetry, since):
+        client = telemetry.subscribe(since)
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            while not telemetry.closed.is_set():
+                if not telemetry.is_subscribed(client):
+                    break # dropped for falling behind
+                try:
+                    item = client.get(timeout=KEEPALIVE_INTERVAL)
+                except queue.Empty:
+                    self.wfile.write(b': keepalive\n\n')
+                    self.wfile.flush()
+                    continue
+                self.wfile.write('id: {}\ndata: {}\n\n'.format(item['seq'], json.dumps(item)).encode())
+                self.wfile.flush()
+        except OSError:
+            pass
+        finally:
+            telemetry.unsubscribe(client)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def add_arguments(parser):
+    parser.add_argument('-tel', '--telemetry', dest='telemetry_port', type=int,
+            help = 'serve recent measurements and test events as json on this localhost port (e.g. curl localhost:8787/status)')
+    parser.add_argument('-tels', '--telemetry-size', dest='telemetry_size', type=int,
+            default = BUFFER_SIZE,
+            help = 'number of recent measurements and events kept for telemetry clients')
+
+
+def start(options):
+    telemetry = Telemetry(options.telemetry_size)
+    telemetry.serve(options.telemetry_port)
+    return telemetry
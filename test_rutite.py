@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+# Runs rutite.py on the simulated backend, so no hardware is needed:
+#
+#   python3 -m pytest test_rutite.py
+
+import json
+import math
+import os.path
+import subprocess
+import sys
+import time
+
+RUTITE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rutite.py')
+SIMULATION = ['-hw', 'simulated', '--sim-speed', '200', '--sim-profile', '0:1000,60:1000,90:50']
+
+
+def start_test(directory, *args):
+    return subprocess.Popen([sys.executable, RUTITE] + SIMULATION + list(args),
+            cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+
+
+def kill_in_state(test, checkpoint, state, timeout=30):
+    # Kills the test, the way a power cut would, once its checkpoint shows
+    # it in `state`.
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with open(checkpoint) as f:
+                if json.load(f)['test']['state'] == state:
+                    break
+        except (OSError, ValueError):
+            pass
+        time.sleep(0.05)
+    test.kill()
+    test.wait()
+
+
+def read_rows(filename):
+    with open(filename) as f:
+        next(f)
+        return [[float(cell) if cell else None for cell in line.split(',')[:2]] for line in f]
+
+
+def test_resume_then_plot(tmp_path):
+    recording = tmp_path / 'r.csv'
+    checkpoint = tmp_path / 'r.csv.state.json'
+    test = start_test(tmp_path, '-ts', 'mcp9808', '-g', 'resume test', '-o', 'r.csv', '-cpi', '2', '-tp', '10')
+    kill_in_state(test, checkpoint, 'main_recording')
+    rows_before = len(read_rows(recording))
+
+    resumed = subprocess.run([sys.executable, RUTITE, '--resume', 'r.csv'],
+            cwd=tmp_path, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, timeout=120)
+    assert resumed.returncode == 0, resumed.stderr
+    assert (tmp_path / 'resume_test.png').exists()
+    assert not checkpoint.exists()
+
+    rows = read_rows(recording)
+    assert len(rows) > rows_before
+    times = [t for t, _ in rows]
+    assert all(later >= earlier for earlier, later in zip(times, times[1:]))
+    # The light carries on from where it was, rather than turning on again.
+    last_lux, gap_lux, next_lux = (lux for _, lux in rows[rows_before - 1:rows_before + 2])
+    assert math.isnan(gap_lux)
+    assert abs(next_lux - last_lux) < 100
+
+
+def test_resume_before_the_light_turns_on(tmp_path):
+    checkpoint = tmp_path / 'r.csv.state.json'
+    test = start_test(tmp_path, '--sim-on-delay', '300', '-o', 'r.csv', '-cpi', '0.5', '-tp', '10')
+    kill_in_state(test, checkpoint, 'waiting_for_threshold')
+
+    resumed = subprocess.run([sys.executable, RUTITE, '--resume', 'r.csv'],
+            cwd=tmp_path, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, timeout=120)
+    assert resumed.returncode == 0, resumed.stderr
+    assert not checkpoint.exists()
+    # Nothing was recorded before the crash, so there's no gap to mark.
+    assert not any(lux is None or math.isnan(lux) for _, lux in read_rows(tmp_path / 'r.csv'))